@@ -0,0 +1,272 @@
+
+# stdlib imports
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = '~/.cache/repoman'
+# how long, in seconds, MetadataCache entries are trusted for
+DEFAULT_METADATA_TTL = 3600
+
+
+class Cache(object):
+    """A local sqlite snapshot of the package items in a simpledb domain,
+    tagged with the repository generation it was taken at. Keeping it up
+    to date is the job of Repodb; this object only stores and filters."""
+
+    # bump this whenever the table layout changes: older cache files
+    # are thrown away and rebuilt from scratch
+    SCHEMA_VERSION = '2'
+
+    def __init__(self, domain_name, cache_dir=DEFAULT_CACHE_DIR):
+        self.domain_name = domain_name
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.path = os.path.join(self.cache_dir, '%s.sqlite' % domain_name)
+        self._log = LOG or logging.getLogger(__name__)
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self._db = sqlite3.connect(self.path)
+            # simpledb's LIKE is case sensitive, so ours should be too
+            self._db.execute('PRAGMA case_sensitive_like = ON')
+            self._create_tables()
+        return self._db
+
+    def _create_tables(self):
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS state '
+                             '(key TEXT PRIMARY KEY, value TEXT)')
+            row = self._db.execute(
+                "SELECT value FROM state WHERE key = 'schema'").fetchone()
+            if row is None or row[0] != self.SCHEMA_VERSION:
+                self._log.debug('(re)creating cache tables in %s', self.path)
+                self._db.execute('DROP TABLE IF EXISTS items')
+                self._db.execute('DROP TABLE IF EXISTS files')
+                self._db.execute('DELETE FROM state')
+                self._db.execute(
+                    "INSERT INTO state VALUES ('schema', ?)",
+                    (self.SCHEMA_VERSION,))
+            self._db.execute('CREATE TABLE IF NOT EXISTS items '
+                             '(key TEXT PRIMARY KEY, name TEXT, '
+                             'distribution TEXT, component TEXT, '
+                             'architecture TEXT, version TEXT, body TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS items_name '
+                             'ON items (name)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS items_leaf '
+                             'ON items (distribution, component, '
+                             'architecture)')
+            # the package files each item refers to, for find_files()
+            self._db.execute('CREATE TABLE IF NOT EXISTS files '
+                             '(key TEXT, filename TEXT, sha256 TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_key '
+                             'ON files (key)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_filename '
+                             'ON files (filename)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_sha256 '
+                             'ON files (sha256)')
+
+    @property
+    def generation(self):
+        """The repository generation this snapshot is current as of, or
+        None if the cache has never been populated."""
+        row = self.db.execute(
+            "SELECT value FROM state WHERE key = 'generation'").fetchone()
+        if row is None:
+            return None
+        return int(row[0])
+
+    def update(self, items, generation, replace=False):
+        """Store package items in the cache and mark it as current as of
+        `generation`. If replace is set, everything previously cached is
+        discarded first.
+
+        :param items: iterable of (key, item) tuples
+        :param generation: int
+        :param replace: bool
+        :returns: the number of items stored
+        """
+        count = 0
+        insert = 'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)'
+        with self.db:
+            if replace:
+                self.db.execute('DELETE FROM items')
+                self.db.execute('DELETE FROM files')
+            for key, item in items:
+                self.db.execute(
+                    insert,
+                    (key, item['name'], item['distribution'],
+                     item['component'], item['architecture'],
+                     item['version'], json.dumps(item, default=dict)))
+                self.db.execute('DELETE FROM files WHERE key = ?', (key,))
+                self.db.executemany(
+                    'INSERT INTO files VALUES (?, ?, ?)',
+                    [(key, filename, item.get('sha256'))
+                     for filename in _filenames(item)])
+                count += 1
+            self.db.execute(
+                "INSERT OR REPLACE INTO state VALUES ('generation', ?)",
+                (str(generation),))
+        self._log.debug('cached %d items as of generation %d',
+                        count, generation)
+        return count
+
+    def invalidate(self):
+        """Forget the cached generation so the next refresh is a full one"""
+        with self.db:
+            self.db.execute("DELETE FROM state WHERE key = 'generation'")
+
+    def select(self, names=[], dists=[], comps=[], archs=[], versions=[],
+               name_wildcard=False):
+        """The local equivalent of Repodb._assemble_select_query() plus
+        Repodb._select(): filter the cached items and return them as dicts.
+
+        :rtype: Generator
+        """
+        query = 'SELECT body FROM items'
+        clauses = []
+        params = []
+        if names:
+            if name_wildcard:
+                clauses.append('(%s)' % ' OR '.join(
+                    ["name LIKE ? ESCAPE '\\'"] * len(names)))
+                params.extend(
+                    [_escape_like(name) + '%' for name in names])
+            else:
+                clauses.append('name IN (%s)' % ','.join('?' * len(names)))
+                params.extend(names)
+        for column, values in (('distribution', dists),
+                               ('component', comps),
+                               ('architecture', archs),
+                               ('version', versions)):
+            if values:
+                values = list(values)
+                clauses.append('%s IN (%s)' % (
+                    column, ','.join('?' * len(values))))
+                params.extend(values)
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        self._log.debug('cache query: %s %s', query, params)
+        for row in self.db.execute(query, params):
+            yield json.loads(row[0])
+
+    def find_files(self, sha256s=[], filenames=[]):
+        """Return the cached items that refer to package files with any
+        of the given sha256 digests or file names.
+
+        :rtype: Generator
+        """
+        clauses = []
+        params = []
+        for column, values in (('sha256', sha256s),
+                               ('filename', filenames)):
+            if values:
+                values = list(values)
+                clauses.append('files.%s IN (%s)' % (
+                    column, ','.join('?' * len(values))))
+                params.extend(values)
+        if not clauses:
+            return
+        query = ('SELECT DISTINCT items.body FROM items JOIN files '
+                 'ON items.key = files.key WHERE ' + ' OR '.join(clauses))
+        self._log.debug('cache query: %s %s', query, params)
+        for row in self.db.execute(query, params):
+            yield json.loads(row[0])
+
+
+class MetadataCache(object):
+    """A small JSON file of values that cost a network call to look up
+    but rarely change -- the caller's ARN, the ARN of the SNS topic, the
+    existence of the simpledb domain -- so that short-lived invocations
+    can skip those calls. Entries expire `ttl` seconds after they were
+    stored; callers key them by whatever the value depends on (the AWS
+    profile, role and region, the domain or topic name...)."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_METADATA_TTL):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.path = os.path.join(self.cache_dir, 'metadata.json')
+        self.ttl = ttl
+        self._log = LOG or logging.getLogger(__name__)
+        self._entries = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as fp:
+                    self._entries = json.load(fp)
+            except (EnvironmentError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, key):
+        """Return the value stored under `key`, or None if there is none
+        or it has expired
+
+        :param key: string
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        self._log.debug('using cached %s', key)
+        return entry[1]
+
+    def set(self, key, value):
+        """Store a value under `key`, and write the cache file
+
+        :param key: string
+        :param value: anything that can be serialized to JSON
+        """
+        # re-read the file, to keep what other invocations stored since
+        self._entries = None
+        now = time.time()
+        entries = dict((k, v) for k, v in self.entries.items() if v[0] >= now)
+        entries[key] = [now + self.ttl, value]
+        self._write(entries)
+
+    def invalidate(self, key):
+        """Forget the value stored under `key`
+
+        :param key: string
+        """
+        self._entries = None
+        if key in self.entries:
+            entries = dict(self.entries)
+            del entries[key]
+            self._write(entries)
+
+    def _write(self, entries):
+        self._entries = entries
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # write to a temporary file first, so that concurrent
+            # invocations never read a partial file
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(entries, fp)
+            os.rename(tmp, self.path)
+        except EnvironmentError as ex:
+            self._log.debug('could not write %s: %s', self.path, ex)
+
+
+def _filenames(item):
+    # binary package items have a filename, source items a list of files
+    names = item.get('files') or []
+    if not isinstance(names, list):
+        names = [names]
+    if item.get('filename'):
+        names = [item['filename']] + names
+    return names
+
+
+def _escape_like(txt):
+    return txt.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
@@ -6,35 +6,51 @@ from __future__ import print_function
 import json
 import logging
 import os
+import re
 import sys
 import time
 
+from collections import defaultdict
 from logging import config
 from pkg_resources import resource_stream
 from six import iteritems
 from six.moves import input
 
 # pypi imports
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from colors import color
 from pgpy.errors import PGPDecryptionError
 from pydpkg import Dpkg
-from pydpkg import Dsc
 from pysectools.pinentry import Pinentry
 from tabulate import tabulate
 
 # internal imports
+from apt_repoman.cache import Cache
+from apt_repoman.cache import MetadataCache
 from apt_repoman.config import Config
+from apt_repoman.config import EVENTUAL_READ_COMMANDS
 from apt_repoman.connection import Connection
+from apt_repoman.ingest import IngestError
+from apt_repoman.ingest import Ingester
+from apt_repoman.migrate import MIGRATIONS
+from apt_repoman.migrate import Migrator
 from apt_repoman.repo import KeyExistsError
 from apt_repoman.repo import Repo
+from apt_repoman.repodb import GENERATION_ATTRIBUTES
 from apt_repoman.repodb import InvalidArchitectureError
+from apt_repoman.repodb import InvalidFieldError
+from apt_repoman.repodb import InvalidShardMapError
 from apt_repoman.repodb import ItemExistsError
 from apt_repoman.repodb import Repodb
+from apt_repoman.repodb import TIERS
+from apt_repoman.repodb import encode_version
+from apt_repoman.versions import sort_items
 
 
 LOG = logging.getLogger(__name__)
 HEADERS = ['name', 'distribution', 'component', 'architecture', 'version']
+MB = 1024 ** 2
 
 
 def repo_print_config(repodb, repo):
@@ -49,6 +65,15 @@ def repo_print_config(repodb, repo):
         LOG.info('\tArchitectures: %s', repodb.archs)
         LOG.info('\tOrigin: %s', repodb.origin)
         LOG.info('\tLabel: %s', repodb.label)
+        LOG.info('\tIndexed control fields: %s', repodb.fields)
+        LOG.info('\tShard map: %s', repodb.shard_map)
+        LOG.info('\tPool layout: %s', repodb.pool_layout)
+        if repodb.rebalancing_from:
+            LOG.warning('\tRebalancing from shard map %s is incomplete!',
+                        repodb.rebalancing_from)
+        if repodb.archive_keep:
+            LOG.info('\tArchive domain: %s (last kept %d versions)',
+                     repodb.archive_domain, repodb.archive_keep)
     except ClientError as ex:
         # if the domain doesn't exist, we can't query it
         # for its config...
@@ -62,7 +87,7 @@ def repo_print_config(repodb, repo):
 
 
 def repo_add(thing, args, repodb, repo):
-    abbrev = thing[0:4] + 's'
+    abbrev = 'fields' if thing == 'field' else thing[0:4] + 's'
     argname = thing + '_names'
     candidates = getattr(args, argname)
     existing = getattr(repodb, abbrev)
@@ -92,11 +117,15 @@ def repo_add(thing, args, repodb, repo):
     if confirm(args):
         res = repodb.add_meta(**kwargs)
     LOG.debug(res)
+    if abbrev == 'fields':
+        LOG.warning('Only packages added from now on will have these fields '
+                    'indexed: run "repoman-cli migrate extract-fields" to '
+                    'index the packages already in the repo.')
     return repo_print_config(repodb, repo)
 
 
 def repo_rm(thing, args, repodb, repo):
-    abbrev = thing[0:4] + 's'
+    abbrev = 'fields' if thing == 'field' else thing[0:4] + 's'
     argname = thing + '_names'
     candidates = getattr(args, argname)
     existing = getattr(repodb, abbrev)
@@ -137,6 +166,11 @@ def repo_rm(thing, args, repodb, repo):
     if confirm(args, evil):
         res = repodb.rm_meta(**{abbrev: elected})
     LOG.debug(res)
+    if abbrev == 'fields':
+        LOG.warning('Packages already in the repo keep their index '
+                    'attributes for these fields until you run '
+                    '"repoman-cli migrate extract-fields".')
+        return repo_print_config(repodb, repo)
     LOG.warning('Deleting a {0} from a repository does not actually '
                 'delete the package files from S3 or the items from '
                 'simpledb, it just stops including those {0}s in '
@@ -205,72 +239,50 @@ def add(args, repodb, repo):
     # we check this here before we risk uploading to s3
     if not validate_meta(args, repodb):
         return 1
+    ingester = Ingester(repodb, repo, processes=args.processes,
+                        threads=args.threads)
+    results = ingester.run(args.files,
+                           dists=args.distribution,
+                           comps=args.component,
+                           overwrite=args.overwrite,
+                           auto_purge=args.auto_purge,
+                           skip_duplicates=args.skip_duplicates)
     success = 0
-    for fn in args.files:
-        LOG.info('attempting to add file: %s', fn)
-        if fn.endswith('.deb'):
-            pkg = Dpkg(fn)
-        elif fn.endswith('.dsc'):
-            pkg = Dsc(fn)
-        else:
-            LOG.error('File "%s" is neither a deb nor a dsc files', fn)
-            success += 1
-            continue
-        try:
-            if isinstance(pkg, Dsc):
-                LOG.info('attempting to add source to s3: %s',
-                         os.path.basename(fn))
-                repo.add_source(pkg,
-                                dists=args.distribution,
-                                overwrite=args.overwrite)
-                LOG.info('attempting to add source to simpledb: %s',
-                         os.path.basename(fn))
-                repodb.add_source(pkg,
-                                  dists=args.distribution,
-                                  comps=args.component,
-                                  overwrite=args.overwrite,
-                                  auto_purge=args.auto_purge)
-            else:
-                arch = pkg.architecture
-                repodb.check_valid_archs([arch])
-                LOG.info('attempting to add package to s3: %s',
-                         os.path.basename(pkg.filename))
-                repo.add_package(pkg,
-                                 dists=args.distribution,
-                                 overwrite=args.overwrite)
-                LOG.info('attempting to add package to simpledb: %s',
-                         os.path.basename(pkg.filename))
-                repodb.add_package(pkg,
-                                   dists=args.distribution,
-                                   comps=args.component,
-                                   overwrite=args.overwrite,
-                                   auto_purge=args.auto_purge)
+    for fn, arch, skipped, error in results:
+        if skipped:
+            LOG.info('Package %s is already in every target '
+                     'distribution and component; skipping.', fn)
+        elif error is None:
             LOG.info('Successfully added %s to repoman!', fn)
-        except InvalidArchitectureError:
-            LOG.error('Package %s is built for the "%s" architecture, '
-                      'which this repo is not currently configured to '
-                      'serve; I will not add it.  You may which to run '
-                      '"repoman repo add_architecture %s"', fn, arch, arch)
-            success += 1
-            continue
-        except KeyExistsError:
-            LOG.error('Package %s already exists in S3, you either want the '
-                      '--overwrite flag or you want to move/copy the package '
-                      'within the repo.  Skipping.', fn)
-            success += 1
-            continue
-        except ItemExistsError:
-            LOG.error('Package %s already exists in simpledb, you either want '
-                      'the --overwrite flag or you want to move/copy the '
-                      'package within the repo.  Skipping.', fn)
+        else:
+            report_add_error(fn, arch, error)
             success += 1
-            continue
     if success > 0:
         LOG.error('Not all packages uploadeded successfully; inspect '
                   'the log output for errors.')
     return success
 
 
+def report_add_error(fn, arch, error):
+    if isinstance(error, InvalidArchitectureError):
+        LOG.error('Package %s is built for the "%s" architecture, '
+                  'which this repo is not currently configured to '
+                  'serve; I will not add it.  You may which to run '
+                  '"repoman repo add_architecture %s"', fn, arch, arch)
+    elif isinstance(error, KeyExistsError):
+        LOG.error('Package %s already exists in S3, you either want the '
+                  '--overwrite flag or you want to move/copy the package '
+                  'within the repo.  Skipping.', fn)
+    elif isinstance(error, ItemExistsError):
+        LOG.error('Package %s already exists in simpledb, you either want '
+                  'the --overwrite flag or you want to move/copy the '
+                  'package within the repo.  Skipping.', fn)
+    elif isinstance(error, IngestError):
+        LOG.error('%s', error)
+    else:
+        LOG.error('Could not add package %s: %s', fn, error)
+
+
 def pin_entry(args, signer):
     pinentry = Pinentry(
         pinentry_path=args.gpg_pinentry_path,
@@ -441,9 +453,7 @@ def create_table_data(results, headers):
         for dist in sorted(results[name]):
             for comp in sorted(results[name][dist]):
                 for arch in sorted(results[name][dist][comp]):
-                    pkgs = results[name][dist][comp][arch]
-                    pkgs.sort(
-                        key=lambda x: Dpkg.compare_versions_key(x['version']))
+                    pkgs = sort_items(results[name][dist][comp][arch])
                     for pkg in pkgs:
                         table.append([pkg[x] for x in headers])
     return table
@@ -506,6 +516,19 @@ def query(args, repodb, repo):
         comps = args.component or repodb.comps
         archs = args.architecture or repodb.archs
 
+    fields = defaultdict(list)
+    for spec in args.field or []:
+        field, sep, value = spec.partition('=')
+        if not sep:
+            LOG.fatal('--field must be in the form KEY=VALUE: %s', spec)
+            return 1
+        fields[field].append(value)
+    try:
+        repodb.check_valid_fields(fields)
+    except InvalidFieldError as ex:
+        LOG.fatal('%s; see "repoman-cli repo add-field"', ex)
+        return 1
+
     LOG.debug('querying simpledb')
     results = repodb.query(
         name_wildcard=args.wildcard,
@@ -514,16 +537,18 @@ def query(args, repodb, repo):
         archs=archs,
         names=args.package,
         versions=args.version,
-        latest_versions=args.latest_versions or 0)
+        latest_versions=args.latest_versions or 0,
+        fields=fields,
+        tiers=TIERS if args.include_archived else ('hot',))
 
     if not results.keys():
         LOG.fatal('No packages found')
         return False
 
     if args.outputfmt == 'json':
-        print(json.dumps(results, indent=2))
+        print(json.dumps(results, indent=2, default=dict))
     elif args.outputfmt == 'jsonc':
-        print(json.dumps(results))
+        print(json.dumps(results, default=dict))
     elif args.outputfmt == 'packages':
         dump_packages(results, repodb)
     else:
@@ -604,14 +629,16 @@ def validate_copy_args(args, repodb):
     evil = []
     if not validate_meta(args, repodb):
         return 1
-    if args.src_distribution == args.dst_distribution and \
+    # copying an archived package to where it came from restores it
+    restore = args.from_archive
+    if not restore and args.src_distribution == args.dst_distribution and \
             args.src_component == args.dst_component:
         LOG.fatal(color(
             'The source and destination distribution and '
             'component flags cannot both match; you\'d have nothing '
             'to copy.', fg='red'))
         return 1
-    if not any((args.dst_distribution, args.dst_component)):
+    if not restore and not any((args.dst_distribution, args.dst_component)):
         LOG.fatal(color(
             'You must specify at least one of a destination '
             'component or distribution when copying packages, '
@@ -636,21 +663,57 @@ def cp(args, repodb, repo):
         archs=args.architecture,
         versions=args.version,
         name_wildcard=args.wildcard,
-        latest_versions=args.latest_versions or 0)
+        latest_versions=args.latest_versions or 0,
+        tiers=('archive',) if args.from_archive else ('hot',))
     candidates, targets = repodb.get_copy_spec(
         candidates=candidates,
         src_dist=args.src_distribution,
         src_comp=args.src_component,
         dst_dist=args.dst_distribution,
         dst_comp=args.dst_component,
-        prune_for_promote=args.promote)
+        prune_for_promote=args.promote,
+        from_archive=args.from_archive)
     if cp_prompt(args, candidates, targets, evil):
-        repodb.do_copy(candidates, targets, repo,
-                       overwrite=args.overwrite,
-                       auto_purge=args.auto_purge)
+        failures = repodb.do_copy(candidates, targets, repo,
+                                  overwrite=args.overwrite,
+                                  auto_purge=args.auto_purge,
+                                  threads=args.threads,
+                                  progress=Progress())
+        if failures:
+            report_copy_failures(failures)
+            return 1
     return 0
 
 
+class Progress(object):
+    """Log the progress of the stages of a long-running operation, at
+    most every `interval` seconds and when each stage completes."""
+
+    STAGES = {'copy': 'Copied %d of %d package files in S3',
+              'write': 'Wrote %d of %d package items to simpledb'}
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self._last = 0
+
+    def __call__(self, stage, done, total):
+        now = time.time()
+        if done == total or now - self._last >= self.interval:
+            self._last = now
+            LOG.info(self.STAGES.get(stage, stage + ': %d of %d'),
+                     done, total)
+
+
+def report_copy_failures(failures):
+    table = [[pkg['name'], pkg['version'], pkg['architecture'],
+              pkg['distribution'], pkg['component'], error]
+             for pkg, error in failures]
+    LOG.error('%d packages could not be copied:', len(failures))
+    print('\n' + tabulate(table, headers=['name', 'version', 'architecture',
+                                          'dst dist', 'dst comp', 'error']) +
+          '\n')
+
+
 def rm(args, repodb, repo):
     if not validate_meta(args, repodb):
         return 1
@@ -738,7 +801,7 @@ def backup(args, repodb, repo):
     backup = {}
     backup['metadata'] = repodb._get_attributes('meta', always_list=True)
     backup['packages'] = repodb.query()
-    print(json.dumps(backup, indent=2))
+    print(json.dumps(backup, indent=2, default=dict))
     return 0
 
 
@@ -757,14 +820,192 @@ def restore(args, repodb, repo):
                     for arch, items in iteritems(archs):
                         for item in items:
                             LOG.info('Restoring item: %s', item)
+                            item['versionkey'] = encode_version(
+                                item['version'])
                             repodb._put_item(item)
+        repodb._index_names(packages.keys())
         LOG.info('Restoring repo configuration: %s', meta)
-        repodb._put_attributes('meta', meta)
+        repodb._put_attributes('meta', dict(
+            (k, v) for k, v in iteritems(meta)
+            if k not in GENERATION_ATTRIBUTES))
+        # the restored items are not stamped with anything meaningful:
+        # make any local caches start over
+        repodb._bump_generation(purged=True)
+    return 0
+
+
+def migrate(args, repodb, repo):
+    """Rewrite existing package items to match the current schema"""
+    migrator = Migrator(repodb, threads=args.threads)
+    names = args.migration or migrator.pending
+    unknown = [x for x in names if x not in MIGRATIONS]
+    if unknown:
+        LOG.fatal('Unknown migration(s) %s; choose from: %s',
+                  ','.join(unknown), ','.join(MIGRATIONS))
+        return 1
+    if not names:
+        LOG.info('All migrations have already been applied')
+        return 0
+    LOG.warning(color(
+        'Rewriting package items in simpledb domain %s: %s', fg='red'),
+        repodb.domain_name, ','.join(names))
+    if confirm(args):
+        for name in names:
+            counts = migrator.run(name)
+            LOG.info('Migration %s scanned %d items and rewrote %d; %d '
+                     'changed underneath it and were skipped', name,
+                     counts['scanned'], counts['rewritten'],
+                     counts['skipped'])
+    return 0
+
+
+def rebalance(args, repodb, repo):
+    """Move package items between simpledb domains"""
+    shard_map = args.shard_map[0]
+    LOG.warning(color(
+        'Moving package items in simpledb domain %s to shard map %s',
+        fg='red'), repodb.domain_name, shard_map)
+    if confirm(args):
+        try:
+            moved = repodb.rebalance(shard_map)
+        except InvalidShardMapError as ex:
+            LOG.fatal('%s', ex)
+            return 1
+        LOG.info('Moved %d items; package items now live in: %s',
+                 moved, ', '.join(repodb.shard_domains))
+    return 0
+
+
+def relayout(args, repodb, repo):
+    """Switch the layout of the S3 pool"""
+    layout = args.pool_layout[0]
+    LOG.warning(color(
+        'Switching the pool in s3://%s to the %s layout',
+        fg='red'), repo.bucket_name, layout)
+    if confirm(args):
+        moved = repodb.relayout(layout, repo)
+        LOG.info('Moved %d items to the %s pool layout', moved, layout)
+        if moved:
+            LOG.warning('Publish every distribution for apt to find '
+                        'packages at their new location.')
+    return 0
+
+
+def which(args, repodb, repo):
+    """Find the package items that refer to a package file"""
+    sha256s = []
+    filenames = []
+    for target in args.target:
+        if os.path.isfile(target) and target.endswith('.deb'):
+            sha256s.append(Dpkg(target).sha256)
+        elif re.match(r'^[0-9a-f]{64}$', target):
+            sha256s.append(target)
+        else:
+            # source packages have no digests in simpledb; fall back on
+            # the name of the file
+            filenames.append(os.path.basename(target))
+    results = repodb.find_files(
+        sha256s=sha256s, filenames=filenames,
+        tiers=TIERS if args.include_archived else ('hot',))
+    if not results:
+        LOG.fatal('No packages found')
+        return 1
+    if args.outputfmt == 'json':
+        print(json.dumps(results, indent=2))
+    elif args.outputfmt == 'jsonc':
+        print(json.dumps(results))
+    else:
+        headers = HEADERS + ['files']
+        table = []
+        for item in results:
+            files = item.get('files') or item.get('filename')
+            if isinstance(files, list):
+                files = ' '.join(files)
+            table.append([item[x] for x in HEADERS] + [files])
+        print('\n' + tabulate(
+            sorted(table), headers=headers, tablefmt=args.outputfmt))
+    return 0
+
+
+def stats(args, repodb, repo):
+    """Count packages on the simpledb side, leaf by leaf"""
+    if not validate_meta(args, repodb):
+        return 1
+    results = repodb.stats(
+        dists=args.distribution,
+        comps=args.component,
+        archs=args.architecture,
+        names=args.names,
+        sample=args.sample,
+        tiers=TIERS if args.include_archived else ('hot',))
+    if args.outputfmt == 'json':
+        print(json.dumps(results, indent=2))
+    elif args.outputfmt == 'jsonc':
+        print(json.dumps(results))
+    else:
+        headers = ['distribution', 'component', 'architecture', 'items']
+        if args.names:
+            headers.append('names')
+        if args.sample:
+            headers.append('bytes')
+        table = [[x[k] for k in headers] for x in results]
+        # distinct names can't be summed across leaves
+        table.append(['total', '', ''] + [
+            sum(x[k] for x in results) if k != 'names' else ''
+            for k in headers[3:]])
+        print('\n' + tabulate(
+            table, headers=headers, tablefmt=args.outputfmt))
+    return 0
+
+
+def changes(args, repodb, repo):
+    """List the changes to package items after a sequence number"""
+    records = list(repodb.changes_since(args.since))
+    if args.outputfmt == 'json':
+        print(json.dumps(records, indent=2))
+    elif args.outputfmt == 'jsonc':
+        print(json.dumps(records))
+    else:
+        headers = ['seq', 'action'] + HEADERS + ['caller']
+        table = [[x.get(k) for k in headers] for x in records]
+        print('\n' + tabulate(
+            table, headers=headers, tablefmt=args.outputfmt))
+    return 0
+
+
+def archive(args, repodb, repo):
+    """Move superseded package versions into the archive domain"""
+    if not validate_meta(args, repodb):
+        return 1
+    if args.keep < 1:
+        LOG.fatal('--keep must be at least 1; use `repoman-cli rm` to '
+                  'get rid of packages altogether')
+        return 1
+    evil = []
+    if not any((args.package, args.distribution, args.component)):
+        evil.append('You are about to archive old versions of every '
+                    'package in the repository!')
+    LOG.warning(color(
+        'Archiving all but the %d most recent versions of matching '
+        'packages to simpledb domain %s', fg='red'),
+        args.keep, repodb.archive_domain)
+    if confirm(args, evil):
+        try:
+            archived = repodb.archive(
+                args.keep,
+                names=args.package,
+                dists=args.distribution,
+                comps=args.component,
+                archs=args.architecture,
+                name_wildcard=args.wildcard)
+        except InvalidShardMapError as ex:
+            LOG.fatal('%s', ex)
+            return 1
+        LOG.info('Archived %d package items', archived)
     return 0
 
 
 def main():
-    retval = 0
     repoman_config = Config(sys.argv[1:])
     args = repoman_config.args
 
@@ -782,10 +1023,36 @@ def main():
     if args.region:
         LOG.warning('overriding default AWS region to: %s', args.region)
 
-    connection = Connection(role_arn=args.aws_role, region=args.region)
-    repodb = Repodb(args.simpledb_domain, connection=connection)
-    repo = Repo(args.s3_bucket, connection=connection)
+    metadata = None
+    if args.metadata_ttl > 0:
+        metadata = MetadataCache(args.cache_dir, ttl=args.metadata_ttl)
+    connection = Connection(role_arn=args.aws_role, region=args.region,
+                            metadata=metadata)
+    cache = None
+    if args.cache and command in ('query', 'publish', 'cp', 'which'):
+        cache = Cache(args.simpledb_domain, cache_dir=args.cache_dir)
+    consistency = args.read_consistency or (
+        'eventual' if command in EVENTUAL_READ_COMMANDS else 'strong')
+    repodb = Repodb(args.simpledb_domain, connection=connection,
+                    control_format=args.control_format, cache=cache,
+                    consistent_read=consistency == 'strong',
+                    notify_mode=args.notify_mode, spool_dir=args.cache_dir,
+                    metadata=metadata)
+    repo = Repo(args.s3_bucket, connection=connection,
+                transfer_config=TransferConfig(
+                    multipart_threshold=args.multipart_threshold * MB,
+                    multipart_chunksize=args.multipart_chunksize * MB,
+                    max_concurrency=args.max_concurrency))
+
+    try:
+        return run_command(command, args, repodb, repo)
+    finally:
+        # notifications go out in the background; wait for them here
+        repodb.close(args.notify_timeout)
 
+
+def run_command(command, args, repodb, repo):
+    retval = 0
     funcs = globals()
 
     if command == 'checkup' or not args.skip_checkup:
@@ -794,7 +1061,8 @@ def main():
             retval += funcs['checkup'](args, repodb, repo)
 
     if command in ('setup', 'repo', 'add', 'cp', 'rm', 'query',
-                   'backup', 'restore'):
+                   'backup', 'restore', 'migrate', 'rebalance', 'archive',
+                   'changes', 'stats', 'which', 'relayout'):
         retval += funcs[command](args, repodb, repo)
 
     # never auto-publish if something above threw an error
@@ -6,11 +6,22 @@ import sys
 # pypi imports
 from configargparse import ArgParser
 
+# internal imports
+from apt_repoman.cache import DEFAULT_CACHE_DIR
+from apt_repoman.cache import DEFAULT_METADATA_TTL
+from apt_repoman.notify import DEFAULT_TIMEOUT
+from apt_repoman.notify import NOTIFY_MODES
+from apt_repoman.repodb import POOL_LAYOUTS
+
 DEFAULT_CONFIG_FILES = ('/etc/repoman/repoman.conf', '~/.repoman')
 
 # note that we do not offer public-read-write as an option; if
 # you want to do that, you can do it to yourself
 S3_BUCKET_ACLS = ('private', 'public-read', 'authenticated-read')
+READ_CONSISTENCIES = ('strong', 'eventual')
+# read-only commands that can do without strongly consistent reads; the
+# reads that plan mutations (e.g. in cp, rm and add) must be strong
+EVENTUAL_READ_COMMANDS = ('query', 'backup', 'checkup', 'stats', 'which')
 LOG = logging.getLogger(__name__)
 
 
@@ -76,6 +87,63 @@ class Config(object):
                   type=int, required=False,
                   help='automatically purge packages older than the '
                   'last N revisions when adding or copying')
+        flags.add('--control-format', action='store', default='packed',
+                  choices=('packed', 'zlib'), required=False,
+                  env_var='REPOMAN_CONTROL_FORMAT',
+                  help='how to store package control text in simpledb: '
+                  'packed (default) or zlib (compressed)')
+        flags.add('--cache', action='store_true', default=False,
+                  required=False, env_var='REPOMAN_CACHE',
+                  help='keep a local copy of the simpledb domain for '
+                  'query, publish, cp and which, refreshed incrementally')
+        flags.add('--cache-dir', action='store', default=DEFAULT_CACHE_DIR,
+                  required=False, env_var='REPOMAN_CACHE_DIR',
+                  help='directory for the local simpledb cache '
+                  '(default: %s)' % DEFAULT_CACHE_DIR)
+        flags.add('--metadata-ttl', action='store', type=int,
+                  default=DEFAULT_METADATA_TTL, required=False,
+                  env_var='REPOMAN_METADATA_TTL',
+                  help='seconds to remember the caller identity, the SNS '
+                  'topic ARN and the existence of the simpledb domain for, '
+                  'in --cache-dir, across invocations; 0 to look them up '
+                  'every time (default: %d)' % DEFAULT_METADATA_TTL)
+        flags.add('--read-consistency', action='store', default=None,
+                  choices=READ_CONSISTENCIES, required=False,
+                  env_var='REPOMAN_READ_CONSISTENCY',
+                  help='strong reads see every completed write, eventual '
+                  'reads are cheaper and faster but may be a second or so '
+                  'out of date (default: eventual for query, backup, '
+                  'checkup, stats and which, strong otherwise)')
+        flags.add('--multipart-threshold', action='store', type=int,
+                  default=8, required=False,
+                  env_var='REPOMAN_MULTIPART_THRESHOLD',
+                  help='upload files of this many MiB or more to S3 in '
+                  'parts (default: 8)')
+        flags.add('--multipart-chunksize', action='store', type=int,
+                  default=16, required=False,
+                  env_var='REPOMAN_MULTIPART_CHUNKSIZE',
+                  help='size in MiB of the parts of multipart uploads; S3 '
+                  'takes at most 10000 parts (default: 16, for files of '
+                  'up to 156 GiB)')
+        flags.add('--max-concurrency', action='store', type=int,
+                  default=10, required=False,
+                  env_var='REPOMAN_MAX_CONCURRENCY',
+                  help='number of files and parts of files to upload to '
+                  'S3 at once, across all the files being added '
+                  '(default: 10)')
+        flags.add('--notify-mode', action='store', default='batch',
+                  choices=NOTIFY_MODES, required=False,
+                  env_var='REPOMAN_NOTIFY_MODE',
+                  help='publish a notification for every change (batch, '
+                  'the default) or a single summary of the changes made '
+                  'by the command (summary)')
+        flags.add('--notify-timeout', action='store', type=int,
+                  default=DEFAULT_TIMEOUT, required=False,
+                  env_var='REPOMAN_NOTIFY_TIMEOUT',
+                  help='seconds to wait for notifications to be published '
+                  'before exiting; those left over are spooled in '
+                  '--cache-dir and published by the next run (default: '
+                  '%d)' % DEFAULT_TIMEOUT)
 
         # subparsers for commands
         commands = flags.add_subparsers(dest='command')
@@ -110,6 +178,27 @@ class Config(object):
             'publish', help='publish the repository to s3')
         query_flags = commands.add_parser(
             'query', help='query the repository')
+        migrate_flags = commands.add_parser(
+            'migrate', help='rewrite existing simpledb items to match '
+            'the current repoman schema')
+        rebalance_flags = commands.add_parser(
+            'rebalance', help='spread package items over several simpledb '
+            'domains, or move them back into one')
+        relayout_flags = commands.add_parser(
+            'relayout', help='switch the layout of the s3 pool that '
+            'package files are added under')
+        which_flags = commands.add_parser(
+            'which', help='find the packages in the repository that refer '
+            'to a package file')
+        stats_flags = commands.add_parser(
+            'stats', help='count the packages in each distribution, '
+            'component and architecture')
+        changes_flags = commands.add_parser(
+            'changes', help='list changes to the repository\'s packages, '
+            'oldest first')
+        archive_flags = commands.add_parser(
+            'archive', help='move superseded package versions out of the '
+            'way, into an archive simpledb domain')
 
         # command flags
 
@@ -128,6 +217,14 @@ class Config(object):
                         help='narrow query by package name(s)')
         query_flags.add('-w', '--wildcard', action='store_true', default=False,
                         help='match package names to left of --package flag')
+        query_flags.add('-F', '--field', action='append', required=False,
+                        metavar='KEY=VALUE',
+                        help='narrow query by the value of an indexed '
+                        'control field, e.g. Section=utils')
+        query_flags.add('-A', '--include-archived', action='store_true',
+                        default=False,
+                        help='include packages moved to the archive by '
+                        '`repoman-cli archive`')
         query_flags.add('-H', '--query-hidden', action='store_true',
                         default=False,
                         help='include packages "hidden" by the removal of '
@@ -280,6 +377,38 @@ class Config(object):
                         dest='confirm', required=False, default=False,
                         help='do not prompt for confirmation')
 
+        repo_add_field_flags = repo_commands.add_parser(
+            'add-field', help='index a control field for query --field')
+        repo_add_field_flags.add(
+            'field_names', nargs='+', help='control field to index')
+        repo_add_field_flags.add(
+            '--i-fear-no-evil', action='store_true',
+            default=False, required=False,
+            help='skip confirmation step for scary actions')
+        raf_confirm = repo_add_field_flags.add_mutually_exclusive_group()
+        raf_confirm.add('--confirm', action='store_true', dest='confirm',
+                        required=False, default=True,
+                        help='confirm any mutating actions')
+        raf_confirm.add('-y', '--no-confirm', action='store_false',
+                        dest='confirm', required=False, default=False,
+                        help='do not prompt for confirmation')
+
+        repo_rm_field_flags = repo_commands.add_parser(
+            'rm-field', help='stop indexing a control field')
+        repo_rm_field_flags.add(
+            'field_names', nargs='+', help='control field to stop indexing')
+        repo_rm_field_flags.add(
+            '--i-fear-no-evil', action='store_true',
+            default=False, required=False,
+            help='skip confirmation step for scary actions')
+        rrf_confirm = repo_rm_field_flags.add_mutually_exclusive_group()
+        rrf_confirm.add('--confirm', action='store_true', dest='confirm',
+                        required=False, default=True,
+                        help='confirm any mutating actions')
+        rrf_confirm.add('-y', '--no-confirm', action='store_false',
+                        dest='confirm', required=False, default=False,
+                        help='do not prompt for confirmation')
+
         repo_add_topic_flags = repo_commands.add_parser(
             'add-topic', help='send notifications to an SNS topic')
         repo_add_topic_flags.add('topic_name', nargs=1, action='store',
@@ -343,6 +472,19 @@ class Config(object):
         add_flags.add('--publish',
                       action='store_true', required=False, default=False,
                       help='publish the repo to s3 after adding packages')
+        add_flags.add('--skip-duplicates',
+                      action='store_true', required=False, default=False,
+                      help='quietly skip binary packages whose exact file '
+                      'is already in every target distribution and '
+                      'component')
+        add_flags.add('--processes', action='store', type=int,
+                      default=0, required=False,
+                      help='number of package files to parse and hash at '
+                      'once (default: one per CPU)')
+        add_flags.add('--threads', action='store', type=int,
+                      default=8, required=False,
+                      help='number of package files to upload to S3 at '
+                      'once (default: 8)')
         add_flags.add('files', nargs='+', help='debian package files to add')
 
         # copy
@@ -369,6 +511,9 @@ class Config(object):
                      'is more recent than the latest destination version ')
         cp_flags.add('-w', '--wildcard', action='store_true', default=False,
                      help='match package names to left of --package flag')
+        cp_flags.add('--from-archive', action='store_true', default=False,
+                     help='copy (or, with no destination, restore) packages '
+                     'moved to the archive by `repoman-cli archive`')
         cp_latest = cp_flags.add_mutually_exclusive_group()
         cp_latest.add('-v', '--version', action='append',
                       help='only copy packages matching these versions')
@@ -379,6 +524,10 @@ class Config(object):
         cp_latest.add('-r', '--recent', action='store', default=0,
                       type=int, dest='latest_versions',
                       help='only copy the N most recent package versions')
+        cp_flags.add('--threads', action='store', type=int,
+                     default=8, required=False,
+                     help='number of package files to copy in S3 at once, '
+                     'when copying between distributions (default: 8)')
         cp_flags.add('--i-fear-no-evil', action='store_true',
                      default=False, required=False,
                      help='skip confirmation step for scary actions')
@@ -440,6 +589,143 @@ class Config(object):
                        dest='confirm', required=False, default=False,
                        help='do not prompt for confirmation')
 
+        # migrate
+        migrate_flags.add('migration', nargs='*',
+                          help='migrations to apply (default is every '
+                          'migration not applied yet)')
+        migrate_flags.add('--threads', action='store', type=int,
+                          default=16, required=False,
+                          help='number of partitions of the domain to '
+                          'migrate at once (default: 16)')
+        migrate_confirm = migrate_flags.add_mutually_exclusive_group()
+        migrate_confirm.add('--confirm', action='store_true', dest='confirm',
+                            required=False, default=True,
+                            help='confirm any mutating actions')
+        migrate_confirm.add('-y', '--no-confirm', action='store_false',
+                            dest='confirm', required=False, default=False,
+                            help='do not prompt for confirmation')
+
+        # rebalance
+        rebalance_flags.add('shard_map', nargs=1, action='store',
+                            metavar='{none,dist,hash:N}',
+                            help='none keeps every package in the one '
+                            'domain, dist uses a domain per distribution '
+                            'and hash:N spreads packages over N domains')
+        rebalance_confirm = rebalance_flags.add_mutually_exclusive_group()
+        rebalance_confirm.add('--confirm', action='store_true',
+                              dest='confirm', required=False, default=True,
+                              help='confirm any mutating actions')
+        rebalance_confirm.add('-y', '--no-confirm', action='store_false',
+                              dest='confirm', required=False, default=False,
+                              help='do not prompt for confirmation')
+
+        # relayout
+        relayout_flags.add('pool_layout', nargs=1, action='store',
+                           choices=POOL_LAYOUTS,
+                           help='dist keeps the files of each distribution '
+                           'in a directory of its own, hash keeps each '
+                           'file once, in a directory named after its '
+                           'sha256 that every distribution shares')
+        relayout_confirm = relayout_flags.add_mutually_exclusive_group()
+        relayout_confirm.add('--confirm', action='store_true',
+                             dest='confirm', required=False, default=True,
+                             help='confirm any mutating actions')
+        relayout_confirm.add('-y', '--no-confirm', action='store_false',
+                             dest='confirm', required=False, default=False,
+                             help='do not prompt for confirmation')
+
+        # which
+        which_flags.add('target', nargs='+',
+                        help='a local .deb file, the sha256 digest of one, '
+                        'or the name of a file in the pool')
+        which_flags.add('-A', '--include-archived', action='store_true',
+                        default=False,
+                        help='include packages moved to the archive by '
+                        '`repoman-cli archive`')
+        which_flags.add('-f', '--format', action='store',
+                        dest='outputfmt', default='simple',
+                        choices=('json', 'jsonc', 'simple', 'plain', 'grid',
+                                 'fancy_grid', 'pipe', 'orgtbl', 'jira',
+                                 'psql', 'rst', 'mediawiki', 'moinmoin',
+                                 'html', 'latex', 'latex_booktabs',
+                                 'textile'),
+                        help='select output format')
+
+        # stats
+        stats_flags.add('-a', '--architecture', action='append',
+                        required=False,
+                        help='limit to specified architectures')
+        stats_flags.add('-d', '--distribution', action='append',
+                        required=False,
+                        help='limit to specified distributions')
+        stats_flags.add('-c', '--component', action='append',
+                        required=False,
+                        help='limit to specified components')
+        stats_flags.add('-n', '--names', action='store_true', default=False,
+                        help='also count distinct package names (reads the '
+                        'name of every package)')
+        stats_flags.add('-s', '--sample', action='store', type=int,
+                        default=0, required=False,
+                        help='estimate the bytes stored in each '
+                        'distribution/component/architecture from the '
+                        'size of N (at most 2500) of its packages')
+        stats_flags.add('-A', '--include-archived', action='store_true',
+                        default=False,
+                        help='include packages moved to the archive by '
+                        '`repoman-cli archive`')
+        stats_flags.add('-f', '--format', action='store',
+                        dest='outputfmt', default='simple',
+                        choices=('json', 'jsonc', 'simple', 'plain', 'grid',
+                                 'fancy_grid', 'pipe', 'orgtbl', 'jira',
+                                 'psql', 'rst', 'mediawiki', 'moinmoin',
+                                 'html', 'latex', 'latex_booktabs',
+                                 'textile'),
+                        help='select output format')
+
+        # changes
+        changes_flags.add('-s', '--since', action='store', type=int,
+                          default=0, required=False,
+                          help='only list changes after the one with this '
+                          'sequence number')
+        changes_flags.add('-f', '--format', action='store',
+                          dest='outputfmt', default='simple',
+                          choices=('json', 'jsonc', 'simple', 'plain', 'grid',
+                                   'fancy_grid', 'pipe', 'orgtbl', 'jira',
+                                   'psql', 'rst', 'mediawiki', 'moinmoin',
+                                   'html', 'latex', 'latex_booktabs',
+                                   'textile'),
+                          help='select output format')
+
+        # archive
+        archive_flags.add('-k', '--keep', action='store', type=int,
+                          required=True,
+                          help='keep the N most recent versions of each '
+                          'package in each distribution, component and '
+                          'architecture; archive the rest')
+        archive_flags.add('-a', '--architecture', action='append',
+                          required=False,
+                          help='limit to specified architectures')
+        archive_flags.add('-d', '--distribution', action='append',
+                          required=False,
+                          help='limit to specified distributions')
+        archive_flags.add('-c', '--component', action='append',
+                          required=False,
+                          help='limit to specified components')
+        archive_flags.add('-p', '--package', action='append',
+                          required=False,
+                          help='limit to specified package names')
+        archive_flags.add('-w', '--wildcard', action='store_true',
+                          default=False,
+                          help='match package names to left of --package '
+                          'flag')
+        archive_confirm = archive_flags.add_mutually_exclusive_group()
+        archive_confirm.add('--confirm', action='store_true', dest='confirm',
+                            required=False, default=True,
+                            help='confirm any mutating actions')
+        archive_confirm.add('-y', '--no-confirm', action='store_false',
+                            dest='confirm', required=False, default=False,
+                            help='do not prompt for confirmation')
+
         # publish to s3
         publish_flags.add('-d', '--distribution', action='append',
                           required=False,
@@ -1,6 +1,7 @@
 
 # stdlib imports
 import logging
+import os
 import time
 
 # pypi imports
@@ -12,11 +13,14 @@ LOG = logging.getLogger(__name__)
 
 class Connection(object):
 
-    def __init__(self, role_arn='', profile_name='', region=None):
+    def __init__(self, role_arn='', profile_name='', region=None,
+                 metadata=None):
         self._log = LOG or logging.getLogger(__name__)
         self.role_arn = role_arn
         self.profile_name = profile_name
         self.region = region
+        # an optional apt_repoman.cache.MetadataCache
+        self.metadata = metadata
         self._s3 = None
         self._sdb = None
         self._sts = None
@@ -68,10 +72,28 @@ class Connection(object):
             self._sns = self.get_client('sns')
         return self._sns
 
+    @property
+    def identity(self):
+        '''A string identifying the credentials and region this connection
+        uses, as far as can be told without calling AWS: the key under
+        which values that depend on them are kept in the metadata cache.'''
+        return '|'.join((
+            self.profile_name or os.environ.get('AWS_PROFILE', ''),
+            os.environ.get('AWS_ACCESS_KEY_ID', ''),
+            self.role_arn or '',
+            self.region or os.environ.get(
+                'AWS_REGION', os.environ.get('AWS_DEFAULT_REGION', ''))))
+
     @property
     def caller_id(self):
         if self._caller_id is None:
-            self._caller_id = self.sts.get_caller_identity()['Arn']
+            key = 'caller_id|%s' % self.identity
+            if self.metadata is not None:
+                self._caller_id = self.metadata.get(key)
+            if self._caller_id is None:
+                self._caller_id = self.sts.get_caller_identity()['Arn']
+                if self.metadata is not None:
+                    self.metadata.set(key, self._caller_id)
         return self._caller_id
 
     def get_session(self):
@@ -0,0 +1,202 @@
+
+# stdlib imports
+import logging
+import time
+
+from collections import defaultdict, namedtuple
+from functools import partial
+from multiprocessing import Pool
+
+# pypi imports
+from botocore.exceptions import ClientError
+from pydpkg import Dpkg
+from pydpkg import Dsc
+
+# internal imports
+from apt_repoman.repo import ChecksumError
+from apt_repoman.repo import KeyExistsError
+from apt_repoman.repo import map_with_clones
+from apt_repoman.repodb import InvalidArchitectureError
+from apt_repoman.repodb import RepodbError
+from apt_repoman.repodb import package_attrs
+from apt_repoman.repodb import pool_dir
+from apt_repoman.repodb import source_attrs
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 8
+
+# The outcome of adding one package file: its architecture (if it could be
+# read), whether it was skipped as a duplicate, and the exception that
+# stopped it from being added, if any.
+Result = namedtuple('Result', ('path', 'arch', 'skipped', 'error'))
+
+
+class IngestError(RepodbError):
+    pass
+
+
+def parse(path, digests=False):
+    """Parse a package file: the CPU-bound part of adding it, run on a
+    pool of processes.
+
+    Package files are hashed as they are uploaded, rather than read twice;
+    set `digests` to have binary packages hashed here and now instead.
+    The source files of a dsc are only checked for presence: their
+    checksums are returned, to be verified during the upload.
+
+    :param path: string
+    :param digests: bool
+    :returns: a tuple of (spec, files to upload, dict of the digests each
+              file must match, error)
+    """
+    try:
+        if path.endswith('.deb'):
+            return package_attrs(Dpkg(path), digests), [path], {}, None
+        elif path.endswith('.dsc'):
+            dsc = Dsc(path)
+            if dsc.missing_files:
+                raise IngestError('missing source files: %s' % ', '.join(
+                    dsc.missing_files))
+            checksums = defaultdict(dict)
+            for hashtype, files in dsc.checksums.items():
+                for file_name, digest in files.items():
+                    checksums[file_name][hashtype] = digest
+            return (source_attrs(dsc, validate=False), dsc.source_files,
+                    dict(checksums), None)
+        return None, [], {}, IngestError(
+            'File "%s" is neither a deb nor a dsc files' % path)
+    except Exception as ex:
+        return None, [], {}, IngestError(
+            'Could not read %s: %s' % (path, ex))
+
+
+class Ingester(object):
+    """Add package files to the repository in bulk.
+
+    The files are parsed and hashed on a pool of processes and uploaded to
+    S3 on a pool of threads, each with a Repo of its own; then the simpledb
+    items of every file that made it that far are written under a single
+    repository generation, by Repodb.add_items(). A file that fails at any
+    stage is reported and left out of the stages that follow, without
+    holding up the others.
+    """
+
+    def __init__(self, repodb, repo, processes=None,
+                 threads=DEFAULT_THREADS):
+        self.repodb = repodb
+        self.repo = repo
+        self.processes = processes or None
+        self.threads = threads
+        self._log = LOG or logging.getLogger(__name__)
+
+    def run(self, paths, dists, comps, overwrite=False, auto_purge=0,
+            skip_duplicates=False):
+        """Add package files to every one of the specified distributions
+        and components.
+
+        :param paths: list of strings
+        :param dists: list of strings
+        :param comps: list of strings
+        :param overwrite: bool
+        :param auto_purge: int
+        :param skip_duplicates: bool, skip binary packages whose exact file
+                                is already in every target dist and comp
+        :returns: a Result for each path, in order
+        :rtype: list
+        """
+        now = time.time()
+        # duplicates are found by digest, and the hash pool layout keys
+        # files by it, so both need hashing up front
+        hashed = self.repodb.pool_layout == 'hash'
+        parsed = self._parse(paths, digests=skip_duplicates or hashed)
+        specs = [x[0] for x in parsed]
+        errors = [x[3] for x in parsed]
+        if hashed:
+            for idx, spec in enumerate(specs):
+                if errors[idx] is None:
+                    spec['pooldir'] = pool_dir(spec)
+                    if 'filename' in spec:
+                        # make sure the file still matches its address
+                        parsed[idx][2][paths[idx]] = dict(
+                            (x, spec[x]) for x in ('md5', 'sha1', 'sha256'))
+        skipped = [False] * len(paths)
+        for idx, spec in enumerate(specs):
+            if errors[idx] is None and spec['architecture'] != 'source':
+                try:
+                    self.repodb.check_valid_archs([spec['architecture']])
+                except InvalidArchitectureError as ex:
+                    errors[idx] = ex
+        if skip_duplicates:
+            present = self._present(
+                [spec['sha256'] for idx, spec in enumerate(specs)
+                 if errors[idx] is None and 'sha256' in spec])
+            for idx, spec in enumerate(specs):
+                if (errors[idx] is None and 'sha256' in spec and
+                        all((dist, comp) in present[spec['sha256']]
+                            for dist in dists for comp in comps)):
+                    skipped[idx] = True
+        todo = [idx for idx in range(len(paths))
+                if errors[idx] is None and not skipped[idx]]
+        for idx, (digests, error) in zip(todo, self._upload(
+                [(specs[idx]['name'], parsed[idx][1], parsed[idx][2],
+                  specs[idx].get('pooldir')) for idx in todo],
+                dists, overwrite)):
+            errors[idx] = error
+            if error is None and 'filename' in specs[idx]:
+                specs[idx].update(digests[paths[idx]])
+        todo = [idx for idx in todo if errors[idx] is None]
+        if todo:
+            for idx, error in zip(todo, self.repodb.add_items(
+                    [specs[idx] for idx in todo], dists, comps,
+                    overwrite=overwrite, auto_purge=auto_purge)):
+                errors[idx] = error
+        self._log.info('Processed %d package files in %.1f seconds',
+                       len(paths), time.time() - now)
+        return [Result(path, specs[idx] and specs[idx]['architecture'],
+                       skipped[idx], errors[idx])
+                for idx, path in enumerate(paths)]
+
+    def _parse(self, paths, digests=False):
+        if len(paths) < 2:
+            return [parse(x, digests) for x in paths]
+        pool = Pool(self.processes)
+        try:
+            return pool.map(partial(parse, digests=digests), paths,
+                            chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _present(self, sha256s):
+        """Return the (dist, comp) pairs each package file is already in"""
+        present = defaultdict(set)
+        if sha256s:
+            for item in self.repodb.find_files(sha256s=sha256s):
+                present[item['sha256']].add(
+                    (item['distribution'], item['component']))
+        return present
+
+    def _upload(self, packages, dists, overwrite):
+        """Upload the files of (name, files, checksums, pooldir) tuples to S3
+        concurrently; return a tuple of (the digests of its files, None or
+        the error that stopped it from being uploaded) for each."""
+        if not packages:
+            return []
+        # every file of the batch is uploaded through the same
+        # TransferManager, so large files are uploaded in parallel parts
+        # alongside the others rather than one after another
+        with self.repo.transfer_manager():
+            return self._upload_packages(packages, dists, overwrite)
+
+    def _upload_packages(self, packages, dists, overwrite):
+        def upload(repo, package):
+            name, files, checksums, pooldir = package
+            try:
+                return repo.add_files(name, files, dists, overwrite,
+                                      checksums, pooldir), None
+            except (KeyExistsError, ChecksumError, ClientError,
+                    EnvironmentError) as ex:
+                return None, ex
+        return list(map_with_clones(self.repo, upload, packages,
+                                    self.threads))
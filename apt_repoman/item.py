@@ -0,0 +1,113 @@
+
+# stdlib imports
+from collections.abc import MutableMapping
+
+# pypi imports
+from six.moves import intern
+
+# The attributes every package item has, in the order they are listed in.
+# They live in slots rather than in a per-item dict, and since the same
+# handful of names, distributions, components and architectures recur
+# across thousands of items, their values are interned.
+SLOTS = ('name', 'distribution', 'component', 'architecture', 'version')
+INTERNED = frozenset(('name', 'distribution', 'component', 'architecture'))
+_SLOTS = frozenset(SLOTS)
+
+
+def _intern(value):
+    # intern() only takes str
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
+class PackageItem(MutableMapping):
+    """A package item read from simpledb, behaving like the dict of its
+    attributes that it replaces, but taking a fraction of the memory:
+    the common attributes are kept in slots, the rest (checksums, control
+    text fragments, extracted fields...) in a dict whose keys are
+    interned, so a full-domain scan holds one copy of each attribute name
+    instead of one per item. The control text stays in its fragments
+    until Repodb._unpack_control_text() joins them.
+
+    Attributes that are not set read as None through the slots (and raise
+    KeyError through the mapping interface, like a dict would), so
+    assigning None to a slotted attribute removes it.
+    """
+
+    __slots__ = SLOTS + ('_attrs',)
+
+    def __init__(self, *args, **kwargs):
+        for slot in SLOTS:
+            setattr(self, slot, None)
+        self._attrs = {}
+        self.update(*args, **kwargs)
+
+    @property
+    def leaf(self):
+        """The (name, dist, comp, arch) tuple of the leaf the item is in"""
+        return (self.name, self.distribution, self.component,
+                self.architecture)
+
+    def copy(self, **overrides):
+        """Return a copy of this item with some attributes replaced. The
+        copy shares its attribute values with the original, which is safe
+        as long as list values are replaced rather than modified in place,
+        as they are everywhere in repoman.
+
+        :param overrides: attributes to set on the copy
+        :rtype: PackageItem
+        """
+        new = type(self).__new__(type(self))
+        for slot in SLOTS:
+            setattr(new, slot, getattr(self, slot))
+        new._attrs = dict(self._attrs)
+        for key, value in overrides.items():
+            new[key] = value
+        return new
+
+    def __getitem__(self, key):
+        if key in _SLOTS:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self._attrs[key]
+
+    def __setitem__(self, key, value):
+        if key in _SLOTS:
+            if key in INTERNED:
+                value = _intern(value)
+            setattr(self, key, value)
+        else:
+            self._attrs[_intern(key)] = value
+
+    def __delitem__(self, key):
+        if key in _SLOTS:
+            if getattr(self, key) is None:
+                raise KeyError(key)
+            setattr(self, key, None)
+        else:
+            del self._attrs[key]
+
+    def __contains__(self, key):
+        if key in _SLOTS:
+            return getattr(self, key) is not None
+        return key in self._attrs
+
+    def __iter__(self):
+        for slot in SLOTS:
+            if getattr(self, slot) is not None:
+                yield slot
+        for key in self._attrs:
+            yield key
+
+    def __len__(self):
+        return len(self._attrs) + sum(
+            1 for x in SLOTS if getattr(self, x) is not None)
+
+    def __repr__(self):
+        return 'PackageItem(%r)' % dict(self)
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
@@ -0,0 +1,236 @@
+
+# stdlib imports
+import logging
+import time
+
+from collections import OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
+
+# pypi imports
+from botocore.exceptions import ClientError
+
+# internal imports
+from apt_repoman.repodb import BATCH_SIZE
+from apt_repoman.repodb import RepodbError
+from apt_repoman.repodb import TIERS
+from apt_repoman.repodb import _attribute_values
+from apt_repoman.repodb import _error_code
+
+LOG = logging.getLogger(__name__)
+
+# package item names are sha256 hex digests, so their first character
+# splits a domain into sixteen disjoint, evenly sized partitions that
+# between them cover every package item and nothing else
+PARTITIONS = '0123456789abcdef'
+DEFAULT_THREADS = len(PARTITIONS)
+
+# A migration is a function of a Repodb and a package item dict that
+# returns None if the item is up to date, or a tuple of (attributes to
+# write, names of attributes to delete). Migrations are applied in
+# version order, and must only ever derive attributes from the rest of
+# the item, so that running them twice is harmless.
+Migration = namedtuple('Migration', ('version', 'name', 'func'))
+
+
+def repack_control_text(repodb, item):
+    """Split control text on utf-8 byte boundaries, in the configured
+    control format, instead of every 256 characters."""
+    return repodb._repack_control_text(item)
+
+
+def encode_versions(repodb, item):
+    """Add the versionkey attribute used to sort items by version."""
+    return repodb._encode_item_version(item)
+
+
+def extract_fields(repodb, item):
+    """Index the control fields configured with `repo add-field`."""
+    return repodb._extract_item_fields(item)
+
+
+def index_names(repodb, item):
+    """Add every package name to the index used by wildcard queries."""
+    return repodb._index_item_name(item)
+
+
+MIGRATIONS = OrderedDict(
+    (x.name, x) for x in sorted([
+        Migration(1, 'repack-control-text', repack_control_text),
+        Migration(2, 'encode-versions', encode_versions),
+        Migration(3, 'extract-fields', extract_fields),
+        Migration(4, 'index-names', index_names),
+    ]))
+
+
+class MigrationError(RepodbError):
+    pass
+
+
+class Migrator(object):
+    """Apply migrations to every package item in a Repodb's domain.
+
+    The domain is scanned one partition at a time on a pool of threads.
+    Changed attributes are written with a put that is conditional on the
+    item not having been rewritten (or deleted) since it was read, so the
+    repository stays writable while a migration runs: anything added or
+    overwritten in the meantime was written by the current code in the
+    first place. Completed partitions are checkpointed in the meta item,
+    so an interrupted migration picks up where it left off.
+    """
+
+    def __init__(self, repodb, threads=DEFAULT_THREADS):
+        self.repodb = repodb
+        self.threads = threads
+        self._log = LOG or logging.getLogger(__name__)
+
+    @property
+    def applied(self):
+        return self.repodb.applied_migrations
+
+    @property
+    def pending(self):
+        """Names of the migrations not yet applied, in version order"""
+        return [x for x in MIGRATIONS if x not in self.applied]
+
+    @property
+    def partitions(self):
+        """Every partition of every domain holding package items, archived
+        or not, in the form <domain>/<first character of item name>"""
+        return ['%s/%s' % (domain, prefix)
+                for domain in self.repodb._domains_for(tiers=TIERS)
+                for prefix in PARTITIONS]
+
+    def checkpoints(self, name):
+        """Return the partitions that the named migration has already
+        been applied to."""
+        prefix = name + ':'
+        values = self.repodb.meta.get('migration_checkpoints', [])
+        return sorted(x[len(prefix):] for x in values
+                      if x.startswith(prefix))
+
+    def _checkpoint(self, name, partition):
+        value = '%s:%s' % (name, partition)
+        self.repodb._put_attributes(
+            'meta', {'migration_checkpoints': value}, replace=False)
+        self.repodb.meta.setdefault('migration_checkpoints', []).append(value)
+
+    def _clear_checkpoints(self, name):
+        values = ['%s:%s' % (name, x) for x in self.checkpoints(name)]
+        if not values:
+            return
+        self.repodb.sdb.delete_attributes(
+            DomainName=self.repodb.domain_name,
+            ItemName='meta',
+            Attributes=[{'Name': 'migration_checkpoints', 'Value': x}
+                        for x in values])
+        self.repodb.meta['migration_checkpoints'] = [
+            x for x in self.repodb.meta.get('migration_checkpoints', [])
+            if x not in values]
+
+    def run(self, name):
+        """Apply the named migration to every package item in the domain,
+        then record it in the repo metadata as having been applied.
+
+        :param name: string, a key of MIGRATIONS
+        :returns: dict of counts of items scanned, rewritten and skipped
+        :rtype: dict
+        :raises: MigrationError
+        """
+        if name not in MIGRATIONS:
+            raise MigrationError('Unknown migration: %s' % name)
+        migration = MIGRATIONS[name]
+        done = self.checkpoints(name)
+        if done:
+            self._log.info('Resuming migration %s: partitions %s are done',
+                           name, ','.join(done))
+        partitions = [x for x in self.partitions if x not in done]
+        totals = {'scanned': 0, 'rewritten': 0, 'skipped': 0}
+        now = time.time()
+        # the client is thread-safe but is created lazily; do that (and
+        # read the repo configuration the migrations depend on) up front
+        self.repodb.sdb
+        self.repodb.meta
+        pool = ThreadPool(max(1, min(self.threads, len(partitions) or 1)))
+        try:
+            for partition, counts in pool.imap_unordered(
+                    lambda x: (x, self._migrate_partition(migration, x)),
+                    partitions):
+                self._checkpoint(name, partition)
+                for k, v in counts.items():
+                    totals[k] += v
+                self._log.info(
+                    'Migration %s: partition %s done (%d scanned, '
+                    '%d rewritten, %d skipped)', name, partition,
+                    counts['scanned'], counts['rewritten'],
+                    counts['skipped'])
+        finally:
+            pool.close()
+            pool.join()
+        if totals['rewritten']:
+            # rewritten items are not re-stamped, so have caches start over
+            self.repodb._bump_generation(purged=True)
+        if name not in self.applied:
+            self.repodb._put_attributes(
+                'meta', {'migrations': name}, replace=False)
+            self.repodb.meta.setdefault('migrations', []).append(name)
+        self._clear_checkpoints(name)
+        self._log.info('Migration %s done in %.1f seconds',
+                       name, time.time() - now)
+        return totals
+
+    def _migrate_partition(self, migration, partition):
+        repodb = self.repodb
+        domain, prefix = partition.rsplit('/', 1)
+        query = "select * from `{0}` where itemName() like '{1}%'".format(
+            domain, prefix)
+        counts = {'scanned': 0, 'rewritten': 0, 'skipped': 0}
+        deletes = []
+        for item in repodb._select(query, consistent_read=True):
+            counts['scanned'] += 1
+            if 'name' not in item:
+                continue
+            changes = migration.func(repodb, item)
+            if changes is None:
+                continue
+            attrs, stale = changes
+            key = repodb._compute_keyname_from_item(item)
+            if attrs and not self._put_changes(domain, key, item, attrs):
+                counts['skipped'] += 1
+                continue
+            if stale:
+                deletes.append({'Name': key, 'Attributes': _attribute_values(
+                    dict((x, item[x]) for x in stale))})
+                if len(deletes) == BATCH_SIZE:
+                    self._delete_batch(domain, deletes)
+                    deletes = []
+            counts['rewritten'] += 1
+        if deletes:
+            self._delete_batch(domain, deletes)
+        return counts
+
+    def _put_changes(self, domain, key, item, attrs):
+        """Write the attributes computed from `item`, unless the item has
+        been rewritten or deleted since: in the former case its writer
+        already took care of the migration, in the latter we must not
+        resurrect it as a stub."""
+        if 'generation' in item:
+            expected = {'Name': 'generation', 'Value': item['generation']}
+        else:
+            expected = {'Name': 'name', 'Value': item['name']}
+        try:
+            self.repodb._put_attributes(key, attrs, expected=expected,
+                                        domain=domain)
+        except ClientError as ex:
+            if _error_code(ex) not in ('ConditionalCheckFailed',
+                                       'AttributeDoesNotExist'):
+                raise
+            self._log.debug('item %s changed during migration; skipping',
+                            key)
+            return False
+        return True
+
+    def _delete_batch(self, domain, items):
+        # deleting attributes cannot resurrect a deleted item, so there is
+        # no need for the (unbatchable) conditions here
+        self.repodb.sdb.batch_delete_attributes(
+            DomainName=domain, Items=items)
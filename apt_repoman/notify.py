@@ -0,0 +1,237 @@
+
+# stdlib imports
+import json
+import logging
+import os
+import threading
+
+from six.moves import queue
+
+# pypi imports
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
+
+LOG = logging.getLogger(__name__)
+
+# SNS's limit on the number of messages in a single PublishBatch call
+BATCH_SIZE = 10
+# SNS's limit on the size of a message, and of a whole batch, less room
+# for the envelope
+MAX_MESSAGE_BYTES = 250 * 1024
+# how long to wait for queued notifications to go out on close()
+DEFAULT_TIMEOUT = 30
+# 'batch' publishes every notification, 'summary' one message per command
+NOTIFY_MODES = ('batch', 'summary')
+SUBJECT = 'Repoman notification'
+# the error codes SNS returns for a topic that does not exist
+NOT_FOUND = ('NotFound', 'NotFoundException')
+
+
+def _message_bytes(notification):
+    """The size of a notification as published: SNS limits are in bytes"""
+    return len(json.dumps(notification).encode('utf-8'))
+
+
+class Dispatcher(object):
+    """Publish notifications to an SNS topic from a background thread, so
+    that mutations do not wait on SNS.
+
+    Notifications are queued by send() and published with PublishBatch,
+    BATCH_SIZE at a time; in 'summary' mode they are instead collected,
+    and published as a single message (or as few as fit) on close().
+    Whatever cannot be published, because SNS is unavailable or close()
+    ran out of time, is appended to a local spool file, and published
+    the next time a Dispatcher for the same spool file starts.
+    """
+
+    def __init__(self, sns, topic_arn, spool_file, mode='batch',
+                 timeout=DEFAULT_TIMEOUT, on_not_found=None):
+        self.sns = sns
+        self.topic_arn = topic_arn
+        # called when the topic turns out not to exist (any more)
+        self.on_not_found = on_not_found
+        self.spool_file = os.path.expanduser(spool_file)
+        self.mode = mode
+        self.timeout = timeout
+        self._log = LOG or logging.getLogger(__name__)
+        self._queue = queue.Queue()
+        self._summary = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        # taken off the queue but not yet published, and whether close()
+        # gave up waiting on them
+        self._inflight = []
+        self._abandoned = False
+
+    def send(self, notifications):
+        """Queue notifications for publishing
+
+        :param notifications: list of dicts
+        """
+        if self._closed:
+            self._spool(notifications)
+            return
+        if self.mode == 'summary':
+            self._summary.extend(notifications)
+            return
+        self._start()
+        for notification in notifications:
+            self._queue.put(notification)
+
+    def close(self, timeout=None):
+        """Publish everything queued, waiting at most `timeout` seconds
+        (by default, the Dispatcher's own), and spool what is left.
+
+        :returns: the number of notifications spooled
+        :rtype: int
+        """
+        if self._closed:
+            return 0
+        self._closed = True
+        timeout = self.timeout if timeout is None else timeout
+        if self._summary:
+            self._start()
+            for message in self._summaries(self._summary):
+                self._queue.put(message)
+            self._summary = []
+        if self._thread is None:
+            return 0
+        self._queue.put(None)
+        self._thread.join(timeout)
+        left = []
+        if self._thread.is_alive():
+            # SNS is hanging: whatever the thread is publishing may never
+            # get there, so spool it too, at the risk of a duplicate
+            with self._lock:
+                left.extend(self._inflight)
+                self._inflight = []
+                self._abandoned = True
+        while True:
+            try:
+                notification = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if notification is not None:
+                left.append(notification)
+        if left:
+            self._log.warning('Gave up waiting for %d notifications to be '
+                              'published after %s seconds', len(left),
+                              timeout)
+            self._spool(left)
+        return len(left)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            # whatever an earlier run could not publish goes out first
+            for notification in self._unspool():
+                self._queue.put(notification)
+            self._thread = threading.Thread(
+                target=self._run, name='repoman-notifications')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        pending = None
+        while True:
+            batch = [pending if pending is not None else self._queue.get()]
+            pending = None
+            size = _message_bytes(batch[0])
+            # a batch is also limited to the size of a single message
+            while batch[-1] is not None and len(batch) < BATCH_SIZE:
+                try:
+                    notification = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if notification is not None:
+                    size += _message_bytes(notification)
+                    if size > MAX_MESSAGE_BYTES:
+                        pending = notification
+                        break
+                batch.append(notification)
+            done = batch[-1] is None
+            batch = [x for x in batch if x is not None]
+            if batch:
+                with self._lock:
+                    self._inflight = batch + [
+                        x for x in [pending] if x is not None]
+                self._publish(batch)
+                with self._lock:
+                    if self._abandoned:
+                        return
+                    self._inflight = [x for x in [pending] if x is not None]
+            if done:
+                return
+
+    def _publish(self, batch):
+        try:
+            response = self.sns.publish_batch(
+                TopicArn=self.topic_arn,
+                PublishBatchRequestEntries=[
+                    {'Id': str(idx), 'Message': json.dumps(x),
+                     'Subject': SUBJECT} for idx, x in enumerate(batch)])
+        except (ClientError, BotoCoreError) as ex:
+            self._log.error('Could not publish %d notifications: %s',
+                            len(batch), ex)
+            if (self.on_not_found is not None and
+                    isinstance(ex, ClientError) and
+                    ex.response.get('Error', {}).get('Code') in NOT_FOUND):
+                self.on_not_found()
+            self._respool(batch)
+            return
+        failed = response.get('Failed', [])
+        if failed:
+            self._log.error('SNS rejected %d notifications: %s',
+                            len(failed), ', '.join(sorted(set(
+                                x.get('Code', '?') for x in failed))))
+            self._respool([batch[int(x['Id'])] for x in failed])
+
+    def _respool(self, notifications):
+        # unless close() gave up on the batch, and spooled it already
+        with self._lock:
+            abandoned = self._abandoned
+        if not abandoned:
+            self._spool(notifications)
+
+    def _summaries(self, notifications):
+        """Pack notifications into as few summary messages as fit"""
+        messages = []
+        chunk = []
+        size = 0
+        for notification in notifications:
+            length = _message_bytes(notification) + 2
+            if chunk and size + length > MAX_MESSAGE_BYTES:
+                messages.append(chunk)
+                chunk, size = [], 0
+            chunk.append(notification)
+            size += length
+        if chunk:
+            messages.append(chunk)
+        return [{'action': 'summary', 'count': len(x), 'notifications': x}
+                for x in messages]
+
+    def _spool(self, notifications):
+        with self._lock:
+            directory = os.path.dirname(self.spool_file)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.spool_file, 'a') as fp:
+                for notification in notifications:
+                    fp.write(json.dumps(notification) + '\n')
+        self._log.warning('Spooled %d notifications to %s',
+                          len(notifications), self.spool_file)
+
+    def _unspool(self):
+        try:
+            with open(self.spool_file) as fp:
+                lines = fp.readlines()
+            os.remove(self.spool_file)
+        except EnvironmentError:
+            return []
+        notifications = [json.loads(x) for x in lines if x.strip()]
+        if notifications:
+            self._log.info('Publishing %d notifications spooled in %s',
+                           len(notifications), self.spool_file)
+        return notifications
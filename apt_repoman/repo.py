@@ -1,21 +1,86 @@
 
 # stdlib imports
+import hashlib
 import logging
 import mimetypes
 import os
 
+from base64 import b64encode
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
 # pypi imports
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from s3transfer.manager import TransferManager
+from six import text_type
+from six.moves import queue
 
 # internal imports
 from apt_repoman.connection import Connection
 
 DEFAULT_ACL = 'bucket-owner-full-control'
+# the digests recorded for every package file
+DIGESTS = ('md5', 'sha1', 'sha256')
+# the errors S3 answers a write conditional on If-None-Match with, when
+# the key exists (or is being written by somebody else right now)
+CONFLICT_ERRORS = ('PreconditionFailed', 'ConditionalRequestConflict', '412')
 
 
 LOG = logging.getLogger(__name__)
 
 
+def hash_pool_dir(name, digest):
+    """Return the content-addressed directory in the pool that the files
+    of a package live in under the 'hash' pool layout, which does not
+    depend on the distribution.
+
+    :param name: string, the package name
+    :param digest: string, the sha256 of the package's content
+    :rtype: string
+    """
+    return '/'.join(('pool', 'by-hash', name[0], name, digest))
+
+
+def map_with_clones(repo, func, args, threads, ordered=True):
+    """Map `func(repo, arg)` over `args` on a pool of up to `threads`
+    threads. boto3 resources are not thread-safe, so each call is handed
+    a clone of `repo` that no other thread is using at the time (or
+    `repo` itself, when there is only one thread). Call this from the
+    thread that owns `repo`.
+
+    :param repo: Repo
+    :param func: callable
+    :param args: list
+    :param threads: int
+    :param ordered: bool, yield the results in the order of `args`
+                    rather than as they complete
+    :rtype: Generator
+    """
+    args = list(args)
+    if not args:
+        return
+    count = max(1, min(threads, len(args)))
+    workers = queue.Queue()
+    for _ in range(count):
+        workers.put(repo.clone() if count > 1 else repo)
+
+    def call(arg):
+        worker = workers.get()
+        try:
+            return func(worker, arg)
+        finally:
+            workers.put(worker)
+    pool = ThreadPool(count)
+    try:
+        for result in (pool.imap if ordered else pool.imap_unordered)(
+                call, args):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
 class RepoError(Exception):
     pass
 
@@ -36,15 +101,77 @@ class FileNotFoundError(RepoError):
     pass
 
 
+class ChecksumError(RepoError):
+    pass
+
+
+def _error_code(ex):
+    return ex.response.get('Error', {}).get('Code')
+
+
+class HashingReader(object):
+    """A read-only file object that computes the digests and size of
+    everything read through it, so that a file can be hashed while it is
+    uploaded instead of being read twice.
+
+    If expected digests are given, reading to the end of the file raises
+    ChecksumError if any of them do not match, which makes the upload
+    fail (and a multipart upload be aborted) rather than complete.
+
+    It deliberately has no seek(), so that boto3 reads it from start to
+    end exactly once.
+    """
+
+    def __init__(self, fileobj, expected={}):
+        self._fileobj = fileobj
+        self.name = getattr(fileobj, 'name', '<stream>')
+        self.expected = expected
+        self.size = 0
+        self._hashes = dict((x, hashlib.new(x))
+                            for x in set(DIGESTS).union(expected))
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        if data:
+            for hasher in self._hashes.values():
+                hasher.update(data)
+            self.size += len(data)
+        elif size != 0:
+            self._verify()
+        return data
+
+    def _verify(self):
+        bad = dict((x, self._hashes[x].hexdigest())
+                   for x, digest in self.expected.items()
+                   if self._hashes[x].hexdigest() != digest)
+        if bad:
+            raise ChecksumError('%s does not match its checksums: %s' % (
+                self.name, ', '.join('%s is %s, not %s' % (
+                    x, bad[x], self.expected[x]) for x in sorted(bad))))
+
+    @property
+    def digests(self):
+        """The md5, sha1 and sha256 digests and size of what has been
+        read, as the package item attributes of the same names"""
+        ret = dict((x, self._hashes[x].hexdigest()) for x in DIGESTS)
+        ret['size'] = str(self.size)
+        return ret
+
+
 class Repo(object):
     """Object encapsulating actions on the S3 arm of a repoman repository."""
-    def __init__(self, bucket_name, role_arn=None, connection=None):
+    def __init__(self, bucket_name, role_arn=None, connection=None,
+                 transfer_config=None):
         self.bucket_name = bucket_name
         self.role_arn = role_arn
+        self.transfer_config = transfer_config or TransferConfig()
         self._log = LOG or logging.getLogger(__name__)
         self._connection = connection or None
         self._s3 = None
         self._bucket = None
+        self._transfers = None
+        # (bucket, key) tuples being uploaded with overwrite=False
+        self._exclusive = set()
 
     @property
     def connection(self):
@@ -56,9 +183,22 @@ class Repo(object):
     @property
     def s3(self):
         if not self._s3:
-            self._s3 = self.connection.s3
+            self._use_resource(self.connection.s3)
         return self._s3
 
+    def _use_resource(self, resource):
+        # s3transfer will not pass IfNoneMatch through to the requests
+        # that make up an upload, so add it to them here
+        self._s3 = resource
+        events = resource.meta.client.meta.events
+        for operation in ('PutObject', 'CompleteMultipartUpload'):
+            events.register('provide-client-params.s3.%s' % operation,
+                            self._add_write_condition)
+
+    def _add_write_condition(self, params, **kwargs):
+        if (params.get('Bucket'), params.get('Key')) in self._exclusive:
+            params['IfNoneMatch'] = '*'
+
     @property
     def bucket(self):
         if not self._bucket:
@@ -156,47 +296,149 @@ class Repo(object):
             return False
         return True
 
-    def _set_key_from_file(self, key_name, file_name, acl=DEFAULT_ACL,
-                           overwrite=False):
-        if not os.path.isfile(file_name):
-            raise FileNotFoundError('"%s" is not a file', file_name)
-        k = self._get_key(key_name)
-        if self._key_exists(k) and not overwrite:
-            raise KeyExistsError(
-                's3://%s/%s" already exists' % (k.bucket_name, k.key))
-        extra_args = {'ACL': acl}
+    @contextmanager
+    def transfer_manager(self):
+        """Share one s3transfer TransferManager among the uploads made
+        within this context, by this Repo and by the clones made of it
+        within it: the parts of all the files being uploaded then go out
+        together, on a single pool of transfer_config.max_concurrency
+        threads, instead of one file after another.
+
+        :returns: a context manager yielding a TransferManager
+        """
+        if self._transfers is not None:
+            yield self._transfers
+            return
+        self._transfers = TransferManager(self.s3.meta.client,
+                                          self.transfer_config)
+        try:
+            yield self._transfers
+        finally:
+            manager, self._transfers = self._transfers, None
+            manager.shutdown()
+
+    def _upload_args(self, file_name, acl):
+        extra_args = {'ACL': acl, 'ChecksumAlgorithm': 'SHA256'}
         content_type, encoding = mimetypes.guess_type(file_name)
         if content_type:
             extra_args['ContentType'] = content_type
         if encoding:
             extra_args['ContentEncoding'] = encoding
-        self._log.debug('uploading file "%s" with args %s to s3://%s/%s',
-                        file_name, extra_args, k.bucket_name, k.key)
-        result = k.upload_file(Filename=file_name, ExtraArgs=extra_args)
-        self._log.debug('uploaded file "%s" to s3://%s/%s: %s',
-                        file_name, k.bucket_name, k.key, result)
-        k.reload()
-        return k
+        return extra_args
+
+    @staticmethod
+    def _wait(future):
+        try:
+            future.result()
+        except Exception as ex:
+            return ex
+        return None
+
+    def _upload_files(self, uploads, acl=DEFAULT_ACL, overwrite=False,
+                      skip_existing=False):
+        """Upload files at once through the shared TransferManager (or one
+        of their own), hashing them on the way. Unless overwrite is set,
+        each write is conditional on the key not existing yet, so that
+        checking and writing take a single round trip; S3 also checks the
+        uploads against a SHA256 checksum computed by botocore.
+
+        All the uploads are waited for, whether or not some fail; the
+        error of the first one that did is raised.
+
+        :param uploads: list of (key name, file name, dict of the digests
+                        the file must match) tuples
+        :param skip_existing: bool, quietly leave keys that already exist
+                              alone, rather than raise KeyExistsError
+        :returns: list of dicts of each file's digests and size, or None
+                  for the files that were skipped
+        :raises: KeyExistsError, ChecksumError
+        """
+        for _, file_name, _ in uploads:
+            if not os.path.isfile(file_name):
+                raise FileNotFoundError('"%s" is not a file' % file_name)
+        keys = [(self.bucket_name, x[0]) for x in uploads]
+        if not overwrite:
+            self._exclusive.update(keys)
+        fileobjs, readers, futures, errors = [], [], [], []
+        try:
+            with self.transfer_manager() as manager:
+                try:
+                    for key_name, file_name, expected in uploads:
+                        extra_args = self._upload_args(file_name, acl)
+                        self._log.debug(
+                            'uploading file "%s" with args %s to '
+                            's3://%s/%s', file_name, extra_args,
+                            self.bucket_name, key_name)
+                        fileobjs.append(open(file_name, 'rb'))
+                        readers.append(HashingReader(fileobjs[-1], expected))
+                        futures.append(manager.upload(
+                            readers[-1], self.bucket_name, key_name,
+                            extra_args=extra_args))
+                finally:
+                    errors = [self._wait(x) for x in futures]
+        finally:
+            for fileobj in fileobjs:
+                fileobj.close()
+            self._exclusive.difference_update(keys)
+        digests = [x.digests for x in readers]
+        for idx, (key_name, file_name, _) in enumerate(uploads):
+            error = errors[idx]
+            if error is None:
+                self._log.debug('uploaded file "%s" to s3://%s/%s',
+                                file_name, self.bucket_name, key_name)
+            elif (not overwrite and isinstance(error, ClientError) and
+                    _error_code(error) in CONFLICT_ERRORS):
+                if not skip_existing:
+                    raise KeyExistsError(
+                        's3://%s/%s" already exists' % (
+                            self.bucket_name, key_name))
+                self._log.info('s3://%s/%s is already in the pool',
+                               self.bucket_name, key_name)
+                digests[idx] = None
+            else:
+                raise error
+        return digests
+
+    def _set_key_from_file(self, key_name, file_name, acl=DEFAULT_ACL,
+                           overwrite=False, expected={}):
+        """Upload a file, hashing it on the way.
+
+        :param expected: dict of digests the file must match
+        :returns: dict of the file's digests and size
+        :raises: KeyExistsError, ChecksumError
+        """
+        return self._upload_files([(key_name, file_name, expected)],
+                                  acl=acl, overwrite=overwrite)[0]
 
     def copy_key(self, old_path, new_path, overwrite=False):
+        """Copy a key on the S3 side, in a single request: unless
+        overwrite is set, the copy is conditional on the new key not
+        existing yet.
+
+        :returns: the CopyObject response
+        :raises: KeyNotFoundError, KeyExistsError
+        """
         old_key = self._get_key(old_path)
         new_key = self._get_key(new_path)
-        if not self._key_exists(old_key):
-            raise KeyNotFoundError(
-                's3://%s/%s does not exist' % (
-                    old_key.bucket_name, old_key.key))
-        if not overwrite:
-            if self._key_exists(new_key):
-                raise KeyExistsError(
-                    's3://%s/%s exists and overwrite=False' % (
-                        new_key.bucket_name, new_key.key))
         self._log.debug(
             'copying s3://%s/%s to s3://%s/%s', old_key.bucket_name,
             old_key.key, new_key.bucket_name, new_key.key)
-        new_key.copy(CopySource={'Bucket': old_key.bucket_name,
-                                 'Key': old_key.key})
-        new_key.reload()
-        return new_key
+        kwargs = {'CopySource': {'Bucket': old_key.bucket_name,
+                                 'Key': old_key.key}}
+        if not overwrite:
+            kwargs['IfNoneMatch'] = '*'
+        try:
+            return new_key.copy_from(**kwargs)
+        except ClientError as ex:
+            if _error_code(ex) in ('NoSuchKey', '404'):
+                raise KeyNotFoundError(
+                    's3://%s/%s does not exist' % (
+                        old_key.bucket_name, old_key.key))
+            if overwrite or _error_code(ex) not in CONFLICT_ERRORS:
+                raise
+            raise KeyExistsError(
+                's3://%s/%s exists and overwrite=False' % (
+                    new_key.bucket_name, new_key.key))
 
     def _get_pkg_pathname(self, pkg, filename, dist):
         """Return the relative S3 path name for our package key.
@@ -214,30 +456,111 @@ class Repo(object):
             'setting contents of S3 key %s to "%s"', key_url, contents)
         self._log.info('setting contents of %s', key_url)
         k = self._get_key(key_name)
-        if not overwrite and self._key_exists(k):
+        if isinstance(contents, text_type):
+            contents = contents.encode('utf-8')
+        kwargs = {'Body': contents,
+                  'ContentMD5': b64encode(
+                      hashlib.md5(contents).digest()).decode('ascii')}
+        if not overwrite:
+            kwargs['IfNoneMatch'] = '*'
+        try:
+            result = k.put(**kwargs)
+        except ClientError as ex:
+            if overwrite or _error_code(ex) not in CONFLICT_ERRORS:
+                raise
             raise KeyExistsError('%s" already exists' % key_url)
-        result = k.put(Body=contents)
         self._log.debug('set contents of %s: %s', key_url,
                         result['ResponseMetadata']['HTTPStatusCode'])
-        k.reload()
-        return k
+        return result
 
-    def add_package(self, pkg, dists=[], overwrite=False):
-        pkg_name = pkg.get_header('package')
-        pkg_file = os.path.basename(pkg.filename)
-        for dist in dists:
-            key_name = self._get_pkg_pathname(pkg_name, pkg_file, dist)
-            try:
+    def clone(self):
+        """Return a Repo for the same bucket with a boto3 resource of its
+        own, for use on another thread: boto3 resources are not
+        thread-safe. Call this from the thread that owns this Repo.
+
+        Within transfer_manager(), the clone uploads through the same
+        TransferManager, and so through this Repo's client.
+
+        :rtype: Repo
+        """
+        repo = Repo(self.bucket_name, self.role_arn, self.connection,
+                    self.transfer_config)
+        repo._use_resource(self.connection.get_resource('s3'))
+        repo._transfers = self._transfers
+        # the shared client adds the write conditions of the clone's keys
+        repo._exclusive = self._exclusive
+        return repo
+
+    def add_files(self, name, file_names, dists=[], overwrite=False,
+                  checksums={}, pooldir=None):
+        """Upload the files of a package to the pool of every one of the
+        specified distributions. Each file is read once: it is hashed as
+        it is uploaded to the first distribution, all the files of the
+        package at once, and copied from there to the others on the S3
+        side.
+
+        Under the 'hash' pool layout, the files are uploaded once, to the
+        directory of their content that every distribution shares, and
+        not at all if they are already there.
+
+        :param name: string, the package name
+        :param file_names: list of local paths
+        :param dists: list of strings
+        :param overwrite: bool
+        :param checksums: dict of file names to dicts of the digests they
+                          must match
+        :param pooldir: string, the directory of the package's content in
+                        the pool, under the 'hash' pool layout
+        :returns: dict of file names to dicts of their digests and size
+        :raises: KeyExistsError, ChecksumError
+        """
+        if pooldir:
+            uploads = [('%s/%s' % (pooldir, os.path.basename(x)), x,
+                        checksums.get(x, {})) for x in file_names]
+            # identical content: the files that are there can stay there,
+            # and a HEAD is much cheaper than uploading them again
+            if not overwrite:
+                uploads = [x for x in uploads if not self._key_exists(
+                    self._get_key(x[0]))]
+            for key_name, file_name, _ in uploads:
                 self._log.info('Attempting to upload s3://%s/%s',
                                self.bucket_name, key_name)
-                self._set_key_from_file(key_name, pkg.filename,
-                                        overwrite=overwrite)
-            except KeyExistsError:
-                self._log.error(
-                    'Key s3://%s/%s already exists, you probably meant '
-                    'to copy it within the repo.',
-                    self.bucket_name, key_name)
-                raise
+            digests = {}
+            if uploads:
+                # the conditional write still covers a concurrent add
+                digests = dict(zip([x[1] for x in uploads], self._upload_files(
+                    uploads, overwrite=overwrite, skip_existing=True)))
+            return dict((x, digests.get(x) or checksums.get(x, {}))
+                        for x in file_names)
+        if not dists:
+            return {}
+        uploads = []
+        for file_name in file_names:
+            key_name = self._get_pkg_pathname(
+                name, os.path.basename(file_name), dists[0])
+            self._log.info('Attempting to upload s3://%s/%s',
+                           self.bucket_name, key_name)
+            uploads.append((key_name, file_name,
+                            checksums.get(file_name, {})))
+        try:
+            digests = dict(zip(file_names, self._upload_files(
+                uploads, overwrite=overwrite)))
+            for dist in dists[1:]:
+                for old_path, file_name, _ in uploads:
+                    key_name = self._get_pkg_pathname(
+                        name, os.path.basename(file_name), dist)
+                    self._log.info('Attempting to copy s3://%s/%s',
+                                   self.bucket_name, key_name)
+                    self.copy_key(old_path, key_name, overwrite=overwrite)
+        except KeyExistsError as ex:
+            self._log.error('%s, you probably meant to copy it within the '
+                            'repo.', ex)
+            raise
+        return digests
+
+    def add_package(self, pkg, dists=[], overwrite=False):
+        self.add_files(pkg.get_header('package'), [pkg.filename],
+                       dists, overwrite)
 
     def add_source(self, dsc, dists=[], overwrite=False):
         """Iterate over the files proprty of a pydpkg.Dsc object,
@@ -251,21 +574,5 @@ class Repo(object):
         """
         # blow up immediately if the Dsc is not fully valid:
         dsc.validate()
-        name = dsc.source
-        for dist in dists:
-            upload = dsc.source_files
-            self._log.debug('files to upload: %s', upload)
-            for src_file in upload:
-                key_name = self._get_pkg_pathname(
-                    name, os.path.basename(src_file), dist)
-                try:
-                    self._log.info('Attempting to upload s3://%s/%s',
-                                   self.bucket_name, key_name)
-                    self._set_key_from_file(key_name, src_file,
-                                            overwrite=overwrite)
-                except KeyExistsError:
-                    self._log.error(
-                        'Key s3://%s/%s already exists, you probably meant '
-                        'to copy it within the repo.',
-                        self.bucket_name, key_name)
-                    raise
+        self._log.debug('files to upload: %s', dsc.source_files)
+        self.add_files(dsc.source, dsc.source_files, dists, overwrite)
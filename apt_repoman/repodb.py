@@ -5,27 +5,258 @@ import itertools
 import json
 import logging
 import os
+import re
+import threading
 import time
-
-from collections import Sequence, Set, OrderedDict, defaultdict
-from copy import copy, deepcopy
+import uuid
+import zlib
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict, defaultdict
+from collections.abc import Sequence, Set
+from copy import copy
+from email import message_from_string
 from gzip import GzipFile
 from io import BytesIO
-from six import string_types, iteritems
+from multiprocessing.pool import ThreadPool
+from six import string_types, text_type, iteritems
 
 # internal imports
+from apt_repoman.cache import DEFAULT_CACHE_DIR
 from apt_repoman.connection import Connection
+from apt_repoman.item import PackageItem
+from apt_repoman.notify import Dispatcher
 from apt_repoman.repo import KeyExistsError
+from apt_repoman.repo import KeyNotFoundError
+from apt_repoman.repo import hash_pool_dir
+from apt_repoman.repo import map_with_clones
+from apt_repoman.versions import compare_versions
+from apt_repoman.versions import encode_version
+from apt_repoman.versions import latest_items
+from apt_repoman.versions import sort_items
 from apt_repoman import utils
 
 # pypi imports
 from botocore.exceptions import ClientError
 from pgpy import PGPKeyring
-from pydpkg import Dpkg
 
 
 LOG = logging.getLogger(__name__)
 
+# simpledb caps the size of a single attribute value
+MAX_ATTRIBUTE_BYTES = 1024
+# ways of storing control text: 'packed' is plain text split on
+# utf-8 byte boundaries, 'zlib' is compressed and base64-encoded first
+CONTROL_FORMATS = ('packed', 'zlib')
+# meta item attributes maintained by _bump_generation(); these are never
+# written back by configuration changes or restored from a backup
+GENERATION_ATTRIBUTES = ('generation', 'purged_generation')
+# meta item attributes that add_meta() and rm_meta() change; nothing else
+# in the meta item is ever written back by _put_meta()
+CONFIG_ATTRIBUTES = ('dists', 'comps', 'archs', 'fields', 'topic_name',
+                     'origin', 'label', 'test_data')
+# control fields holding lists of package relationships; these are
+# indexed as the bare names of the packages they refer to
+RELATIONSHIP_FIELDS = (
+    'source', 'binary', 'depends', 'pre-depends', 'recommends', 'suggests',
+    'enhances', 'breaks', 'conflicts', 'provides', 'replaces', 'built-using',
+    'build-depends', 'build-depends-indep', 'build-conflicts',
+    'build-conflicts-indep')
+# ways of spreading package items over several simpledb domains: all in
+# the one domain, one domain per distribution, or N domains by item name
+SHARD_SCHEMES = ('none', 'dist', 'hash:N')
+# where package files are added in the S3 pool: under a directory per
+# distribution, or under a directory per package file (per source
+# package) content, shared by every distribution; see hash_pool_dir()
+POOL_LAYOUTS = ('dist', 'hash')
+# where package items live: 'hot' items are in the shard domains and
+# are published, 'archive' items are superseded versions set aside in a
+# domain of their own by archive()
+TIERS = ('hot', 'archive')
+# change records are numbered generation * CHANGES_PER_GENERATION + n,
+# where n counts the changes made by the mutation that won the generation
+CHANGES_PER_GENERATION = 10 ** 9
+# simpledb's limit on the number of items in a single batch call
+BATCH_SIZE = 25
+# simpledb will not return more than this many items from a single select
+MAX_SELECT_LIMIT = 2500
+# simpledb's limit on the number of values compared in a single predicate
+MAX_COMPARISONS = 20
+# latest-N queries covering at most this many leaves, all named up front,
+# are sorted and pruned on the simpledb side, one leaf at a time; broader
+# ones are cheaper to answer with a single scan
+MAX_PUSHDOWN_LEAVES = 20
+# prefix of the name index items in domain_name, one per package name;
+# never a hex digit, so no package item or migration partition clashes
+NAME_INDEX_PREFIX = 'nameindex-'
+# how many select queries to run at once when querying leaf by leaf
+SELECT_THREADS = 10
+# how many S3 copies to run at once when copying packages
+COPY_THREADS = 8
+# enough of a package item to identify it and sort it by version
+LEAF_ATTRIBUTES = ['name', 'version', 'distribution', 'component',
+                   'architecture', 'versionkey']
+
+
+def field_attribute(field):
+    """Return the name of the simpledb attribute that indexes a control
+    field, e.g. Build-Depends -> field_build_depends
+
+    :param field: string
+    :rtype: string
+    """
+    return 'field_' + field.lower().replace('-', '_')
+
+
+def _relationship_names(value):
+    # "foo (>= 1.0) [amd64] | bar:any, baz" -> foo, bar, baz
+    for relation in re.split(r'[,|]', value):
+        match = re.match(r'\s*([^\s(\[<:]+)', relation)
+        if match:
+            yield match.group(1)
+
+
+def _hash_shards(shard_map):
+    """Return N for a shard map of the form hash:N
+
+    :raises: InvalidShardMapError
+    """
+    scheme, _, count = shard_map.partition(':')
+    if scheme != 'hash' or not count.isdigit() or int(count) < 1:
+        raise InvalidShardMapError(
+            'Shard map must be one of %s, not %s' % (
+                ', '.join(SHARD_SCHEMES), shard_map))
+    return int(count)
+
+
+def _as_set(value):
+    # simpledb attributes are either a single string or a list of them
+    if value is None:
+        return set()
+    if isinstance(value, string_types):
+        return set([value])
+    return set(value)
+
+
+def _attribute_values(attrs):
+    """Flatten a dict of attribute name to value or list of values into
+    the Name/Value pairs taken by the sdb API."""
+    return [{'Name': name, 'Value': value}
+            for name, values in sorted(iteritems(attrs))
+            for value in sorted(_as_set(values))]
+
+
+def _item_bytes(item):
+    # roughly how simpledb sizes an item: its name plus every
+    # attribute name and value, in utf-8
+    size = 64
+    for name, values in iteritems(item):
+        for value in _as_set(values):
+            size += len(name.encode('utf-8')) + len(value.encode('utf-8'))
+    return size
+
+
+def _control_runs(item):
+    """Find the complete sets of controltxtN fragments in an item: for
+    each zero-padded width, the fragments numbered contiguously from 0,
+    as long as their count takes that many digits, as it does for every
+    set written by either splitter.
+
+    :returns: dict of width to list of attribute names
+    """
+    runs = {}
+    widths = set(len(x) - len('controltxt') for x in item
+                 if x.startswith('controltxt'))
+    for width in widths:
+        run = []
+        while 'controltxt%s' % str(len(run)).zfill(width) in item:
+            run.append('controltxt%s' % str(len(run)).zfill(width))
+        if run and len(str(len(run))) == width:
+            runs[width] = run
+    return runs
+
+
+def _error_code(ex):
+    """Return the AWS error code carried by a botocore ClientError"""
+    return ex.response.get('Error', {}).get('Code')
+
+
+def _unchanged(item):
+    """Return the condition, for an update of a package item we read
+    earlier, that it has not been rewritten or deleted since"""
+    if 'generation' in item:
+        return {'Name': 'generation', 'Value': item['generation']}
+    return {'Name': 'name', 'Value': item['name']}
+
+
+def package_attrs(pkg, digests=True):
+    """Return the attributes shared by every package item of a pydpkg.Dpkg
+    object, wherever it is added, plus its control message as `control`.
+    This is a plain function so that the result can be passed between
+    processes.
+
+    The digests and size of the file (md5, sha1, sha256 and size) take
+    reading all of it; unless `digests` is set, they are left out, for
+    the caller to fill in once the file has been read for another reason.
+
+    :param pkg: a pydpkg.Dpkg object
+    :param digests: bool
+    :rtype: dict
+    """
+    attrs = {'name': pkg.get_header('package'),
+             'filename': os.path.basename(pkg.filename),
+             'version': pkg.version,
+             'architecture': pkg.get_header('architecture'),
+             'control': str(pkg.message.as_string())}
+    if digests:
+        attrs.update({'md5': pkg.md5,
+                      'sha1': pkg.sha1,
+                      'sha256': pkg.sha256,
+                      'size': str(pkg.filesize)})
+    return attrs
+
+
+def source_attrs(dsc, validate=True):
+    """The equivalent of package_attrs() for a pydpkg.Dsc object. Unless
+    `validate` is unset, blows up immediately if the source bundle is
+    incomplete or corrupt.
+
+    :param dsc: a pydpkg.Dsc object
+    :param validate: bool
+    :rtype: dict
+    """
+    if validate:
+        dsc.validate()
+    return {'name': dsc.source,
+            'files': [os.path.basename(x) for x in dsc.source_files],
+            'version': dsc.version,
+            'architecture': 'source',
+            'control': dsc.message_str}
+
+
+def pool_dir(attrs):
+    """Return the directory of the S3 pool that the files of a package
+    live in under the 'hash' pool layout: binary packages are keyed by
+    the sha256 of their file, source packages by the sha256 of their
+    control text, which lists the checksums of every file in the source
+    package.
+
+    :param attrs: dict, the output of package_attrs() with digests, or
+                  of source_attrs()
+    :rtype: string
+    """
+    if 'filename' in attrs:
+        digest = attrs['sha256']
+    else:
+        digest = hashlib.sha256(attrs['control'].encode('utf-8')).hexdigest()
+    return hash_pool_dir(attrs['name'], digest)
+
+
+def _same_files(item, other):
+    """Whether two items of a package refer to the same package files"""
+    return (item.get('sha256') == other.get('sha256') and
+            item.get('files') == other.get('files'))
+
 
 class RepodbError(Exception):
     pass
@@ -47,6 +278,18 @@ class InvalidComponentError(RepodbError):
     pass
 
 
+class InvalidShardMapError(RepodbError):
+    pass
+
+
+class InvalidPoolLayoutError(RepodbError):
+    pass
+
+
+class InvalidFieldError(RepodbError):
+    pass
+
+
 class InvalidCopyActionError(RepodbError):
     pass
 
@@ -61,9 +304,29 @@ class KeyringNotFoundError(RepodbError):
 
 class Repodb(object):
 
-    def __init__(self, domain_name, role_arn=None, connection=None):
+    def __init__(self, domain_name, role_arn=None, connection=None,
+                 control_format='packed', cache=None, consistent_read=True,
+                 notify_mode='batch', spool_dir=DEFAULT_CACHE_DIR,
+                 metadata=None):
+        if control_format not in CONTROL_FORMATS:
+            raise RepodbError(
+                'control text format must be one of %s: %s' %
+                (CONTROL_FORMATS, control_format))
         self.domain_name = domain_name
         self.role_arn = role_arn
+        self.control_format = control_format
+        self.cache = cache
+        # whether reads see every write that completed before they began;
+        # eventually consistent reads are cheaper and faster, but may be a
+        # second or so out of date
+        self.consistent_read = consistent_read
+        # how notifications are published, and where the ones that could
+        # not be are kept until the next run; see apt_repoman.notify
+        self.notify_mode = notify_mode
+        self.spool_dir = spool_dir
+        # an optional apt_repoman.cache.MetadataCache, to remember the
+        # existence of the domain and the ARN of the topic between runs
+        self.metadata = metadata
         self._log = LOG or logging.getLogger(__name__)
         self._connection = connection or None
         self._sdb = None
@@ -72,6 +335,10 @@ class Repodb(object):
         self._domain_exists = None
         self._topic_exists = None
         self._topic_arn = None
+        self._notifier = None
+        self._cache_fresh = False
+        self._indexed_names = set()
+        self._shard_lock = threading.Lock()
 
     @property
     def connection(self):
@@ -91,26 +358,81 @@ class Repodb(object):
             self._sns = self.connection.sns
         return self._sns
 
+    @property
+    def notifier(self):
+        if self._notifier is None:
+            self._notifier = Dispatcher(
+                self.sns, self.topic_arn,
+                os.path.join(self.spool_dir,
+                             '%s-notifications.jsonl' % self.domain_name),
+                mode=self.notify_mode, on_not_found=self._forget_topic_arn)
+        return self._notifier
+
+    def _metadata_key(self, kind, name):
+        return '%s|%s|%s' % (kind, self.connection.identity, name)
+
+    def _forget_topic_arn(self):
+        # the topic has been deleted: resolve (and re-create) it next time
+        if self.metadata is not None and self.topic_name:
+            self.metadata.invalidate(
+                self._metadata_key('topic_arn', self.topic_name))
+
+    def _forget_domain(self):
+        self._domain_exists = None
+        if self.metadata is not None:
+            self.metadata.invalidate(
+                self._metadata_key('domain', self.domain_name))
+
+    def close(self, timeout=None):
+        """Finish publishing notifications, waiting at most `timeout`
+        seconds; the ones left over are spooled for the next run.
+
+        :returns: the number of notifications spooled
+        :rtype: int
+        """
+        if self._notifier is None:
+            return 0
+        return self._notifier.close(timeout)
+
     @property
     def meta(self):
         if not self._meta:
-            try:
-                self._meta = self._get_attributes('meta', always_list=True)
-            except KeyError:
-                self._log.warning(
-                    'No metadata found in simpledb domain %s, '
-                    'did you forget to run "repoman setup"?', self.domain_name)
-                self._meta = {}
+            self._reload_meta()
+        return self._meta
+
+    def _reload_meta(self, consistent_read=None):
+        """(Re-)read the meta item; reads that other reads are checked
+        against, like the repository generation, must be consistent."""
+        try:
+            self._meta = self._get_attributes(
+                'meta', always_list=True, consistent_read=consistent_read)
+        except KeyError:
+            self._log.warning(
+                'No metadata found in simpledb domain %s, '
+                'did you forget to run "repoman setup"?', self.domain_name)
+            self._meta = {}
+        except ClientError as ex:
+            if _error_code(ex) == 'NoSuchDomain':
+                self._forget_domain()
+            raise
         return self._meta
 
     @property
     def domain_exists(self):
         if isinstance(self._domain_exists, type(None)):
+            key = self._metadata_key('domain', self.domain_name)
+            # only a domain that exists is remembered: one that does not
+            # is about to be created by setup
+            if self.metadata is not None and self.metadata.get(key):
+                self._domain_exists = True
+                return self._domain_exists
             domains = []
             paginator = self.sdb.get_paginator('list_domains')
             for page in paginator.paginate():
                 domains.extend(page.get('DomainNames', []))
             self._domain_exists = self.domain_name in domains
+            if self.metadata is not None and self._domain_exists:
+                self.metadata.set(key, True)
         return self._domain_exists
 
     @property
@@ -123,13 +445,20 @@ class Repodb(object):
             try:
                 if not self.topic_name:
                     return self._topic_arn  # if unset, logging is off
+                key = self._metadata_key('topic_arn', self.topic_name)
+                if self.metadata is not None:
+                    self._topic_arn = self.metadata.get(key)
+                if self._topic_arn is not None:
+                    return self._topic_arn
                 # be nice and accept either a name or a full ARN here
-                elif self.topic_name.startswith('arn:aws:sns:'):
+                if self.topic_name.startswith('arn:aws:sns:'):
                     self._topic_arn = self.sns.create_topic(
                         Name=self.topic_name.split(':')[5])['TopicArn']
                 else:
                     self._topic_arn = self.sns.create_topic(
                         Name=self.topic_name)['TopicArn']
+                if self.metadata is not None:
+                    self.metadata.set(key, self._topic_arn)
             except KeyError:
                 # someone put something unparseable into the topic config
                 self._log.warning(
@@ -142,6 +471,17 @@ class Repodb(object):
                     'logging disabled: %s', self.topic_name, ex)
         return self._topic_arn
 
+    @property
+    def generation(self):
+        """The repository generation: a counter in the meta item that
+        is advanced by every mutation of the package items."""
+        return int((self.meta.get('generation') or ['0'])[0])
+
+    @property
+    def purged_generation(self):
+        """The generation of the most recent deletion of package items"""
+        return int((self.meta.get('purged_generation') or ['0'])[0])
+
     @property
     def archs(self):
         archs = self.meta.get('archs', [])
@@ -161,6 +501,55 @@ class Repodb(object):
     def comps(self):
         return self.meta.get('comps', [])
 
+    @property
+    def fields(self):
+        return self.meta.get('fields', [])
+
+    @property
+    def shard_map(self):
+        """How package items are spread over simpledb domains; see
+        SHARD_SCHEMES. The meta item always lives in domain_name."""
+        return (self.meta.get('shard_map') or ['none'])[0]
+
+    @property
+    def dist_shards(self):
+        """Every distribution that has had a domain of its own under the
+        'dist' shard map, including any since removed from the repo
+        config, whose items are still there."""
+        return self.meta.get('dist_shards', [])
+
+    @property
+    def rebalancing_from(self):
+        """The previous shard map while a rebalance is in progress"""
+        return (self.meta.get('shard_map_from') or [None])[0]
+
+    @property
+    def shard_domains(self):
+        """Every domain that may currently hold hot package items"""
+        return self._domains_for()
+
+    @property
+    def archive_domain(self):
+        return '%s-archive' % self.domain_name
+
+    @property
+    def changes_domain(self):
+        return '%s-changes' % self.domain_name
+
+    @property
+    def pool_layout(self):
+        """Where package files are added in the S3 pool; see
+        POOL_LAYOUTS. Every package item written under the 'hash' layout
+        records its directory in the pool as its `pooldir` attribute."""
+        return (self.meta.get('pool_layout') or ['dist'])[0]
+
+    @property
+    def archive_keep(self):
+        """The number of versions per leaf the last archive() kept in the
+        hot domains, or None if nothing has ever been archived."""
+        keep = (self.meta.get('archive_keep') or [None])[0]
+        return int(keep) if keep else None
+
     @property
     def topic_name(self):
         # this may be unset and that is legit
@@ -198,10 +587,195 @@ class Repodb(object):
                             self.domain_name, ex)
             raise
 
+    def _shard_domains(self, shard_map, dists=[]):
+        """Return the domains a shard map spreads the package items of
+        `dists` (or of every distribution) over."""
+        if shard_map == 'none':
+            return [self.domain_name]
+        if shard_map == 'dist':
+            # a removed distribution's items stay in its domain; and a
+            # distribution with no domain of its own has no items
+            known = self.dists + [x for x in self.dist_shards
+                                  if x not in self.dists]
+            return ['%s-%s' % (self.domain_name, x)
+                    for x in known if not dists or x in dists]
+        return ['%s-%03d' % (self.domain_name, x)
+                for x in range(_hash_shards(shard_map))]
+
+    def _domains_for(self, dists=[], tiers=('hot',)):
+        """Return the domains that may hold package items of `dists`
+        in any of `tiers`."""
+        domains = []
+        if 'hot' in tiers:
+            # while rebalancing, items may be in either the old or new shard
+            for shard_map in (self.shard_map, self.rebalancing_from):
+                if shard_map is None:
+                    continue
+                for domain in self._shard_domains(shard_map, dists):
+                    if domain not in domains:
+                        domains.append(domain)
+        if 'archive' in tiers and self.archive_keep:
+            domains.append(self.archive_domain)
+        return domains
+
+    def _shard_for(self, key, dist, shard_map=None):
+        """Return the domain a package item belongs in
+
+        :param key: string, the item name
+        :param dist: string, the item's distribution
+        :param shard_map: string, defaults to the current shard map
+        :rtype: string
+        """
+        shard_map = shard_map or self.shard_map
+        if shard_map == 'none':
+            return self.domain_name
+        if shard_map == 'dist':
+            return '%s-%s' % (self.domain_name, dist)
+        return '%s-%03d' % (self.domain_name,
+                            int(key[:8], 16) % _hash_shards(shard_map))
+
+    def _shard_for_item(self, item, shard_map=None):
+        return self._shard_for(self._compute_keyname_from_item(item),
+                               item['distribution'], shard_map)
+
+    def _create_shard_domains(self, shard_map=None):
+        """Create any of the domains of a shard map that do not exist"""
+        shard_map = shard_map or self.shard_map
+        if shard_map == 'dist':
+            return self._create_dist_shards(self.dists)
+        self._create_domains(self._shard_domains(shard_map))
+
+    def _create_dist_shards(self, dists):
+        """Create the domains of `dists` under the 'dist' shard map, and
+        record them in the repo metadata, so that their items are found
+        even once the distributions are removed from the repo config."""
+        with self._shard_lock:
+            new = [x for x in dists if x not in self.dist_shards]
+            self._create_domains(['%s-%s' % (self.domain_name, x)
+                                  for x in dists])
+            if new:
+                self._put_attributes('meta', {'dist_shards': new},
+                                     replace=False)
+                self.meta.setdefault('dist_shards', []).extend(new)
+
+    def _create_domains(self, domains):
+        existing = []
+        for page in self.sdb.get_paginator('list_domains').paginate():
+            existing.extend(page.get('DomainNames', []))
+        for domain in domains:
+            if domain not in existing:
+                self._log.warning('Creating simpledb domain %s', domain)
+                self.sdb.create_domain(DomainName=domain)
+
+    def _parallel(self, func, args):
+        """Map `func` over `args` on a pool of threads; the sdb client is
+        thread-safe, though boto3 resources are not."""
+        args = list(args)
+        if len(args) < 2:
+            return [func(x) for x in args]
+        # make sure the client exists before fanning out
+        self.sdb
+        pool = ThreadPool(min(len(args), SELECT_THREADS))
+        try:
+            return pool.map(func, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _select_shards(self, dists=[], tiers=('hot',), consistent_read=None,
+                       **kwargs):
+        """Run a select query built by _assemble_select_query() against
+        every domain that may hold items of `dists`, concurrently.
+
+        Once the name index has been built, wildcard names are resolved
+        against it, and the queries look up the matching names exactly
+        instead of scanning for them.
+
+        :rtype: Generator
+        """
+        domains = self._domains_for(dists, tiers)
+        names = [kwargs.pop('names', [])]
+        if names[0] and kwargs.get('name_wildcard') and self.names_indexed:
+            matches = self._resolve_wildcard(names[0])
+            if not matches:
+                return iter([])
+            kwargs['name_wildcard'] = False
+            names = [matches[x:x + MAX_COMPARISONS]
+                     for x in range(0, len(matches), MAX_COMPARISONS)]
+        queries = [self._assemble_select_query(
+            dists=dists, domain=domain, names=batch, **kwargs)
+            for domain in domains for batch in names]
+        if len(queries) == 1:
+            return self._select(queries[0], consistent_read)
+        results = self._parallel(
+            lambda query: list(self._select(query, consistent_read)),
+            queries)
+        return self._dedupe(itertools.chain.from_iterable(results))
+
+    @property
+    def names_indexed(self):
+        """Whether the name index covers every package item"""
+        return 'index-names' in self.applied_migrations
+
+    def _resolve_wildcard(self, prefixes):
+        """Return the package names in the name index that start with
+        any of `prefixes`, sorted."""
+        query = ("select `indexed_name` from `{0}` where {1}").format(
+            self.domain_name, ' or '.join(
+                ["`indexed_name` like '{0}%'".format(x) for x in prefixes]))
+        self._log.debug('query: %s', query)
+        return sorted(set(x['indexed_name'] for x in self._select(query)))
+
+    def _index_names(self, names):
+        """Add package names to the name index. Every write carries a new
+        token, so that _unindex_names() can tell if it raced with one."""
+        for name in set(names):
+            self._put_attributes(NAME_INDEX_PREFIX + name, {
+                'indexed_name': name, 'index_token': uuid.uuid4().hex})
+
+    def _unindex_names(self, names):
+        """Drop the package names that no longer have any package items,
+        archived or not, from the name index."""
+        def unindex(name):
+            key = NAME_INDEX_PREFIX + name
+            try:
+                token = self._get_attributes(
+                    key, ['index_token'], consistent_read=True)['index_token']
+            except KeyError:
+                return
+            for domain in self._domains_for(tiers=TIERS):
+                for page in self._select(self._assemble_select_query(
+                        names=[name], count=True, domain=domain), True):
+                    if int(page['Count']):
+                        return
+            try:
+                # unless somebody has added the name back since we looked
+                self.sdb.delete_attributes(
+                    DomainName=self.domain_name, ItemName=key,
+                    Expected={'Name': 'index_token', 'Value': token})
+            except ClientError as ex:
+                if _error_code(ex) not in ('ConditionalCheckFailed',
+                                           'AttributeDoesNotExist'):
+                    raise
+        self._parallel(unindex, sorted(set(names)))
+
+    def _dedupe(self, items):
+        # mid-rebalance, an item can briefly be in two domains at once, and
+        # an archived item may have been copied back to the hot domains
+        seen = set()
+        for item in items:
+            if 'version' in item:
+                key = self._compute_keyname_from_item(item)
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield item
+
     def _create_meta(self, dists=[], comps=[], archs=[],
                      topic_name='', origin='', label='',
-                     test_data=''):
+                     test_data='', fields=[]):
         notifications = []
+        changed = []
         while 'all' in archs:
             self._log.warning('You cannot add the "all" architecture; like '
                               'the Vorlons it has always been here.')
@@ -210,8 +784,10 @@ class Repodb(object):
             self._log.warning('You cannot add the "source" architecture; like '
                               'the Vorlons it has always been here.')
             archs.remove('source')
-        for key in ('dists', 'comps', 'archs'):
+        for key in ('dists', 'comps', 'archs', 'fields'):
             targets = locals()[key]
+            if targets or key not in self.meta:
+                changed.append(key)
             if key not in self.meta:
                 # if not present, add
                 self._meta[key] = targets
@@ -229,40 +805,46 @@ class Repodb(object):
         if topic_name:
             self._log.debug('setting up sns notifications: %s', topic_name)
             self._meta['topic_name'] = [topic_name]
+            changed.append('topic_name')
             notifications.append(
                 {'action': 'add', 'type': 'sns_topic',
                  'name': topic_name, 'caller': self.connection.caller_id})
         if origin:
             self._log.debug('setting repo origin: %s', origin)
             self._meta['origin'] = [origin]
+            changed.append('origin')
             notifications.append(
                 {'action': 'add', 'type': 'origin',
                  'name': origin, 'caller': self.connection.caller_id})
         if label:
             self._log.debug('setting repo label: %s', label)
             self._meta['label'] = [label]
+            changed.append('label')
             notifications.append(
                 {'action': 'add', 'type': 'label',
                  'name': label, 'caller': self.connection.caller_id})
         if topic_name:
             self._log.debug('setting up sns notifications: %s', topic_name)
             self._meta['topic_name'] = [topic_name]
+            changed.append('topic_name')
             notifications.append(
                 {'action': 'add', 'type': 'sns_topic',
                  'name': topic_name, 'caller': self.connection.caller_id})
         if test_data:
             self._meta['test_data'] = test_data
+            changed.append('test_data')
         self._log.debug('updated meta: %s', self._meta)
-        response = self._put_attributes('meta', self.meta, replace=True)
+        response = self._put_meta(changed)
         if response:
             self._send_notifications(notifications)
         return response
 
     def _delete_meta(self, dists=[], comps=[], archs=[],
                      topic_name=False, origin=False, label=False,
-                     test_data=False):
+                     test_data=False, fields=[]):
         notifications = []
-        for key in ('archs', 'dists', 'comps'):
+        changed = []
+        for key in ('archs', 'dists', 'comps', 'fields'):
             targets = locals()[key]
             for target in targets:
                 current = getattr(self, key)
@@ -273,12 +855,14 @@ class Repodb(object):
                     continue
                 current.pop(current.index(target))
                 self.meta[key] = current
+                changed.append(key)
                 notifications.append(
                     {'action': 'delete', 'type': key,
                      'name': target, 'caller': self.connection.caller_id})
         if topic_name and 'topic_name' in self.meta:
             self._log.debug('Disabling sns notifications')
             self.meta['topic_name'] = ''
+            changed.append('topic_name')
             notifications.append(
                 {'action': 'delete', 'type': 'sns_topic',
                  'name': self.topic_name,
@@ -286,6 +870,7 @@ class Repodb(object):
         if origin and 'origin' in self.meta:
             self._log.debug('Disabling sns notifications')
             self.meta['origin'] = ''
+            changed.append('origin')
             notifications.append(
                 {'action': 'delete', 'type': 'origin',
                  'name': self.origin,
@@ -293,25 +878,271 @@ class Repodb(object):
         if label and 'label' in self.meta:
             self._log.debug('Disabling sns notifications')
             self.meta['label'] = ''
+            changed.append('label')
             notifications.append(
                 {'action': 'delete', 'type': 'label',
                  'name': self.label,
                  'caller': self.connection.caller_id})
         if test_data and 'test_data' in self.meta:
             self.meta['test_data'] = ''
-        response = self._put_attributes('meta', self.meta, replace=True)
+            changed.append('test_data')
+        response = self._put_meta(changed)
         if response:
             self._send_notifications(notifications)
         return response
 
+    def _put_meta(self, keys):
+        """Write the repository configuration attributes that the caller
+        changed back to the meta item. Only CONFIG_ATTRIBUTES are ever
+        written: the rest of the meta item (generation counters,
+        migrations, shard map) is kept up to date by the code that owns
+        it, and our cached copy of it may be stale.
+
+        :param keys: list of strings, the attributes changed
+        """
+        attrs = dict((k, self.meta[k]) for k in CONFIG_ATTRIBUTES
+                     if k in keys and k in self.meta)
+        if not attrs:
+            return None
+        return self._put_attributes('meta', attrs, replace=True)
+
+    def _format_generation(self, generation):
+        # simpledb only compares strings, so pad generations out to
+        # a fixed width to make them sort numerically
+        return '%020d' % generation
+
+    def _next_generation(self):
+        """The generation stamp that items written by the mutation
+        currently in progress should carry."""
+        return self._format_generation(self.generation + 1)
+
+    def _bump_generation(self, written=[], purged=False, changes=[]):
+        """Advance the repository generation after a mutation.
+
+        `written` are the items written by the mutation, stamped
+        with _next_generation(). The meta item is only updated if nobody
+        else has advanced the generation in the meantime; if somebody has,
+        the items are re-stamped with the next free generation and we try
+        again. This guarantees that an item stamped with generation N is
+        always in place before the meta item says N, so a cache that is
+        current as of N only ever needs the items stamped after N.
+
+        The change records describing the mutation are written to the
+        change feed, and re-stamped, in just the same way.
+
+        :param written: list of (domain, item name) tuples
+        :param purged: bool, whether the mutation deleted any items
+        :param changes: list of dicts made by _change_record()
+        :returns: the new generation
+        :rtype: int
+        """
+        stamp = self._next_generation()
+        records = [(uuid.uuid4().hex, x) for x in changes]
+        self._put_change_records(records, int(stamp))
+        while True:
+            current = self.generation
+            new = self._format_generation(current + 1)
+            if new != stamp:
+                self._log.debug('re-stamping %d items with generation %s',
+                                len(written), new)
+                for domain, key in written:
+                    self._put_attributes(key, {'generation': new},
+                                         domain=domain)
+                self._put_change_records(records, current + 1)
+                stamp = new
+            attrs = {'generation': new}
+            if purged:
+                attrs['purged_generation'] = new
+            if current:
+                expected = {'Name': 'generation',
+                            'Value': self._format_generation(current)}
+            else:
+                expected = {'Name': 'generation', 'Exists': False}
+            try:
+                self._put_attributes('meta', attrs, expected=expected)
+            except ClientError as ex:
+                if _error_code(ex) not in ('ConditionalCheckFailed',
+                                           'AttributeDoesNotExist'):
+                    raise
+                # somebody else got there first: re-read and go again
+                self._reload_meta(consistent_read=True)
+                continue
+            for attr, value in iteritems(attrs):
+                self.meta[attr] = [value]
+            self._cache_fresh = False
+            return current + 1
+
+    def _change_record(self, action, item, **kwargs):
+        """Describe a change to a package item for the change feed: the
+        notification we send for it, plus enough to find the item."""
+        record = {'action': action,
+                  'key': self._compute_keyname_from_item(item),
+                  'name': item['name'],
+                  'version': item['version'],
+                  'distribution': item['distribution'],
+                  'component': item['component'],
+                  'architecture': item['architecture'],
+                  'caller': self.connection.caller_id,
+                  'timestamp': '%d' % time.time()}
+        record.update(kwargs)
+        return record
+
+    def _put_change_records(self, records, generation):
+        """Write (or re-number) change records as of a generation, in
+        batches, creating the change feed domain the first time."""
+        for idx in range(0, len(records), BATCH_SIZE):
+            items = []
+            for count, (name, record) in enumerate(
+                    records[idx:idx + BATCH_SIZE], idx):
+                attrs = dict(record)
+                attrs['seq'] = '%029d' % (
+                    generation * CHANGES_PER_GENERATION + count)
+                items.append({'Name': name,
+                              'Attributes': self._respool_attributes(
+                                  attrs, True)})
+            try:
+                self.sdb.batch_put_attributes(
+                    DomainName=self.changes_domain, Items=items)
+            except ClientError as ex:
+                if _error_code(ex) != 'NoSuchDomain':
+                    raise
+                self._create_domains([self.changes_domain])
+                self.sdb.batch_put_attributes(
+                    DomainName=self.changes_domain, Items=items)
+
+    def changes_since(self, seq=0):
+        """Return the changes made to package items after the change
+        numbered `seq`, oldest first. Every change record is a dict with
+        the keys of a notification for the change, plus `seq` (its number
+        as an int), `key` (the item name) and `architecture`.
+
+        Only the changes of mutations the repository generation has
+        caught up with are returned, so a reader that carries on from the
+        last seq it saw never skips a change; if a writer was interrupted,
+        it may however see some changes twice.
+
+        :param seq: int
+        :rtype: Generator
+        """
+        # always check against the current state of the meta item; as in
+        # _refresh_cache(), both reads have to be strongly consistent
+        self._reload_meta(consistent_read=True)
+        last = (self.generation + 1) * CHANGES_PER_GENERATION
+        query = ("select * from `{0}` where `seq` > '{1:029d}' and "
+                 "`seq` < '{2:029d}' order by `seq` asc").format(
+                     self.changes_domain, seq, last)
+        self._log.debug('query: %s', query)
+        try:
+            for item in self._select(query, consistent_read=True):
+                item['seq'] = int(item['seq'])
+                yield item
+        except ClientError as ex:
+            if _error_code(ex) != 'NoSuchDomain':
+                raise
+            self._log.debug('no changes have been recorded yet')
+
+    def _refresh_cache(self):
+        """Bring the local cache up to date with simpledb. If nothing has
+        been deleted since the cache was last refreshed, only the items
+        stamped with a newer generation are fetched; otherwise (or if
+        there is no cache yet) the whole domain is re-read.
+
+        Note that items written by versions of repoman that predate
+        generation stamps are only picked up by a full refresh.
+        """
+        if self._cache_fresh:
+            return
+        # always check against the current state of the meta item, and
+        # read strongly: an eventually consistent read could miss items
+        # stamped with a generation the cache would then claim to have
+        self._reload_meta(consistent_read=True)
+        generation = self.generation
+        cached = self.cache.generation
+        if cached == generation:
+            self._log.debug('cache is current as of generation %d',
+                            generation)
+        elif (cached is None or cached > generation or
+                cached < self.purged_generation):
+            self._log.info('rebuilding local cache of simpledb domain %s',
+                           self.domain_name)
+            self.cache.update(
+                self._keyed(self._select_shards(consistent_read=True)),
+                generation, replace=True)
+        else:
+            self._log.debug('updating cache from generation %d to %d',
+                            cached, generation)
+            self.cache.update(
+                self._keyed(self._select_shards(since_generation=cached,
+                                                consistent_read=True)),
+                generation, replace=False)
+        self._cache_fresh = True
+
+    def _keyed(self, items):
+        for item in items:
+            yield self._compute_keyname_from_item(item), item
+
+    def _find_items(self, names=[], dists=[], comps=[], archs=[],
+                    versions=[], name_wildcard=False, fields={},
+                    tiers=('hot',)):
+        """Return the package items matching a set of filters, either
+        from the local cache (if there is one) or straight from simpledb.
+        The cache only holds hot items.
+
+        :rtype: Generator
+        """
+        if self.cache is not None and 'archive' not in tiers:
+            self._refresh_cache()
+            items = self.cache.select(
+                names=names, dists=dists, comps=comps, archs=archs,
+                versions=versions, name_wildcard=name_wildcard)
+            if fields:
+                items = (x for x in items if all(
+                    _as_set(x.get(field_attribute(k))).intersection(v)
+                    for k, v in iteritems(fields)))
+            return items
+        return self._select_shards(
+            names=names, dists=dists, comps=comps, archs=archs,
+            versions=versions, name_wildcard=name_wildcard, fields=fields,
+            tiers=tiers)
+
+    def find_files(self, sha256s=[], filenames=[], tiers=('hot',)):
+        """Return the package items that refer to package files with any
+        of the given sha256 digests or (pool) file names, from the local
+        cache if there is one.
+
+        Source package items carry no digests, so are only found by the
+        names of their files.
+
+        :param sha256s: list of strings
+        :param filenames: list of strings
+        :param tiers: tuple of TIERS to look in
+        :rtype: list
+        """
+        if not (sha256s or filenames):
+            return []
+        if self.cache is not None and 'archive' not in tiers:
+            self._refresh_cache()
+            return list(self.cache.find_files(sha256s, filenames))
+        selectors = []
+        for attr, values in (('sha256', sha256s),
+                             ('filename', filenames),
+                             ('files', filenames)):
+            if values:
+                selectors.append('`{0}` in ({1})'.format(attr, ','.join(
+                    ["'%s'" % x.replace("'", "''") for x in values])))
+        queries = [
+            'select * from `{0}` where `name` is not null and ({1})'.format(
+                domain, ' or '.join(selectors))
+            for domain in self._domains_for(tiers=tiers)]
+        results = self._parallel(
+            lambda query: list(self._select(query)), queries)
+        return list(self._dedupe(itertools.chain.from_iterable(results)))
+
     def _send_notifications(self, notifications):
-        if not self.topic_arn:
+        # published in the background; see close()
+        if not self.topic_arn or not notifications:
             return None
-        for alert in notifications:
-            self.sns.publish(
-                TopicArn=self.topic_arn,
-                Message=json.dumps(alert),
-                Subject='Repoman notification')
+        self.notifier.send(notifications)
 
     def _respool_attributes(self, attributes, replace=False):
         """ Transform a python dictionary in the form
@@ -381,11 +1212,13 @@ class Repodb(object):
                     response[k] = v
         return response
 
-    def _get_attributes(self, key, attribute_names=[], consistent_read=True,
-                        always_list=False):
+    def _get_attributes(self, key, attribute_names=[], consistent_read=None,
+                        always_list=False, domain=None):
+        if consistent_read is None:
+            consistent_read = self.consistent_read
         try:
             attributes = self.sdb.get_attributes(
-                DomainName=self.domain_name,
+                DomainName=domain or self.domain_name,
                 ItemName=key,
                 AttributeNames=attribute_names,
                 ConsistentRead=consistent_read)['Attributes']
@@ -401,38 +1234,127 @@ class Repodb(object):
         except KeyError:
             return None
 
-    def _put_attributes(self, key, attrs, replace=True):
+    def _put_attributes(self, key, attrs, replace=True, expected=None,
+                        domain=None):
         attributes = self._respool_attributes(attrs, replace)
+        kwargs = {}
+        if expected is not None:
+            kwargs['Expected'] = expected
         try:
             response = self.sdb.put_attributes(
-                DomainName=self.domain_name,
+                DomainName=domain or self.domain_name,
                 ItemName=key,
-                Attributes=attributes)
+                Attributes=attributes,
+                **kwargs)
+        except ClientError as ex:
+            if _error_code(ex) == 'ConditionalCheckFailed':
+                self._log.debug('Conditional update of key %s failed: %s',
+                                key, ex)
+            else:
+                self._log.fatal('Could not update key %s: %s', key, ex)
+            raise
         except Exception as ex:
             self._log.fatal('Could not update key %s: %s', key, ex)
             raise
         return response
 
+    def _put_new_item(self, key, attrs, overwrite=False):
+        """Write a package item. Unless overwrite is set, the write is
+        conditional on the item not existing yet, so that checking and
+        writing take a single round trip and two concurrent writers
+        cannot both succeed.
+
+        :raises: ItemExistsError
+        """
+        expected = None
+        if not overwrite:
+            expected = {'Name': 'name', 'Exists': False}
+        try:
+            return self._put_attributes(
+                key, attrs, expected=expected,
+                domain=self._shard_for(key, attrs['distribution']))
+        except ClientError as ex:
+            if _error_code(ex) != 'ConditionalCheckFailed':
+                raise
+            raise ItemExistsError(
+                'Package %s version %s in distribution %s, component %s '
+                'and architecture %s already exists in simpledb' % (
+                    attrs['name'], attrs['version'], attrs['distribution'],
+                    attrs['component'], attrs['architecture']))
+
+    def _encode_item_version(self, item):
+        """Migration step: add the versionkey attribute used for sorting
+        package items by version in select queries."""
+        key = encode_version(item['version'])
+        if item.get('versionkey') == key:
+            return None
+        return {'versionkey': key}, []
+
+    def _index_item_name(self, item):
+        """Migration step: add the item's name to the name index."""
+        if item['name'] not in self._indexed_names:
+            self._index_names([item['name']])
+            # set.add() is atomic, so migration threads can share this
+            self._indexed_names.add(item['name'])
+        return None
+
+    def _extract_item_fields(self, item):
+        """Migration step: (re-)index the configured control fields and
+        drop the attributes of fields that are no longer indexed."""
+        attrs = self._extract_fields(self._unpack_control_text(item))
+        current = dict((k, v) for k, v in iteritems(item)
+                       if k.startswith('field_'))
+        stale = sorted(set(current) - set(attrs))
+        if not stale and all(_as_set(current.get(k)) == _as_set(v)
+                             for k, v in iteritems(attrs)):
+            return None
+        return attrs, stale
+
+    def _delete_attributes(self, key, attrs, domain=None):
+        """Delete the given values of attributes of an item, leaving the
+        rest of the item alone.
+
+        :param attrs: dict of attribute name to value or list of values
+        """
+        try:
+            response = self.sdb.delete_attributes(
+                DomainName=domain or self.domain_name,
+                ItemName=key,
+                Attributes=_attribute_values(attrs))
+        except Exception as ex:
+            self._log.fatal('Could not delete attributes %s of item %s: %s',
+                            sorted(attrs), key, ex)
+            raise
+        return response
+
     def _put_item(self, item, replace=True):
         """A convenient wrapper around _put_attributes() and
         _compute_keyname_from_item()"""
         keyname = self._compute_keyname_from_item(item)
-        return self._put_attributes(keyname, item, replace)
+        return self._put_attributes(keyname, item, replace,
+                                    domain=self._shard_for_item(item))
 
     def _delete_item(self, item):
+        # delete the whole item rather than the attribute values we happen
+        # to know about: our copy may be older than what is in simpledb
         key = self._compute_keyname_from_item(item)
-        attrs = self._respool_attributes(item, replace=None)
+        domains = [self._shard_for(key, item['distribution'])]
+        if self.rebalancing_from:
+            domains.append(self._shard_for(
+                key, item['distribution'], self.rebalancing_from))
         try:
-            response = self.sdb.delete_attributes(
-                DomainName=self.domain_name,
-                ItemName=key,
-                Attributes=attrs)
+            for domain in sorted(set(domains)):
+                response = self.sdb.delete_attributes(
+                    DomainName=domain,
+                    ItemName=key)
         except Exception as ex:
             self._log.fatal('Could not delete item %s: %s', key, ex)
             raise
         return response
 
-    def _select(self, query, consistent_read=True):
+    def _select(self, query, consistent_read=None):
+        if consistent_read is None:
+            consistent_read = self.consistent_read
         pag = self.sdb.get_paginator('select')
         for page in pag.paginate(
                 SelectExpression=query,
@@ -440,8 +1362,29 @@ class Repodb(object):
             for item in page.get('Items', []):
                 yield self._unspool_attributes(item['Attributes'])
 
+    def _select_first(self, query, limit, consistent_read=None):
+        """Return no more than the first `limit` items of a select query
+        that ends in a limit clause: unlike _select(), don't carry on
+        with the next page of `limit` items."""
+        if consistent_read is None:
+            consistent_read = self.consistent_read
+        items = []
+        kwargs = {'SelectExpression': query,
+                  'ConsistentRead': consistent_read}
+        while len(items) < limit:
+            response = self.sdb.select(**kwargs)
+            items.extend([self._unspool_attributes(x['Attributes'])
+                          for x in response.get('Items', [])])
+            if 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+        return items[:limit]
+
     def _assemble_select_query(self, names=[], dists=[], comps=[], archs=[],
-                               versions=[], name_wildcard=False):
+                               versions=[], name_wildcard=False,
+                               since_generation=None, latest_versions=0,
+                               older_than=None, attributes=[], fields={},
+                               domain=None, count=False, limit=0):
         """Query the simpledb database for package items: this function
         assembles a simpledb select query as a string suitable for feeding
         to repodb._select()
@@ -455,11 +1398,22 @@ class Repodb(object):
         :param comps: list of repository components (strings)
         :param archs: list of package architectures (strings)
         :param versions: list of package versions (strings)
+        :param since_generation: only items stamped after this generation
+        :param latest_versions: only the N newest items, newest first
+        :param older_than: only items with a lower encoded version than this
+        :param attributes: only return these attributes of each item
+        :param fields: dict of control field names to lists of values
+        :param domain: the domain to query, by default domain_name
+        :param count: only count the matching items
+        :param limit: only the first N items, at most MAX_SELECT_LIMIT
         :returns: a generator object for a simpledb select() query
         :rtype: Generator
         """
-        query = 'select * from `{0}` where `name` is not null'.format(
-            self.domain_name)
+        output = ', '.join(['`%s`' % x for x in attributes]) or '*'
+        if count:
+            output = 'count(*)'
+        query = 'select {0} from `{1}` where `name` is not null'.format(
+            output, domain or self.domain_name)
         selectors = []
         tmpl = "every({0}) in ({1})"
         wild_tmpl = "`{0}` LIKE '{1}%'"
@@ -486,9 +1440,28 @@ class Repodb(object):
         if versions:
             selectors.append(tmpl.format(
                 'version', ','.join(["'%s'" % x for x in versions])))
+        for field in sorted(fields):
+            # no every() here: relationship fields are multi-valued, and
+            # any one of their values matching is what we want
+            selectors.append("`{0}` in ({1})".format(
+                field_attribute(field), ','.join(
+                    ["'%s'" % x.replace("'", "''") for x in fields[field]])))
+        if since_generation is not None:
+            selectors.append("`generation` > '{0}'".format(
+                self._format_generation(since_generation)))
+        if older_than is not None:
+            selectors.append("`versionkey` < '{0}'".format(older_than))
+        elif latest_versions:
+            # simpledb can only sort on an attribute used in a predicate
+            selectors.append('`versionkey` is not null')
         if selectors:
             query += ' and '
             query += ' and '.join(selectors)
+        if latest_versions:
+            query += ' order by `versionkey` desc limit {0}'.format(
+                latest_versions)
+        elif limit:
+            query += ' limit {0}'.format(min(limit, MAX_SELECT_LIMIT))
         self._log.debug('query: %s', query)
         return query
 
@@ -513,22 +1486,105 @@ class Repodb(object):
             comp=item['component'],
             arch=item['architecture'])
 
-    def _split_control_text(self, txt, max_elems=256):
-        """Simpledb attribute txtues are capped at 1024 bytes, and
+    def _split_control_text(self, txt, max_bytes=MAX_ATTRIBUTE_BYTES):
+        """Simpledb attribute values are capped at 1024 bytes, and
         debian control messages can easily be longer than that.
         Even better, control messages can contain unicode strings.
 
-        So: split into a list of substrings, each of which could
-        be up to 4 bytes long...
+        So: split into a list of substrings, each of which is at most
+        max_bytes long once encoded as utf-8, taking care never to cut
+        a multi-byte character in half.
         """
+        if not isinstance(txt, text_type):
+            txt = txt.decode('utf-8')
+        data = txt.encode('utf-8')
+        frags = []
+        start = 0
+        while start < len(data):
+            end = min(start + max_bytes, len(data))
+            # back off until we are not in the middle of a utf-8 sequence
+            while end < len(data) and ord(data[end:end+1]) & 0xC0 == 0x80:
+                end -= 1
+            frags.append(data[start:end].decode('utf-8'))
+            start = end
         splits = OrderedDict()
-        frags = [txt[i:i+max_elems] for i in range(0, len(txt), max_elems)]
         # pad each key name to the minimum necessary length
         padding = len(str(len(frags)))  # think about it :)
         for count, frag in enumerate(frags):
             splits['controltxt%s' % str(count).zfill(padding)] = frag
         return splits
 
+    def _pack_control_text(self, txt):
+        """Return the full set of attributes used to store a control
+        message: the controltxtNN fragments themselves, the format they
+        were written in and the number of fragments, so that readers
+        can ignore any stale fragments left behind by older writers.
+        """
+        if self.control_format == 'zlib':
+            if not isinstance(txt, text_type):
+                txt = txt.decode('utf-8')
+            txt = b64encode(zlib.compress(txt.encode('utf-8'))).decode('ascii')
+        attrs = self._split_control_text(txt)
+        attrs['controlfrags'] = str(len(attrs))
+        attrs['controlfmt'] = self.control_format
+        return attrs
+
+    def _unpack_control_text(self, item):
+        """Re-assemble the control message stored in an item, whether it
+        was written by _pack_control_text() or by the old fixed-width
+        splitter (which recorded neither a format nor a fragment count).
+
+        A client that predates controlfrags can rewrite an item written
+        by _pack_control_text(), leaving behind a controlfrags and
+        controlfmt that no longer describe its control text. When the
+        fragments present do not match them, they are read the old way.
+        """
+        frags = sorted(x for x in item if x.startswith('controltxt'))
+        if 'controlfrags' in item:
+            count = int(item['controlfrags'])
+            padding = len(str(count))
+            named = ['controltxt%s' % str(x).zfill(padding)
+                     for x in range(count)]
+            runs = _control_runs(item)
+            # a complete set of fragments of another width
+            legacy = [runs[x] for x in sorted(runs) if x != padding]
+            if not legacy and all(x in item for x in named):
+                control_txt = ''.join(item[x] for x in named)
+                if item.get('controlfmt') != 'zlib':
+                    return control_txt
+                try:
+                    return zlib.decompress(
+                        b64decode(control_txt)).decode('utf-8')
+                except (ValueError, zlib.error):
+                    # plain text of the same width
+                    pass
+            self._log.warning('The control text of %s %s in %s does not '
+                              'match its controlfrags; reading it as '
+                              'written by an older client', item.get('name'),
+                              item.get('version'), item.get('distribution'))
+            if legacy:
+                frags = legacy[-1]
+            elif padding in runs:
+                frags = runs[padding]
+        return ''.join(item[x] for x in frags)
+
+    def _repack_control_text(self, item):
+        """Migration: re-pack the control text of an item written by an
+        older version of repoman (or with a different control format).
+
+        :returns: None if the item is already current, otherwise a tuple
+                  of (attributes to put, attribute names to delete)
+        """
+        packed = self._pack_control_text(self._unpack_control_text(item))
+        current = dict(
+            (k, v) for k, v in iteritems(item)
+            if k.startswith('controltxt') or
+            k in ('controlfmt', 'controlfrags'))
+        if current == dict(packed):
+            return None
+        stale = [k for k in current if k not in packed]
+        return packed, stale
+
     def _build_dist_release(self, dist, origin, comps=[], archs=[], date=None):
         self._log.debug('assembling release file for %s', dist)
         if not archs:
@@ -558,11 +1614,15 @@ class Repodb(object):
             ))
 
     def _create_pkg_msg_from_item(self, item, dist):
-        message = 'Filename: pool/%s/%s/%s/%s\n' % (
-            dist,
-            item['name'][0],
-            item['name'],
-            item['filename'])
+        if 'pooldir' in item:
+            message = 'Filename: %s/%s\n' % (item['pooldir'],
+                                             item['filename'])
+        else:
+            message = 'Filename: pool/%s/%s/%s/%s\n' % (
+                dist,
+                item['name'][0],
+                item['name'],
+                item['filename'])
         message += 'MD5sum: %s\n' % item['md5']
         message += 'SHA1: %s\n' % item['sha1']
         message += 'SHA256: %s\n' % item['sha256']
@@ -570,14 +1630,7 @@ class Repodb(object):
         # re-assemble control text from all fragments
         # this has to go last, as the control message
         # might have trailing newlines
-        control_frags = []
-        control_txt = ''
-        for attr in item:
-            if attr.startswith('controltxt'):
-                control_frags.append(attr)
-        for attr in sorted(control_frags):
-            control_txt += item[attr]
-        message += control_txt + '\n'
+        message += self._unpack_control_text(item) + '\n'
         return message
 
     def _build_package_files(self, dists):
@@ -590,8 +1643,7 @@ class Repodb(object):
         archs = set(self.archs)
         archs.remove('source')
         query = self._create_sorted_package_dict(
-            self._select(self._assemble_select_query(
-                dists=dists, comps=self.comps, archs=archs)))
+            self._find_items(dists=dists, comps=self.comps, archs=archs))
         # iterate over every package returned by simpledb;
         # sort them into a nested dictionary:
         # {dist: {comp: {arch: 'Packages.txt'}}}
@@ -616,21 +1668,17 @@ class Repodb(object):
         return package_files
 
     def _create_src_msg_from_item(self, item, dist):
-        message = 'Directory: pool/%s/%s/%s\n' % (
-            dist,
-            item['name'][0],
-            item['name'])
+        if 'pooldir' in item:
+            message = 'Directory: %s\n' % item['pooldir']
+        else:
+            message = 'Directory: pool/%s/%s/%s\n' % (
+                dist,
+                item['name'][0],
+                item['name'])
         message += 'Package: %s\n' % item['name']
         # re-assemble message text from all fragments. this has to go last, as
         # the message might have trailing newlines
-        control_frags = []
-        control_txt = ''
-        for attr in item:
-            if attr.startswith('controltxt'):
-                control_frags.append(attr)
-        for attr in sorted(control_frags):
-            control_txt += item[attr]
-        message += control_txt + '\n'
+        message += self._unpack_control_text(item) + '\n'
         return message
 
     def _build_source_files(self, dists):
@@ -641,8 +1689,7 @@ class Repodb(object):
             lambda: defaultdict(lambda: defaultdict(lambda: '')))
         # get all sources for the dists we are publishing
         query = self._create_sorted_package_dict(
-            self._select(self._assemble_select_query(
-                dists=dists, comps=self.comps, archs=['source'])))
+            self._find_items(dists=dists, comps=self.comps, archs=['source']))
         # iterate over every package returned by simpledb;
         # sort them into a nested dictionary:
         # {dist: {comp: {'source': 'Sources.txt'}}}
@@ -837,30 +1884,23 @@ class Repodb(object):
         them into a nested dict in the form:
             {name: {dist: {comp: {arch: [item, item...]}}}}
         ...then sort each list of items at the tree leaves from
-        lowest to highest by debian package version sorting order."""
+        lowest to highest by debian package version sorting order.
+
+        The items are converted to (compact) PackageItems and grouped in a
+        flat index keyed by leaf on the way in; the tree is only built
+        once every leaf has been sorted and pruned."""
         self._log.debug('latest: %d', latest_versions)
+        leaves = defaultdict(list)
+        for pkg in sources:
+            if not isinstance(pkg, PackageItem):
+                pkg = PackageItem(pkg)
+            leaves[pkg.leaf].append(pkg)
         sorted_sources = defaultdict(lambda: defaultdict(
             lambda: defaultdict(lambda: defaultdict(list))))
-        for pkg in sources:
-            sorted_sources[pkg['name']][
-                pkg['distribution']][
-                    pkg['component']][pkg['architecture']].append(pkg)
-        for name, dists in iteritems(sorted_sources):
-            for dist, comps in iteritems(dists):
-                for comp, archs in iteritems(comps):
-                    for arch, pkgs in iteritems(archs):
-                        ct = len(pkgs)
-                        pkgs.sort(key=lambda x:
-                                  Dpkg.compare_versions_key(x['version']))
-                        self._log.debug('len pkgs: %d', ct)
-                        if latest_versions > 0:
-                            # prune to only the N most "recent" packages
-                            sorted_sources[name][dist][comp][arch] = (
-                                pkgs[-latest_versions:])
-                        elif (latest_versions < 0 and -latest_versions-1 < ct):
-                            # prune to ALL BUT the N most "recent" packages
-                            sorted_sources[name][dist][comp][arch] = (
-                                pkgs[:latest_versions])
+        for (name, dist, comp, arch), pkgs in iteritems(leaves):
+            self._log.debug('len pkgs: %d', len(pkgs))
+            sorted_sources[name][dist][comp][arch] = latest_items(
+                pkgs, latest_versions)
         return sorted_sources
 
     def _check_spec(self, sources, targets):
@@ -895,6 +1935,15 @@ class Repodb(object):
                 'with as much detail as you can provide')
         return True
 
+    def _walk_leaves(self, ndcai):
+        """Like _walk_ndcai(), but yield the lists of items at each leaf
+        of the nested dictionary, as (name, dist, comp, arch, items)."""
+        for name, dists in iteritems(ndcai):
+            for dist, comps in iteritems(dists):
+                for comp, archs in iteritems(comps):
+                    for arch, items in iteritems(archs):
+                        yield (name, dist, comp, arch, items)
+
     def _walk_ndcai(self, ndcai, enumerate_items=False):
         """Multiple functions in this object have to unspool
         a nested dictionary in the form of:
@@ -925,7 +1974,7 @@ class Repodb(object):
 
     def add_meta(self, archs=[], dists=[], comps=[],
                  topic_name='', origin='', label='',
-                 test_data=''):
+                 test_data='', fields=[]):
         if archs:
             self._log.info('Adding architectures: %s', archs)
         if dists:
@@ -940,11 +1989,17 @@ class Repodb(object):
             self._log.info('Setting repository label: %s', label)
         if test_data:
             self._log.info('Writing test data to repo: %s', test_data)
-        return self._create_meta(dists, comps, archs,
-                                 topic_name, origin, label, test_data)
+        if fields:
+            self._log.info('Indexing control fields: %s', fields)
+        response = self._create_meta(dists, comps, archs,
+                                     topic_name, origin, label, test_data,
+                                     fields=fields)
+        if dists and self.shard_map == 'dist':
+            self._create_shard_domains()
+        return response
 
     def rm_meta(self, archs=[], dists=[], comps=[],
-                topic_name=False, test_data=False):
+                topic_name=False, test_data=False, fields=[]):
         if archs:
             self._log.info('Deleting architectures: %s', archs)
         if dists:
@@ -955,7 +2010,10 @@ class Repodb(object):
             self._log.info('Deleting SNS topic for logging')
         if test_data:
             self._log.info('Deleting test data from repo')
-        return self._delete_meta(dists, comps, archs, topic_name, test_data)
+        if fields:
+            self._log.info('No longer indexing control fields: %s', fields)
+        return self._delete_meta(dists, comps, archs, topic_name, test_data,
+                                 fields=fields)
 
     def find_invalid_metadata(self, candidates, metadata_type):
         """Check that each member of a list of possible repository
@@ -1020,6 +2078,52 @@ class Repodb(object):
                 unrecognized)
         return True
 
+    def check_valid_fields(self, fields=[]):
+        """Assert that each member of the list `fields` is a control field
+        this repo is currently configured to index; otherwise raise
+        InvalidFieldError.
+
+        :param fields: list
+        :returns: true
+        :raises: InvalidFieldError
+        """
+        indexed = [field_attribute(x) for x in self.fields]
+        unrecognized = [x for x in fields
+                        if field_attribute(x) not in indexed]
+        if unrecognized:
+            raise InvalidFieldError(
+                'control fields %s are not currently indexed by this repo' %
+                unrecognized)
+        return True
+
+    def _extract_fields(self, control_txt):
+        """Return the values of the control fields this repo indexes as
+        a dict of simpledb attributes. Relationship fields (Depends,
+        Source and the like) are reduced to the names of the packages they
+        refer to; other fields are stored verbatim.
+
+        :param control_txt: string, a debian control message
+        :rtype: dict
+        """
+        message = message_from_string(control_txt)
+        attrs = {}
+        for field in self.fields:
+            value = message.get(field)
+            if value is None:
+                continue
+            if field.lower() in RELATIONSHIP_FIELDS:
+                values = sorted(set(_relationship_names(value)))
+            else:
+                values = [value.strip()]
+            # fields too long for a simpledb attribute are not indexed
+            values = [x for x in values
+                      if len(x.encode('utf-8')) <= MAX_ATTRIBUTE_BYTES]
+            if len(values) == 1:
+                attrs[field_attribute(field)] = values[0]
+            elif values:
+                attrs[field_attribute(field)] = values
+        return attrs
+
     def add_package(self, pkg, dists=[], comps=[],
                     overwrite=False, auto_purge=0):
         """Import the metadata from a pydpkg.Dpkg object as a
@@ -1032,52 +2136,10 @@ class Repodb(object):
         :param overwrite: bool
         :param auto_purge: int
         """
-        pkg_name = pkg.get_header('package')
-        pkg_file = os.path.basename(pkg.filename)
-        control_str = str(pkg.message.as_string())
-        pkg_arch = pkg.get_header('architecture')
-        self.check_valid_archs([pkg_arch])
-        self.check_valid_dists(dists)
-        self.check_valid_comps(comps)
-        for dist in dists:
-            for comp in comps:
-                attrs = {'name': pkg_name,
-                         'filename': pkg_file,
-                         'distribution': dist,
-                         'component': comp,
-                         'version': pkg.version,
-                         'architecture': pkg_arch,
-                         'md5': pkg.md5,
-                         'sha1': pkg.sha1,
-                         'sha256': pkg.sha256,
-                         'size': str(pkg.filesize)}
-                attrs.update(self._split_control_text(control_str))
-                self._log.debug('attrs: %s', attrs)
-                key_name = self._compute_keyname_from_item(attrs)
-                self._log.debug('key name: %s', key_name)
-                if self._item_exists(key_name) and not overwrite:
-                    raise ItemExistsError(
-                        'Package %s version %s in distribution % and '
-                        'component %s already exists in simpledb',
-                        pkg_name, pkg.version, dist, comp)
-                self._put_attributes(key_name, attrs)
-                self._send_notifications([
-                    {'action': 'add', 'type': 'package',
-                     'name': attrs['name'],
-                     'version': attrs['version'],
-                     'distribution': attrs['distribution'],
-                     'component': attrs['component'],
-                     'caller': self.connection.caller_id}])
-                if auto_purge > 0:
-                    self._log.warning(
-                        'Automatically purging %d oldest versions of %s '
-                        'in the %s distribution, %s component and %s '
-                        'architecture.', auto_purge, pkg_name, dist,
-                        comp, pkg_arch)
-                    targets = self.get_candidates(
-                        dist, comp, names=[pkg_name], archs=[pkg_arch],
-                        latest_versions=-auto_purge)
-                    self.do_rm(targets)
+        spec = package_attrs(pkg)
+        self.check_valid_archs([spec['architecture']])
+        self._raise_first(self.add_items(
+            [spec], dists, comps, overwrite, auto_purge))
 
     def add_source(self, dsc, dists=[], comps=[], overwrite=False,
                    auto_purge=0):
@@ -1085,59 +2147,222 @@ class Repodb(object):
         simpledb item for each of the specified distributions
         and components.
 
-        Annoyingly, debian dsc messages are juuuuust different
-        enough from binary ones that this has to be a special case.
-
         :param dsc: a pydpkg.Dsc object
         :param dists: list of strings
         :param comps: list of strings
         :param overwrite: bool
         :param auto_purge: int
         """
-        # blow up immediately if the source bundle is incomplete
-        # or corrupt
-        dsc.validate()
-        dsc_arch = 'source'
-        dsc_name = dsc.source
-        source_files = [os.path.basename(x) for x in dsc.source_files]
-        message_str = dsc.message_str
+        self._raise_first(self.add_items(
+            [source_attrs(dsc)], dists, comps, overwrite, auto_purge))
+
+    def _raise_first(self, errors):
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def add_items(self, specs, dists=[], comps=[], overwrite=False,
+                  auto_purge=0):
+        """Write the simpledb items of any number of packages, each to every
+        one of the specified distributions and components, under a single
+        repository generation. A spec is the output of package_attrs() or
+        source_attrs(); the caller is expected to have checked that its
+        architecture is valid.
+
+        Unless overwrite is set, every item is written with its own
+        conditional put (simpledb cannot batch those), concurrently;
+        otherwise the items are written in batches.
+
+        :param specs: list of dicts
+        :param dists: list of strings
+        :param comps: list of strings
+        :param overwrite: bool
+        :param auto_purge: int
+        :returns: for each spec, None or the exception that stopped any of
+                  its items from being written
+        :rtype: list
+        """
         self.check_valid_dists(dists)
         self.check_valid_comps(comps)
-        for dist in dists:
-            for comp in comps:
-                attrs = {'name': dsc_name,
-                         'files': source_files,  # nb: this will be a list
-                         'distribution': dist,
-                         'component': comp,
-                         'version': dsc.version,
-                         'architecture': dsc_arch}
-                attrs.update(self._split_control_text(message_str))
-                self._log.debug('attrs: %s', attrs)
-                key_name = self._compute_keyname_from_item(attrs)
-                self._log.debug('key name: %s', key_name)
-                if self._item_exists(key_name) and not overwrite:
-                    raise ItemExistsError(
-                        'Source package %s version %s in distribution % and '
-                        'component %s already exists in simpledb',
-                        dsc_name, dsc.version, dist, comp)
-                self._put_attributes(key_name, attrs)
-                self._send_notifications([
-                    {'action': 'add', 'type': 'source',
-                     'name': dsc_name,
+        generation = self._next_generation()
+        items = []
+        for idx, spec in enumerate(specs):
+            base = dict((k, v) for k, v in iteritems(spec) if k != 'control')
+            base['versionkey'] = encode_version(spec['version'])
+            base['generation'] = generation
+            base.update(self._pack_control_text(spec['control']))
+            base.update(self._extract_fields(spec['control']))
+            for dist in dists:
+                for comp in comps:
+                    attrs = dict(base, distribution=dist, component=comp)
+                    key_name = self._compute_keyname_from_item(attrs)
+                    self._log.debug('key name: %s attrs: %s', key_name, attrs)
+                    items.append((idx, key_name, attrs))
+        errors = [None] * len(specs)
+        added = set()
+        written = []
+        changes = []
+        try:
+            if overwrite:
+                results = self._put_item_batches(items)
+            else:
+                results = self._parallel(self._put_new_item_result, items)
+            notifications = []
+            for (idx, key_name, attrs), error in zip(items, results):
+                if error is not None:
+                    errors[idx] = errors[idx] or error
+                    continue
+                added.add(specs[idx]['name'])
+                written.append((self._shard_for(key_name,
+                                                attrs['distribution']),
+                                key_name))
+                changes.append(self._change_record('add', attrs))
+                notifications.append(
+                    {'action': 'add',
+                     'type': 'source' if 'files' in attrs else 'package',
+                     'name': attrs['name'],
                      'version': attrs['version'],
-                     'distribution': dist,
-                     'component': comp,
-                     'caller': self.connection.caller_id}])
-                if auto_purge > 0:
-                    self._log.warning(
-                        'Automatically purging %d oldest versions of %s '
-                        'in the %s distribution, %s component and %s '
-                        'architecture.', auto_purge, dsc_name, dist,
-                        comp, dsc_arch)
-                    targets = self.get_candidates(
-                        dist, comp, names=[dsc_name], archs=[dsc_arch],
-                        latest_versions=-auto_purge)
-                    self.do_rm(targets)
+                     'distribution': attrs['distribution'],
+                     'component': attrs['component'],
+                     'caller': self.connection.caller_id})
+            self._send_notifications(notifications)
+        finally:
+            if written:
+                self._index_names(added)
+                self._bump_generation(written, changes=changes)
+        if auto_purge > 0:
+            self.purge(
+                [(spec['name'], dist, comp, spec['architecture'])
+                 for idx, spec in enumerate(specs) if errors[idx] is None
+                 for dist in dists for comp in comps], auto_purge)
+        return errors
+
+    def _put_new_item_result(self, item):
+        idx, key_name, attrs = item
+        try:
+            self._put_new_item(key_name, attrs)
+        except (ItemExistsError, ClientError) as ex:
+            return ex
+        return None
+
+    def _put_item_batches(self, items):
+        """Unconditionally write (idx, key, attrs) tuples, BATCH_SIZE at a
+        time per domain; return the error of each write, if any."""
+        by_domain = defaultdict(list)
+        for pos, (idx, key_name, attrs) in enumerate(items):
+            by_domain[self._shard_for(
+                key_name, attrs['distribution'])].append(pos)
+        batches = [(domain, positions[x:x + BATCH_SIZE])
+                   for domain, positions in sorted(iteritems(by_domain))
+                   for x in range(0, len(positions), BATCH_SIZE)]
+
+        def put_batch(batch):
+            domain, positions = batch
+            try:
+                self.sdb.batch_put_attributes(
+                    DomainName=domain,
+                    Items=[{'Name': items[x][1],
+                            'Attributes': self._respool_attributes(
+                                items[x][2], True)}
+                           for x in positions])
+            except ClientError as ex:
+                return positions, ex
+            return positions, None
+        results = [None] * len(items)
+        for positions, error in self._parallel(put_batch, batches):
+            for pos in positions:
+                results[pos] = error
+        return results
+
+    def purge(self, leaves, keep):
+        """Delete all but the `keep` newest versions of the packages in
+        each of a set of (name, dist, comp, arch) leaves: the automatic
+        purge that follows adding or copying packages.
+
+        The versions of every leaf are fetched with a single query per
+        domain and batch of names, the versions to delete are worked out
+        locally, and they are deleted in batches.
+
+        :param leaves: iterable of (name, dist, comp, arch) tuples
+        :param keep: int
+        :returns: the number of items deleted
+        :rtype: int
+        """
+        leaves = set(leaves)
+        if not leaves or keep < 1:
+            return 0
+        names = sorted(set(x[0] for x in leaves))
+        dists = sorted(set(x[1] for x in leaves))
+        comps = sorted(set(x[2] for x in leaves))
+        archs = sorted(set(x[3] for x in leaves))
+        self._log.warning(
+            'Automatically purging all but the %d newest versions of %d '
+            'packages in %d distributions, components and architectures.',
+            keep, len(names), len(leaves))
+        queries = [self._assemble_select_query(
+            names=names[x:x + MAX_COMPARISONS], dists=dists, comps=comps,
+            archs=archs, attributes=LEAF_ATTRIBUTES, domain=domain)
+            for domain in self._domains_for(dists)
+            for x in range(0, len(names), MAX_COMPARISONS)]
+        # the purge must see what was just added or copied
+        results = self._parallel(
+            lambda query: list(self._select(query, consistent_read=True)),
+            queries)
+        found = defaultdict(list)
+        for item in self._dedupe(itertools.chain.from_iterable(results)):
+            leaf = (item['name'], item['distribution'], item['component'],
+                    item['architecture'])
+            if leaf in leaves:
+                found[leaf].append(item)
+        targets = []
+        for leaf in sorted(found):
+            if len(found[leaf]) > keep:
+                targets.extend(sort_items(found[leaf])[:-keep])
+        self._delete_item_batches(targets)
+        return len(targets)
+
+    def _delete_item_batches(self, items):
+        """Delete package items, BATCH_SIZE at a time per domain, and
+        record and announce their deletion."""
+        if not items:
+            return
+        by_domain = defaultdict(list)
+        changes = []
+        for item in items:
+            self._log.warning(
+                'Deleting pkg %s version %s in distribution '
+                '%s component %s architecture %s',
+                item['name'], item['version'],
+                item['distribution'], item['component'],
+                item['architecture'])
+            key = self._compute_keyname_from_item(item)
+            for shard_map in (self.shard_map, self.rebalancing_from):
+                if shard_map is not None:
+                    domain = self._shard_for(key, item['distribution'],
+                                             shard_map)
+                    if key not in by_domain[domain]:
+                        by_domain[domain].append(key)
+            changes.append(self._change_record('delete', item))
+        batches = [(domain, keys[x:x + BATCH_SIZE])
+                   for domain, keys in sorted(iteritems(by_domain))
+                   for x in range(0, len(keys), BATCH_SIZE)]
+        try:
+            self._parallel(
+                lambda batch: self.sdb.batch_delete_attributes(
+                    DomainName=batch[0],
+                    Items=[{'Name': x} for x in batch[1]]),
+                batches)
+        finally:
+            # a partial delete is still a delete: caches have to start over
+            self._bump_generation(purged=True, changes=changes)
+        self._send_notifications([
+            {'action': 'delete', 'type': 'package',
+             'name': item['name'],
+             'version': item['version'],
+             'distribution': item['distribution'],
+             'component': item['component'],
+             'caller': self.connection.caller_id} for item in items])
+        self._unindex_names(sorted(set(x['name'] for x in items)))
 
     def publish(self, repo, dists=[],
                 gpg_home='~/.gnupg', gpg_signers=[], gpg_passphrases=[]):
@@ -1188,7 +2413,8 @@ class Repodb(object):
         return retval
 
     def query(self, names=[], dists=[], comps=[], archs=[], versions=[],
-              latest_versions=0, name_wildcard=False):
+              latest_versions=0, name_wildcard=False, fields={},
+              tiers=('hot',)):
         """
         A friendly wrapper around repodb._assemble_select_query() and
         _create_sorted_package_dict() that returns a nested dictionary of
@@ -1205,8 +2431,12 @@ class Repodb(object):
         :param versions: list of strings
         :param latest_versions: int
         :param name_wildcard: bool
+        :param fields: dict of control field names to lists of values
+        :param tiers: tuple of TIERS to read from
         :rtype: dict
         """
+        if fields:
+            self.check_valid_fields(fields)
         if dists:
             self.check_valid_dists(dists)
             if isinstance(dists, str):
@@ -1219,20 +2449,109 @@ class Repodb(object):
             self.check_valid_archs(archs)
             if isinstance(archs, str):
                 archs = [archs]
-        query_str = self._assemble_select_query(
-            names=names,
-            dists=dists,
-            comps=comps,
-            archs=archs,
-            versions=versions,
-            name_wildcard=name_wildcard)
+        leaves = self._pushdown_leaves(names, dists, comps, archs,
+                                       name_wildcard)
+        if (latest_versions and leaves and
+                (self.cache is None or 'archive' in tiers) and
+                self.versions_encoded and
+                abs(latest_versions) <= MAX_SELECT_LIMIT):
+            # let simpledb do the sorting and pruning
+            return self._create_sorted_package_dict(
+                self._find_latest_items(
+                    leaves,
+                    versions=versions,
+                    latest_versions=latest_versions,
+                    fields=fields,
+                    tiers=tiers))
         return self._create_sorted_package_dict(
-            self._select(query_str),
+            self._find_items(
+                names=names,
+                dists=dists,
+                comps=comps,
+                archs=archs,
+                versions=versions,
+                name_wildcard=name_wildcard,
+                fields=fields,
+                tiers=tiers),
             latest_versions)
 
+    @property
+    def versions_encoded(self):
+        """Whether every package item carries a versionkey attribute"""
+        return 'encode-versions' in self.applied_migrations
+
+    def _pushdown_leaves(self, names, dists, comps, archs, name_wildcard):
+        """Return the (name, dist, comp, arch) tuples a query covers, if
+        they are all named and there are at most MAX_PUSHDOWN_LEAVES of
+        them, otherwise None: finding out which leaves a broader query
+        covers takes a scan of every matching item, which might as well
+        read the items in full."""
+        if name_wildcard or not (names and dists and comps and archs):
+            return None
+        names, dists, comps, archs = [
+            sorted(set(x)) for x in (names, dists, comps, archs)]
+        if (len(names) * len(dists) * len(comps) * len(archs) >
+                MAX_PUSHDOWN_LEAVES):
+            return None
+        return list(itertools.product(names, dists, comps, archs))
+
+    def _find_latest_in_leaf(self, leaf, versions=[], latest_versions=1,
+                             fields={}, tiers=('hot',)):
+        """Return the N newest package items in a single leaf or, if N is
+        negative, all but the N newest."""
+        name, dist, comp, arch = leaf
+        filters = {'names': [name], 'dists': [dist], 'comps': [comp],
+                   'archs': [arch], 'versions': versions, 'fields': fields}
+        # under a hash shard map a leaf is spread over every shard, so
+        # take the newest N from each and merge
+        domains = self._domains_for([dist], tiers)
+        count = abs(latest_versions)
+        if latest_versions > 0:
+            return self._merge_newest(
+                [self._select_first(self._assemble_select_query(
+                    latest_versions=count, domain=domain, **filters), count)
+                 for domain in domains], count)
+        newest = self._merge_newest(
+            [self._select_first(self._assemble_select_query(
+                latest_versions=count, attributes=LEAF_ATTRIBUTES,
+                domain=domain, **filters), count)
+             for domain in domains], count)
+        if len(newest) < count:
+            return []
+        return list(self._dedupe(itertools.chain.from_iterable(
+            self._select(self._assemble_select_query(
+                older_than=newest[-1]['versionkey'], domain=domain,
+                **filters))
+            for domain in domains)))
+
+    def _merge_newest(self, results, count):
+        if len(results) == 1:
+            return results[0]
+        merged = sorted(self._dedupe(itertools.chain.from_iterable(results)),
+                        key=lambda x: x['versionkey'], reverse=True)
+        return merged[:count]
+
+    def _find_latest_items(self, leaves, versions=[], latest_versions=1,
+                           fields={}, tiers=('hot',)):
+        """The equivalent of _create_sorted_package_dict(_find_items(...),
+        latest_versions) for a handful of known leaves (see
+        _pushdown_leaves()) that sorts and prunes on the simpledb side
+        using the versionkey attribute, one leaf at a time, so that only
+        the items returned are ever read in full.
+
+        :param leaves: list of (name, dist, comp, arch) tuples
+        :rtype: list
+        """
+        results = self._parallel(
+            lambda leaf: self._find_latest_in_leaf(
+                leaf, versions, latest_versions, fields, tiers),
+            leaves)
+        return list(itertools.chain.from_iterable(results))
+
     def get_candidates(self, src_dist, src_comp,
                        names=[], versions=[], archs=[],
-                       latest_versions=0, name_wildcard=False):
+                       latest_versions=0, name_wildcard=False,
+                       tiers=('hot',)):
         """
         A small wrapper around repodb.query() that ensures we are only
         passing in a single distribution and/or component, since
@@ -1245,6 +2564,7 @@ class Repodb(object):
         :param archs: list of strings
         :param latest_versions: int
         :param name_wildcard: bool
+        :param tiers: tuple of TIERS to look for packages in
         :rtype: dict
         :raises: InvalidDistributionError, InvalidComponentError
         """
@@ -1263,12 +2583,13 @@ class Repodb(object):
             archs=archs,
             versions=versions,
             latest_versions=latest_versions,
-            name_wildcard=name_wildcard)
+            name_wildcard=name_wildcard,
+            tiers=tiers)
         return sources
 
     def get_copy_spec(self, candidates, src_dist, src_comp,
                       dst_dist=None, dst_comp=None,
-                      prune_for_promote=False):
+                      prune_for_promote=False, from_archive=False):
         """Given a nested dict of source packages for copying,
         compute an equivalent nested dict of new package items to
         create, and prune no-ops from both the source and the
@@ -1277,6 +2598,9 @@ class Repodb(object):
         If prune_for_promote is true, prune from the source side
         any packages that are older, version-wise, than the newest
         package on the destination side.
+
+        If from_archive is true, the candidates came from the archive,
+        so copying them to where they already are restores them.
         """
         # if no destination distribution or component is specified, then
         # the move is within the source dist/comp
@@ -1286,108 +2610,198 @@ class Repodb(object):
         self.check_valid_comps([dst_comp])
         existing = self.get_candidates(
             dst_dist, dst_comp, names=candidates.keys())
+        # index what is already at the destination by item identity (the
+        # inputs of _compute_keyname()), and note the newest version of
+        # each package and architecture there, for promotions
+        at_target = {}
+        latest = {}
+        for name, dist, comp, arch, item in self._walk_ndcai(existing):
+            at_target[(name, item['version'], arch)] = item
+        for name, dists in iteritems(existing):
+            for arch, items in iteritems(
+                    dists.get(dst_dist, {}).get(dst_comp, {})):
+                if items:
+                    latest[(name, arch)] = items[-1]['version']
         targets = defaultdict(
             lambda: defaultdict(
                 lambda: defaultdict(lambda: defaultdict(list))))
-        # what's an o(n^4) between friends?
-        for name, dist, comp, arch, idx, old in self._walk_ndcai(
-                candidates, enumerate_items=True):
-            new = deepcopy(old)
-            new['distribution'] = dst_dist or new['distribution']
-            new['component'] = dst_comp or new['component']
-            if new == old:
-                self._log.debug('Same as source: %s', new)
-                candidates[name][dist][comp][arch][idx] = None
-                continue
-            if new in existing[name][dist][comp][arch]:
-                self._log.debug('Already at target: %s', new)
-                candidates[name][dist][comp][arch][idx] = None
-                continue
-            if prune_for_promote:
-                # if the old version < the newest available
-                # version on the destination side (if there are
-                # any), we are not a candidate for promotion
-                if existing[name][dst_dist][dst_comp][arch]:
-                    latest = existing[name][dst_dist][dst_comp][arch][-1]
-                    res = Dpkg.compare_versions(
-                        latest['version'], new['version'])
-                    if res >= 0:
-                        self._log.warning('skipping')
-                        candidates[name][dist][comp][arch][idx] = None
-                        continue
-            targets[name][dist][comp][arch].append(new)
+        # one pass over the candidates, keeping those that are not no-ops
+        for name, dist, comp, arch, olds in self._walk_leaves(candidates):
+            kept = []
+            news = targets[name][dist][comp][arch]
+            for old in olds:
+                if not isinstance(old, PackageItem):
+                    old = PackageItem(old)
+                if (old.distribution, old.component) == (
+                        dst_dist, dst_comp) and not from_archive:
+                    self._log.debug('Same as source: %s', old)
+                    continue
+                there = at_target.get((name, old.version, old.architecture))
+                if there is not None and _same_files(there, old):
+                    self._log.debug('Already at target: %s', old)
+                    continue
+                # if the old version < the newest available version on
+                # the destination side (if there are any), we are not a
+                # candidate for promotion
+                if prune_for_promote and (name, arch) in latest and \
+                        compare_versions(latest[(name, arch)],
+                                         old.version) >= 0:
+                    self._log.warning('skipping')
+                    continue
+                kept.append(old)
+                news.append(old.copy(distribution=dst_dist,
+                                     component=dst_comp))
             # prune no-ops from source side
-            if None in candidates[name][dist][comp][arch]:
-                candidates[name][dist][comp][arch].remove(None)
+            olds[:] = kept
         if self._check_spec(candidates, targets):
             return candidates, targets
 
-    def do_copy(self, candidates, targets, repo,
-                overwrite=False, auto_purge=0):
+    def do_copy(self, candidates, targets, repo, overwrite=False,
+                auto_purge=0, threads=COPY_THREADS, progress=None):
+        """Carry out the copies planned by get_copy_spec().
+
+        The S3 copies of the packages that change distribution (in the
+        'dist' pool layout) are run concurrently, on a pool of `threads`
+        threads with a Repo each. Then the items of every package whose
+        files all landed are written in batches, under a single repository
+        generation, and the notifications for them are sent at the end.
+        A package that cannot be copied is reported, and does not hold up
+        the others.
+
+        :param candidates: the first output of get_copy_spec()
+        :param targets: the second output of get_copy_spec()
+        :param repo: apt_repoman.repo.Repo
+        :param overwrite: bool
+        :param auto_purge: int
+        :param threads: int
+        :param progress: callable taking a stage ('copy' for S3 copies,
+                         'write' for simpledb writes), the number of
+                         things done in it so far and their total
+        :returns: a list of (target item, error) tuples for the items that
+                  were not copied
+        :rtype: list
+        """
+        progress = progress or (lambda stage, done, total: None)
+        copies = []
         for name, dist, comp, arch, idx, pkg in self._walk_ndcai(
                 targets, enumerate_items=True):
-            src_dist = candidates[name][dist][comp][arch][idx]['distribution']
-            src_comp = candidates[name][dist][comp][arch][idx]['component']
-            dst_dist = pkg['distribution']
-            if src_dist != dst_dist:
-                self._log.warning(
-                    'copy of package %s from distribution %s to '
-                    '%s requires an s3 copy',
-                    name, src_dist, dst_dist)
-                # handle both source and binary files
-                filenames = filter(
-                    None,
-                    itertools.chain([pkg.get('filename')],
-                                    pkg.get('files', [])))
-                for fn in filenames:
-                    old_path = os.path.join(
-                        'pool', src_dist, pkg['name'][0],
-                        pkg['name'], fn)
-                    new_path = os.path.join(
-                        'pool', dst_dist, pkg['name'][0],
-                        pkg['name'], fn)
-                    try:
-                        repo.copy_key(old_path, new_path, overwrite)
-                    except KeyExistsError:
-                        self._log.warning(
-                            'package already exists at s3://%s ',
-                            new_path)
+            src = candidates[name][dist][comp][arch][idx]
+            copies.append((pkg, src['distribution'], src['component'],
+                           self._pool_copies(pkg, src['distribution'])))
+        errors = self._copy_files([x[3] for x in copies], repo, overwrite,
+                                  threads, progress)
+        generation = self._next_generation()
+        items = []
+        for pos, (pkg, src_dist, src_comp, paths) in enumerate(copies):
+            if errors[pos] is not None:
+                continue
             self._log.info(
                 'creating package %s version %s '
                 'distribution %s component %s '
                 'architecture %s', pkg['name'],
                 pkg['version'], pkg['distribution'],
                 pkg['component'], pkg['architecture'])
-            key = self._compute_keyname_from_item(pkg)
-            self._put_attributes(key, pkg)
-            self._send_notifications([
-                {'action': 'copy', 'type': 'package',
-                 'name': pkg['name'],
-                 'version': pkg['version'],
-                 'dst_distribution': pkg['distribution'],
-                 'dst_component': pkg['component'],
-                 'src_distribution': src_dist,
-                 'src_component': src_comp,
-                 'caller': self.connection.caller_id}])
+            pkg['versionkey'] = encode_version(pkg['version'])
+            pkg['generation'] = generation
+            items.append((pos, self._compute_keyname_from_item(pkg), pkg))
+        written = []
+        changes = []
+        landed = set()
+        try:
+            progress('write', 0, len(items))
+            results = self._put_item_batches(items)
+            progress('write', len(items), len(items))
+            notifications = []
+            for (pos, key, pkg), error in zip(items, results):
+                if error is not None:
+                    errors[pos] = error
+                    continue
+                pkg, src_dist, src_comp, _ = copies[pos]
+                landed.add((pkg['name'], pkg['distribution'],
+                            pkg['component'], pkg['architecture']))
+                written.append((self._shard_for(key, pkg['distribution']),
+                                key))
+                changes.append(self._change_record(
+                    'copy', pkg, src_distribution=src_dist,
+                    src_component=src_comp))
+                notifications.append(
+                    {'action': 'copy', 'type': 'package',
+                     'name': pkg['name'],
+                     'version': pkg['version'],
+                     'dst_distribution': pkg['distribution'],
+                     'dst_component': pkg['component'],
+                     'src_distribution': src_dist,
+                     'src_component': src_comp,
+                     'caller': self.connection.caller_id})
+            self._send_notifications(notifications)
+        finally:
+            if written:
+                self._bump_generation(written, changes=changes)
         if auto_purge > 0:
-            for name, dists in iteritems(targets):
-                for dist, comps in iteritems(dists):
-                    for comp, archs in iteritems(comps):
-                        for arch, items in iteritems(archs):
-                            # horrible cheat here
-                            dst_dist = items[0]['distribution']
-                            dst_comp = items[0]['component']
-                            self._log.warning(
-                                'Automatically purging %d oldest versions of '
-                                '%s in the %s distribution, %s component and '
-                                '%s architecture.', auto_purge, name, dist,
-                                comp, arch)
-                            purge_targets = self.get_candidates(
-                                dst_dist, dst_comp, names=[name], archs=[arch],
-                                latest_versions=-auto_purge)
-                            self.do_rm(purge_targets)
+            self.purge(landed, auto_purge)
+        return [(copies[pos][0], error) for pos, error in enumerate(errors)
+                if error is not None]
+
+    def _pool_copies(self, pkg, src_dist):
+        """Return the (old path, new path) tuples of the S3 copies that
+        copying a package from `src_dist` takes."""
+        dst_dist = pkg['distribution']
+        # packages in the hash pool layout are in every dist already
+        if src_dist == dst_dist or 'pooldir' in pkg:
+            return []
+        self._log.warning(
+            'copy of package %s from distribution %s to '
+            '%s requires an s3 copy',
+            pkg['name'], src_dist, dst_dist)
+        # handle both source and binary files
+        filenames = filter(
+            None,
+            itertools.chain([pkg.get('filename')],
+                            pkg.get('files', [])))
+        return [(os.path.join('pool', src_dist, pkg['name'][0],
+                              pkg['name'], fn),
+                 os.path.join('pool', dst_dist, pkg['name'][0],
+                              pkg['name'], fn))
+                for fn in filenames]
+
+    def _copy_files(self, copies, repo, overwrite, threads, progress):
+        """Run lists of S3 copies concurrently; return, for each list,
+        None or the error of the first of its copies that failed."""
+        jobs = [(pos, old_path, new_path)
+                for pos, paths in enumerate(copies)
+                for old_path, new_path in paths]
+        errors = [None] * len(copies)
+        if not jobs:
+            return errors
+
+        def copy_file(worker, job):
+            pos, old_path, new_path = job
+            try:
+                worker.copy_key(old_path, new_path, overwrite)
+            except KeyExistsError:
+                self._log.warning(
+                    'package already exists at s3://%s ', new_path)
+            except (KeyNotFoundError, ClientError) as ex:
+                return pos, ex
+            return pos, None
+        progress('copy', 0, len(jobs))
+        for done, (pos, error) in enumerate(map_with_clones(
+                repo, copy_file, jobs, threads, ordered=False), 1):
+            errors[pos] = errors[pos] or error
+            progress('copy', done, len(jobs))
+        return errors
 
     def do_rm(self, targets):
+        changes = []
+        try:
+            self._delete_items(targets, changes)
+        finally:
+            # a partial delete is still a delete: caches have to start over
+            if targets:
+                self._bump_generation(purged=True, changes=changes)
+        self._unindex_names([x['name'] for x in changes])
+
+    def _delete_items(self, targets, changes):
         for name, dist, comp, arch, item in self._walk_ndcai(targets):
             self._log.warning(
                 'Deleting pkg %s version %s in distribution '
@@ -1396,6 +2810,7 @@ class Repodb(object):
                 item['distribution'], item['component'],
                 item['architecture'])
             self._delete_item(item)
+            changes.append(self._change_record('delete', item))
             self._send_notifications([
                 {'action': 'delete', 'type': 'package',
                  'name': item['name'],
@@ -1403,3 +2818,327 @@ class Repodb(object):
                  'distribution': item['distribution'],
                  'component': item['component'],
                  'caller': self.connection.caller_id}])
+
+    @property
+    def applied_migrations(self):
+        return self.meta.get('migrations', [])
+
+    def rebalance(self, shard_map):
+        """Switch to a new shard map, moving every package item to the
+        domain it belongs in under that map. Until the move is complete,
+        reads look in the domains of both the old and new maps and writes
+        go to the new one; an interrupted rebalance can be resumed by
+        running it again with the same shard map.
+
+        :param shard_map: string, see SHARD_SCHEMES
+        :returns: the number of items moved
+        :rtype: int
+        :raises: InvalidShardMapError
+        """
+        if shard_map not in ('none', 'dist'):
+            _hash_shards(shard_map)
+        previous = self.rebalancing_from
+        if previous is None:
+            previous = self.shard_map
+            if previous == shard_map:
+                self._log.info('Shard map is already %s', shard_map)
+                return 0
+        elif shard_map != self.shard_map:
+            raise InvalidShardMapError(
+                'A rebalance from %s to %s is in progress: finish that '
+                'first' % (previous, self.shard_map))
+        self._create_shard_domains(shard_map)
+        self._put_attributes('meta', {'shard_map': shard_map,
+                                      'shard_map_from': previous})
+        self.meta['shard_map'] = [shard_map]
+        self.meta['shard_map_from'] = [previous]
+        moved = self._parallel(
+            lambda domain: self._move_items(domain, shard_map),
+            self._shard_domains(previous))
+        self._delete_attributes('meta', {'shard_map_from': previous})
+        del self.meta['shard_map_from']
+        return sum(moved)
+
+    def _move_items(self, domain, shard_map):
+        """Move the package items in `domain` that belong elsewhere under
+        `shard_map`, BATCH_SIZE at a time."""
+        moved = 0
+        moves = []
+        query = self._assemble_select_query(domain=domain)
+        for item in self._select(query, consistent_read=True):
+            key = self._compute_keyname_from_item(item)
+            target = self._shard_for(key, item['distribution'], shard_map)
+            if target == domain:
+                continue
+            if (shard_map == 'dist' and
+                    item['distribution'] not in self.dist_shards):
+                # the items of a removed distribution need a domain too
+                self._create_dist_shards([item['distribution']])
+            moves.append((target, item))
+            if len(moves) == BATCH_SIZE:
+                moved += self._move_batch(domain, moves)
+                moves = []
+        if moves:
+            moved += self._move_batch(domain, moves)
+        return moved
+
+    def _move_batch(self, domain, moves):
+        """Move package items out of `domain`, concurrently.
+
+        :param moves: list of (target domain, item) tuples
+        :returns: the number of items moved
+        """
+        moved = sum(self._parallel(
+            lambda move: self._move_item(domain, move[0], move[1]), moves))
+        self._log.info('moved %d items out of domain %s', moved, domain)
+        return moved
+
+    def _move_item(self, domain, target, item):
+        """Move a package item from `domain` to `target`. The item we
+        read may be stale by now: it is only written to `target` if
+        nothing is there yet, and only removed from `domain` if it has
+        not been rewritten or deleted there since. Everything has to be
+        in place in its new home before it is removed from the old one.
+
+        :returns: 1 if the item was moved, 0 if it was left alone
+        """
+        key = self._compute_keyname_from_item(item)
+        placed = True
+        try:
+            self._put_attributes(key, item,
+                                 expected={'Name': 'name', 'Exists': False},
+                                 domain=target)
+        except ClientError as ex:
+            if _error_code(ex) != 'ConditionalCheckFailed':
+                raise
+            # written there since, or by a move that was interrupted:
+            # either way, that copy wins over ours
+            placed = False
+        try:
+            self.sdb.delete_attributes(DomainName=domain, ItemName=key,
+                                       Expected=_unchanged(item))
+        except ClientError as ex:
+            if _error_code(ex) not in ('ConditionalCheckFailed',
+                                       'AttributeDoesNotExist'):
+                raise
+            self._log.debug('item %s changed while being moved out of '
+                            'domain %s; skipping', key, domain)
+            if placed:
+                self._unplace_item(target, key, item)
+            return 0
+        return 1
+
+    def _unplace_item(self, target, key, item):
+        """Take back the copy of an item that _move_item() wrote to
+        `target`, unless it has been rewritten there in the meantime."""
+        try:
+            self.sdb.delete_attributes(DomainName=target, ItemName=key,
+                                       Expected=_unchanged(item))
+        except ClientError as ex:
+            if _error_code(ex) not in ('ConditionalCheckFailed',
+                                       'AttributeDoesNotExist'):
+                raise
+
+    def relayout(self, layout, repo):
+        """Switch the layout that package files are added under in the S3
+        pool; see POOL_LAYOUTS. Switching to the 'hash' layout also moves
+        every package already in the repository, archived or not, over to
+        it: its files are copied on the S3 side from the directory of its
+        distribution to that of its content, which the copies of the
+        package in other distributions share, and its items are pointed
+        at them. An interrupted switch can be resumed by running it again.
+
+        Packages stay in the 'hash' layout once they are in it; the files
+        they used to be at are left in place, for the indices published
+        before the switch to go on referring to.
+
+        :param layout: string, one of POOL_LAYOUTS
+        :param repo: apt_repoman.repo.Repo
+        :returns: the number of items moved
+        :rtype: int
+        :raises: InvalidPoolLayoutError
+        """
+        if layout not in POOL_LAYOUTS:
+            raise InvalidPoolLayoutError(
+                'Unknown pool layout %s: choose one of %s' % (
+                    layout, ', '.join(POOL_LAYOUTS)))
+        if layout != self.pool_layout:
+            self._put_attributes('meta', {'pool_layout': layout})
+            self.meta['pool_layout'] = [layout]
+        if layout != 'hash':
+            return 0
+        domains = self._domains_for(tiers=TIERS)
+        # make sure the client exists before fanning out
+        self.sdb
+        moved = sum(map_with_clones(
+            repo, lambda worker, domain: self._relayout_items(domain, worker),
+            domains, SELECT_THREADS))
+        if moved:
+            # moved items are not re-stamped, so have caches start over
+            self._bump_generation(purged=True)
+        return moved
+
+    def _relayout_items(self, domain, repo):
+        """Move the package items in `domain` into the hash pool layout,
+        one at a time."""
+        moved = 0
+        query = self._assemble_select_query(domain=domain)
+        for item in self._select(query, consistent_read=True):
+            if 'pooldir' in item:
+                continue
+            if 'filename' not in item:
+                item['control'] = self._unpack_control_text(item)
+            pooldir = pool_dir(item)
+            filenames = filter(
+                None,
+                itertools.chain([item.get('filename')],
+                                item.get('files', [])))
+            try:
+                for fn in filenames:
+                    try:
+                        repo.copy_key(
+                            os.path.join('pool', item['distribution'],
+                                         item['name'][0], item['name'], fn),
+                            '%s/%s' % (pooldir, fn))
+                    except KeyExistsError:
+                        # put there for a copy of the package elsewhere
+                        pass
+            except KeyNotFoundError as ex:
+                self._log.error('Cannot move package %s version %s in '
+                                'distribution %s: %s', item['name'],
+                                item['version'], item['distribution'], ex)
+                continue
+            key = self._compute_keyname_from_item(item)
+            # unless the item was rewritten or deleted in the meantime
+            try:
+                self._put_attributes(key, {'pooldir': pooldir},
+                                     expected=_unchanged(item),
+                                     domain=domain)
+            except ClientError as ex:
+                if _error_code(ex) not in ('ConditionalCheckFailed',
+                                           'AttributeDoesNotExist'):
+                    raise
+                self._log.debug('item %s changed during relayout; '
+                                'skipping', key)
+                continue
+            moved += 1
+        self._log.info('moved %d items in domain %s to the hash pool '
+                       'layout', moved, domain)
+        return moved
+
+    def archive(self, keep, names=[], dists=[], comps=[], archs=[],
+                name_wildcard=False):
+        """Move all but the `keep` newest versions of every package in
+        each distribution, component and architecture out of the hot
+        domains and into archive_domain, where neither publish() nor
+        query() (by default) have to page through them. Archived items
+        can be copied back with do_copy().
+
+        :param keep: int, the number of versions to keep hot
+        :param names: list of strings
+        :param dists: list of strings
+        :param comps: list of strings
+        :param archs: list of strings
+        :param name_wildcard: bool
+        :returns: the number of items archived
+        :rtype: int
+        :raises: InvalidShardMapError
+        """
+        if self.rebalancing_from:
+            raise InvalidShardMapError(
+                'A rebalance from %s to %s is in progress: finish that '
+                'first' % (self.rebalancing_from, self.shard_map))
+        targets = self.query(names=names, dists=dists, comps=comps,
+                             archs=archs, name_wildcard=name_wildcard,
+                             latest_versions=-keep)
+        by_domain = defaultdict(list)
+        for name, dist, comp, arch, item in self._walk_ndcai(targets):
+            by_domain[self._shard_for_item(item)].append(item)
+        self._create_domains([self.archive_domain])
+        self._put_attributes('meta', {'archive_keep': str(keep)})
+        self.meta['archive_keep'] = [str(keep)]
+        if not by_domain:
+            return 0
+        changes = []
+        try:
+            self._parallel(
+                lambda domain: self._archive_items(
+                    domain, by_domain[domain], changes),
+                sorted(by_domain))
+        finally:
+            # the hot domains lost items: caches have to start over
+            self._bump_generation(purged=True, changes=changes)
+        # items that changed while being moved were left alone
+        self._send_notifications([
+            {'action': 'archive', 'type': 'package',
+             'name': change['name'],
+             'version': change['version'],
+             'distribution': change['distribution'],
+             'component': change['component'],
+             'caller': change['caller']} for change in changes])
+        return len(changes)
+
+    def _archive_items(self, domain, items, changes):
+        for idx in range(0, len(items), BATCH_SIZE):
+            batch = items[idx:idx + BATCH_SIZE]
+            moved = self._parallel(
+                lambda item: self._move_item(
+                    domain, self.archive_domain, item), batch)
+            # list.extend() is atomic, so the threads can share this
+            changes.extend(
+                [self._change_record('archive', item)
+                 for item, done in zip(batch, moved) if done])
+
+    def stats(self, dists=[], comps=[], archs=[], names=False, sample=0,
+              tiers=('hot',)):
+        """Count the package items in every distribution, component and
+        architecture on the simpledb side, running a count query per
+        leaf (and shard) concurrently.
+
+        :param dists: list of strings, by default every distribution
+        :param comps: list of strings, by default every component
+        :param archs: list of strings, by default every architecture
+        :param names: bool, also count distinct package names, which
+                      means reading the name of every item
+        :param sample: int, estimate the bytes stored in each leaf from
+                       the size of up to this many of its items, at most
+                       MAX_SELECT_LIMIT
+        :param tiers: tuple of TIERS to count
+        :returns: a dict for each leaf with keys distribution, component,
+                  architecture, items and optionally names and bytes
+        :rtype: list
+        """
+        if sample > MAX_SELECT_LIMIT:
+            self._log.warning('Sampling %d items per leaf, not %d',
+                              MAX_SELECT_LIMIT, sample)
+            sample = MAX_SELECT_LIMIT
+        leaves = list(itertools.product(
+            dists or self.dists, comps or self.comps, archs or self.archs))
+        return self._parallel(
+            lambda leaf: self._leaf_stats(leaf, names, sample, tiers),
+            leaves)
+
+    def _leaf_stats(self, leaf, names=False, sample=0, tiers=('hot',)):
+        dist, comp, arch = leaf
+        filters = {'dists': [dist], 'comps': [comp], 'archs': [arch]}
+        stats = {'distribution': dist, 'component': comp,
+                 'architecture': arch, 'items': 0}
+        domains = self._domains_for([dist], tiers)
+        for domain in domains:
+            # a count that takes too long is returned in installments
+            for page in self._select(self._assemble_select_query(
+                    count=True, domain=domain, **filters)):
+                stats['items'] += int(page['Count'])
+        if names:
+            stats['names'] = len(set(
+                x['name'] for x in self._select_shards(
+                    attributes=['name'], tiers=tiers, **filters)))
+        if sample:
+            items = list(itertools.chain.from_iterable(
+                self._select_first(self._assemble_select_query(
+                    domain=domain, limit=sample, **filters), sample)
+                for domain in domains))[:sample]
+            size = sum(_item_bytes(x) for x in items)
+            stats['bytes'] = (
+                size * stats['items'] // len(items) if items else 0)
+        return stats
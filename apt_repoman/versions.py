@@ -0,0 +1,120 @@
+
+# stdlib imports
+import functools
+import heapq
+import re
+
+# versions seen by a single process rarely number more than a few tens of
+# thousands; past this many, version_key() forgets the least recently used
+KEY_CACHE_SIZE = 65536
+
+
+def _encode_revision(txt):
+    # debian compares alternating runs of non-digits and digits: the
+    # non-digits character by character, with '~' sorting before the
+    # end of the run, the end before letters and letters before
+    # everything else; the digits numerically
+    encoded = []
+    for nondigits, digits in re.findall(r'(\D*)(\d*)', txt):
+        if not (nondigits or digits):
+            continue
+        for c in nondigits:
+            if c == '~':
+                encoded.append('0')
+            elif c.isalpha():
+                encoded.append('2' + c)
+            else:
+                encoded.append('3' + c)
+        encoded.append('1')
+        encoded.append(_encode_number(digits))
+    # the end of the string sorts like the end of a run of non-digits
+    encoded.append('1')
+    return ''.join(encoded)
+
+
+def _encode_number(digits):
+    digits = digits.lstrip('0')
+    return '%02d%s' % (len(digits), digits)
+
+
+def encode_version(version):
+    """Encode a debian version string such that plain string comparison of
+    the encoded values (which is all simpledb can do) orders them the same
+    way as dpkg does, for use with `order by` in select queries.
+
+    :param version: string
+    :rtype: string
+    """
+    epoch, rest = version.split(':', 1) if ':' in version else ('', version)
+    upstream, revision = rest.rsplit('-', 1) if '-' in rest else (rest, '')
+    return ''.join([_encode_number(epoch or '0'),
+                    _encode_revision(upstream),
+                    _encode_revision(revision or '0')])
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def version_key(version):
+    """A memoized encode_version(): the key to sort debian versions by.
+
+    Unlike pydpkg's compare_versions_key(), which parses both versions
+    over again on every single comparison, this parses each distinct
+    version once per process.
+
+    :param version: string
+    :rtype: string
+    """
+    return encode_version(version)
+
+
+def compare_versions(ver1, ver2):
+    """Compare two debian versions like pydpkg.Dpkg.compare_versions()
+
+    :returns: -1, 0 or 1
+    :rtype: int
+    """
+    key1, key2 = version_key(ver1), version_key(ver2)
+    return (key1 > key2) - (key1 < key2)
+
+
+def _item_key(item):
+    return version_key(item['version'])
+
+
+class SortedItems(list):
+    """A list of package items known to be in version order, oldest to
+    newest, so that sort_items() need not sort it again."""
+    __slots__ = ()
+
+
+def sort_items(items):
+    """Return package items sorted oldest to newest, unless they already
+    are.
+
+    :param items: iterable of package items
+    :rtype: SortedItems
+    """
+    if isinstance(items, SortedItems):
+        return items
+    return SortedItems(sorted(items, key=_item_key))
+
+
+def latest_items(items, latest_versions=0):
+    """Return package items sorted oldest to newest and, if latest_versions
+    is positive, pruned to the N newest or, if it is negative, to all but
+    the N newest. Picking the N newest does not sort the rest.
+
+    :param items: list of package items
+    :param latest_versions: int
+    :rtype: SortedItems
+    """
+    if (0 < latest_versions < len(items) and
+            not isinstance(items, SortedItems)):
+        newest = heapq.nlargest(latest_versions, items, key=_item_key)
+        newest.reverse()
+        return SortedItems(newest)
+    items = sort_items(items)
+    if latest_versions > 0:
+        return SortedItems(items[-latest_versions:])
+    elif latest_versions < 0:
+        return SortedItems(items[:latest_versions])
+    return items
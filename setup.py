@@ -17,18 +17,20 @@ setup(
     url='https://github.com/theclimatecorporation/repoman',
     download_url='https://github.com/theclimatecorporation/repoman/tarball/%s' % __version__,
     keywords=['apt', 'debian', 'dpkg', 'packaging'],
+    python_requires='>=3.10',
     package_data={'': ['*.json']},
     install_requires=[
         'PGPy==0.5.2',
         'ansicolors==1.1.8',
-        'boto3==1.4.4',
+        'boto3==1.43.114',
         'configargparse==0.12.0',
         'pydpkg==1.3.2',
         'pysectools==0.4.2',
         'tabulate==0.7.7'
     ],
     extras_require={
-        'test': ['mock==2.0.0', 'pep8==1.7.0', 'pytest==3.1.1', 'pylint==1.7.1']
+        'test': ['mock==5.2.0', 'pycodestyle==2.15.0', 'pytest==9.1.1',
+                 'pylint==1.7.1']
     },
     entry_points = {
         'console_scripts': ['repoman-cli=apt_repoman.cli:main'],
@@ -36,11 +38,10 @@ setup(
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "License :: OSI Approved :: Apache Software License",
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
-        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
         "Programming Language :: Python :: Implementation :: CPython",
         "Topic :: System :: Archiving :: Packaging",
         ]
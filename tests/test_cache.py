@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import shutil
+import tempfile
+import time
+import unittest
+
+from mock import patch
+
+from apt_repoman.cache import Cache
+from apt_repoman.cache import MetadataCache
+
+
+def _item(name, version, dist='xenial', comp='main', arch='amd64'):
+    return {'name': name, 'version': version, 'distribution': dist,
+            'component': comp, 'architecture': arch,
+            'controltxt00': 'Package: %s' % name}
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.cache = Cache('testdomain', cache_dir=self._dir)
+        self.items = [
+            ('k1', _item('foo', '1.0')),
+            ('k2', _item('foo', '1.1')),
+            ('k3', _item('foo_bar', '2.0', comp='nightly')),
+            ('k4', _item('fooqux', '3.0', dist='jessie', arch='source'))]
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def testGeneration(self):
+        self.assertIsNone(self.cache.generation)
+        self.assertEqual(self.cache.update(self.items, 3), 4)
+        self.assertEqual(self.cache.generation, 3)
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.generation)
+
+    def testUpdate(self):
+        self.cache.update(self.items, 3)
+        # incremental updates replace items by key
+        self.cache.update([('k1', _item('foo', '1.0', comp='nightly'))], 4)
+        self.assertEqual(len(list(self.cache.select())), 4)
+        self.assertEqual(
+            [x['component'] for x in self.cache.select(versions=['1.0'])],
+            ['nightly'])
+        # full updates replace everything
+        self.cache.update(self.items[:1], 5, replace=True)
+        self.assertEqual(list(self.cache.select()), [self.items[0][1]])
+        self.assertEqual(self.cache.generation, 5)
+
+    def testSelect(self):
+        self.cache.update(self.items, 3)
+
+        def names(**kwargs):
+            return sorted(x['name'] + '=' + x['version']
+                          for x in self.cache.select(**kwargs))
+        self.assertEqual(names(names=['foo']), ['foo=1.0', 'foo=1.1'])
+        self.assertEqual(names(names=['foo_'], name_wildcard=True),
+                         ['foo_bar=2.0'])
+        self.assertEqual(names(names=['FOO'], name_wildcard=True), [])
+        self.assertEqual(names(dists=['jessie']), ['fooqux=3.0'])
+        self.assertEqual(names(comps=['main'], archs=['amd64']),
+                         ['foo=1.0', 'foo=1.1'])
+        self.assertEqual(names(names=['foo'], versions=['1.1', '2.0']),
+                         ['foo=1.1'])
+
+    def testFindFiles(self):
+        deb = _item('foo', '1.0')
+        deb.update({'filename': 'foo_1.0_amd64.deb', 'sha256': 'abc'})
+        dsc = _item('foo', '1.0', arch='source')
+        dsc['files'] = ['foo_1.0.dsc', 'foo_1.0.tar.gz']
+        self.cache.update([('k1', deb), ('k2', dsc)], 3)
+        self.assertEqual(list(self.cache.find_files(sha256s=['abc'])), [deb])
+        self.assertEqual(
+            list(self.cache.find_files(filenames=['foo_1.0.tar.gz'])), [dsc])
+        self.assertEqual(list(self.cache.find_files()), [])
+        # replacing an item replaces its files
+        deb['sha256'] = 'def'
+        self.cache.update([('k1', deb)], 4)
+        self.assertEqual(list(self.cache.find_files(sha256s=['abc'])), [])
+        self.assertEqual(list(self.cache.find_files(
+            sha256s=['def'], filenames=['foo_1.0_amd64.deb'])), [deb])
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def testGetSet(self):
+        metadata = MetadataCache(self._dir + '/sub', ttl=60)
+        self.assertIsNone(metadata.get('caller_id|x'))
+        metadata.set('caller_id|x', 'arn:aws:iam::123:user/foo')
+        metadata.set('domain|x|testdomain', True)
+        # another invocation reads them back from disk
+        other = MetadataCache(self._dir + '/sub', ttl=60)
+        self.assertEqual(other.get('caller_id|x'), 'arn:aws:iam::123:user/foo')
+        self.assertTrue(other.get('domain|x|testdomain'))
+        # and keeps what this one stored since
+        metadata.set('topic_arn|x|t', 'arn:aws:sns:us-east-1:123:t')
+        other.set('caller_id|y', 'arn:aws:iam::123:user/bar')
+        self.assertEqual(MetadataCache(self._dir + '/sub').get(
+            'topic_arn|x|t'), 'arn:aws:sns:us-east-1:123:t')
+        other.invalidate('caller_id|x')
+        self.assertIsNone(MetadataCache(self._dir + '/sub').get(
+            'caller_id|x'))
+
+    def testExpiry(self):
+        metadata = MetadataCache(self._dir, ttl=60)
+        metadata.set('caller_id|x', 'arn:aws:iam::123:user/foo')
+        with patch('apt_repoman.cache.time.time',
+                   return_value=time.time() + 61):
+            self.assertIsNone(metadata.get('caller_id|x'))
+            # expired entries are dropped on the next write
+            metadata.set('caller_id|y', 'arn:aws:iam::123:user/bar')
+            self.assertNotIn('caller_id|x', metadata.entries)
+
+    def testUnreadable(self):
+        with open(self._dir + '/metadata.json', 'w') as fp:
+            fp.write('{not json')
+        self.assertIsNone(MetadataCache(self._dir).get('caller_id|x'))
@@ -58,3 +58,31 @@ def test_query(setup, capsys):
         assert result == 0
         out, err = capsys.readouterr()
         assert out == expected
+
+
+def test_restore(setup, tmpdir):
+    s3, sdb, sns, repo, repodb, args, _dir = setup
+    repodb._meta = {'shard_map': ['none']}
+    repodb._bump_generation = MagicMock()
+    item = {'name': 'foo', 'version': '1.0', 'distribution': 'xenial',
+            'component': 'main', 'architecture': 'amd64',
+            'controltxt0': 'Package: foo'}
+    backup = tmpdir.join('backup.json')
+    backup.write(json.dumps({
+        'metadata': {'dists': ['xenial'], 'generation': ['00000000000000000007']},
+        'packages': {'foo': {'xenial': {'main': {'amd64': [item]}}}}}))
+    args.filename = [str(backup)]
+    key = repodb._compute_keyname_from_item(item)
+    with Stubber(sdb) as stub:
+        stub.add_response('put_attributes', {}, {
+            'DomainName': 'testdomain', 'ItemName': key, 'Attributes': ANY})
+        stub.add_response('put_attributes', {}, {
+            'DomainName': 'testdomain', 'ItemName': ANY, 'Attributes': ANY})
+        # the generation is not restored
+        stub.add_response('put_attributes', {}, {
+            'DomainName': 'testdomain', 'ItemName': 'meta',
+            'Attributes': [{'Name': 'dists', 'Value': 'xenial',
+                            'Replace': True}]})
+        assert cli.restore(args, repodb, repo) == 0
+        stub.assert_no_pending_responses()
+    repodb._bump_generation.assert_called_once_with(purged=True)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import shutil
+import tempfile
+import unittest
+
+import botocore.session
+from botocore.stub import Stubber
+
+from apt_repoman.cache import MetadataCache
+from apt_repoman.connection import Connection
+
+ARN = 'arn:aws:iam::123456789012:user/foo'
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _connection(self, **kwargs):
+        connection = Connection(metadata=MetadataCache(self._dir), **kwargs)
+        connection._sts = botocore.session.get_session().create_client(
+            'sts', region_name='us-east-1')
+        return connection
+
+    def testCallerId(self):
+        connection = self._connection(region='us-east-1')
+        with Stubber(connection._sts) as stub:
+            stub.add_response('get_caller_identity', {
+                'UserId': 'x', 'Account': '123456789012', 'Arn': ARN})
+            self.assertEqual(connection.caller_id, ARN)
+        # remembered across invocations with the same credentials
+        connection = self._connection(region='us-east-1')
+        with Stubber(connection._sts):
+            self.assertEqual(connection.caller_id, ARN)
+        # but not for another role
+        connection = self._connection(
+            region='us-east-1', role_arn='arn:aws:iam::123456789012:role/r')
+        with Stubber(connection._sts) as stub:
+            stub.add_response('get_caller_identity', {
+                'UserId': 'y', 'Account': '123456789012',
+                'Arn': ARN.replace('foo', 'bar')})
+            self.assertEqual(connection.caller_id, ARN.replace('foo', 'bar'))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import unittest
+
+from mock import MagicMock, patch
+
+from apt_repoman.ingest import IngestError, Ingester
+from apt_repoman.repo import KeyExistsError
+from apt_repoman.repodb import InvalidArchitectureError, ItemExistsError
+
+
+def _parse(path, digests=False):
+    if not path.endswith('.deb'):
+        return None, [], {}, IngestError('not a package: %s' % path)
+    name, version, arch = path[:-4].split('_')
+    spec = {'name': name, 'version': version, 'architecture': arch,
+            'filename': path, 'control': 'Package: %s\n' % name}
+    if digests:
+        spec.update({'md5': 'md5', 'sha1': 'sha1', 'sha256': path})
+    return spec, [path], {}, None
+
+
+class IngesterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repodb = MagicMock()
+        self.repo = MagicMock()
+        self.repo.clone.return_value = self.repo
+        self.ingester = Ingester(self.repodb, self.repo, threads=2)
+
+    def _run(self, paths, **kwargs):
+        # parse in-process, so the mocks survive
+        with patch.object(self.ingester, '_parse',
+                          lambda paths, digests: [_parse(x, digests)
+                                                  for x in paths]):
+            return self.ingester.run(paths, ['xenial'], ['main'], **kwargs)
+
+    def testRun(self):
+        def check_valid_archs(archs):
+            if archs != ['amd64']:
+                raise InvalidArchitectureError(archs)
+
+        def add_files(name, files, dists, overwrite, checksums, pooldir):
+            if name == 'baz':
+                raise KeyExistsError(name)
+            return {files[0]: {'sha256': name}}
+        self.repodb.check_valid_archs.side_effect = check_valid_archs
+        self.repo.add_files.side_effect = add_files
+        self.repodb.add_items.side_effect = lambda specs, *args, **kw: [
+            ItemExistsError() if x['name'] == 'qux' else None for x in specs]
+        paths = ['foo_1.0_amd64.deb', 'bar_1.0_armhf.deb', 'foo.txt',
+                 'baz_1.0_amd64.deb', 'qux_1.0_amd64.deb']
+        results = self._run(paths)
+        self.assertEqual([x.path for x in results], paths)
+        self.assertEqual([type(x.error) for x in results],
+                         [type(None), InvalidArchitectureError, IngestError,
+                          KeyExistsError, ItemExistsError])
+        self.assertEqual(results[1].arch, 'armhf')
+        # the uploads of the batch share a TransferManager
+        self.repo.transfer_manager.assert_called_once_with()
+        # only the files that made it to S3 are written to simpledb, all
+        # at once
+        specs = self.repodb.add_items.call_args[0][0]
+        self.assertEqual([x['name'] for x in specs], ['foo', 'qux'])
+        # with the digests computed while uploading them
+        self.assertEqual([x['sha256'] for x in specs], ['foo', 'qux'])
+        self.assertEqual(self.repodb.add_items.call_count, 1)
+
+    def testSkipDuplicates(self):
+        self.repodb.find_files.return_value = [
+            {'sha256': 'foo_1.0_amd64.deb', 'distribution': 'xenial',
+             'component': 'main'}]
+        self.repodb.add_items.return_value = [None]
+        self.repo.add_files.return_value = {'bar_1.0_amd64.deb': {}}
+        results = self._run(['foo_1.0_amd64.deb', 'bar_1.0_amd64.deb'],
+                            skip_duplicates=True)
+        self.assertEqual([x.skipped for x in results], [True, False])
+        self.repodb.find_files.assert_called_once_with(
+            sha256s=['foo_1.0_amd64.deb', 'bar_1.0_amd64.deb'])
+        self.assertEqual(self.repo.add_files.call_count, 1)
+
+    def testHashPoolLayout(self):
+        self.repodb.pool_layout = 'hash'
+        self.repodb.add_items.return_value = [None]
+        self.repo.add_files.return_value = {'foo_1.0_amd64.deb': {}}
+        self._run(['foo_1.0_amd64.deb'])
+        # the files are hashed first, to address them by their content
+        self.repo.add_files.assert_called_once_with(
+            'foo', ['foo_1.0_amd64.deb'], ['xenial'], False,
+            {'foo_1.0_amd64.deb': {'md5': 'md5', 'sha1': 'sha1',
+                                   'sha256': 'foo_1.0_amd64.deb'}},
+            'pool/by-hash/f/foo/foo_1.0_amd64.deb')
+        spec = self.repodb.add_items.call_args[0][0][0]
+        self.assertEqual(spec['pooldir'],
+                         'pool/by-hash/f/foo/foo_1.0_amd64.deb')
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(IngesterTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
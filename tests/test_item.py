@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import json
+import pickle
+import unittest
+
+from apt_repoman.item import PackageItem
+
+
+class PackageItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.attrs = {'name': 'foo',
+                      'distribution': 'xenial',
+                      'component': 'main',
+                      'architecture': 'amd64',
+                      'version': '1.0',
+                      'sha256': 'abc',
+                      'controltxt0': 'Package: foo'}
+        self.item = PackageItem(self.attrs)
+
+    def testMapping(self):
+        self.assertEqual(self.item, self.attrs)
+        self.assertEqual(dict(self.item), self.attrs)
+        self.assertEqual(len(self.item), 7)
+        self.assertEqual(list(self.item)[:5], ['name', 'distribution',
+                                               'component', 'architecture',
+                                               'version'])
+        self.assertEqual(self.item.leaf, ('foo', 'xenial', 'main', 'amd64'))
+        self.assertEqual(json.loads(json.dumps(self.item, default=dict)),
+                         self.attrs)
+        self.assertEqual(pickle.loads(pickle.dumps(self.item)), self.item)
+
+    def testMissingAttributes(self):
+        # projections only carry some of the slotted attributes
+        item = PackageItem({'name': 'foo', 'versionkey': 'x'})
+        self.assertEqual(dict(item), {'name': 'foo', 'versionkey': 'x'})
+        self.assertNotIn('version', item)
+        self.assertIsNone(item.get('version'))
+        self.assertRaises(KeyError, lambda: item['version'])
+        del item['name']
+        self.assertNotIn('name', item)
+        self.assertRaises(KeyError, item.__delitem__, 'name')
+
+    def testCopy(self):
+        new = self.item.copy(distribution='bionic')
+        self.assertEqual(new['distribution'], 'bionic')
+        self.assertEqual(self.item['distribution'], 'xenial')
+        self.assertNotEqual(new, self.item)
+        new['versionkey'] = 'x'
+        self.assertNotIn('versionkey', self.item)
+        self.assertEqual(self.item.copy(), self.item)
+
+    def testInterned(self):
+        other = PackageItem(json.loads(json.dumps(self.attrs)))
+        self.assertIs(other.distribution, self.item.distribution)
+        self.assertIs(list(other._attrs)[0], list(self.item._attrs)[0])
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(PackageItemTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import unittest
+
+import botocore.session
+from botocore.stub import Stubber
+from mock import patch
+
+from apt_repoman.migrate import MIGRATIONS, PARTITIONS, Migrator
+from apt_repoman.repodb import Repodb, encode_version
+
+
+class MigratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repodb = Repodb('testdomain')
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb._meta = {'migrations': ['repack-control-text'],
+                             'migration_checkpoints': [
+                                 'encode-versions:testdomain/%s' % x
+                                 for x in PARTITIONS if x != 'a'] +
+                             ['extract-fields:testdomain/0']}
+        self.migrator = Migrator(self.repodb, threads=1)
+
+    def testMigrations(self):
+        self.assertEqual(list(MIGRATIONS), ['repack-control-text',
+                                            'encode-versions',
+                                            'extract-fields',
+                                            'index-names'])
+        self.assertEqual(self.migrator.pending,
+                         ['encode-versions', 'extract-fields',
+                          'index-names'])
+        self.assertEqual(self.migrator.checkpoints('extract-fields'),
+                         ['testdomain/0'])
+
+    def testPartitions(self):
+        self.assertEqual(len(self.migrator.partitions), 16)
+        self.repodb._meta['shard_map'] = ['hash:2']
+        self.assertEqual(self.migrator.partitions[15:17],
+                         ['testdomain-000/f', 'testdomain-001/0'])
+
+    def testRun(self):
+        item = {'name': 'foo', 'version': '1.0', 'distribution': 'baz',
+                'component': 'qux', 'architecture': 'xyzzy'}
+        key = self.repodb._compute_keyname_from_item(item)
+        attributes = [{'Name': k, 'Value': v} for k, v in item.items()]
+        select = {
+            'SelectExpression':
+                "select * from `testdomain` where itemName() like 'a%'",
+            'ConsistentRead': True}
+        put = {'DomainName': 'testdomain',
+               'ItemName': key,
+               'Attributes': [{'Name': 'versionkey',
+                               'Value': encode_version('1.0'),
+                               'Replace': True}],
+               'Expected': {'Name': 'name', 'Value': 'foo'}}
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_response('select', {'Items': [
+                {'Name': key, 'Attributes': attributes},
+                {'Name': key, 'Attributes': attributes}]}, select)
+            stub.add_response('put_attributes', {}, put)
+            # the second copy changed underneath us
+            stub.add_client_error('put_attributes', 'ConditionalCheckFailed',
+                                  expected_params=put)
+            # checkpoint, record, clear checkpoints
+            for operation in ('put_attributes', 'put_attributes',
+                              'delete_attributes'):
+                stub.add_response(operation, {})
+            with patch.object(Repodb, '_bump_generation') as bump:
+                counts = self.migrator.run('encode-versions')
+            bump.assert_called_once_with(purged=True)
+        self.assertEqual(counts,
+                         {'scanned': 2, 'rewritten': 1, 'skipped': 1})
+        self.assertIn('encode-versions', self.repodb.applied_migrations)
+        self.assertEqual(self.migrator.checkpoints('encode-versions'), [])
+        self.assertEqual(self.migrator.checkpoints('extract-fields'),
+                         ['testdomain/0'])
+
+    def testRunDeletesStaleAttributes(self):
+        item = {'name': 'foo', 'version': '1.0', 'distribution': 'xenial',
+                'component': 'main', 'architecture': 'amd64',
+                'controltxt0': 'Package: foo\n',
+                'controltxt1': 'Version: 1.0'}
+        key = self.repodb._compute_keyname_from_item(item)
+        self.repodb._meta = {'migration_checkpoints': [
+            'repack-control-text:testdomain/%s' % x
+            for x in PARTITIONS if x != key[0]]}
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_response('select', {'Items': [
+                {'Name': key, 'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in item.items()]}]})
+            stub.add_response('put_attributes', {})
+            # simpledb takes a value with every attribute name
+            stub.add_response('batch_delete_attributes', {}, {
+                'DomainName': 'testdomain',
+                'Items': [{'Name': key, 'Attributes': [
+                    {'Name': 'controltxt1', 'Value': 'Version: 1.0'}]}]})
+            # checkpoint, record, clear checkpoints
+            for operation in ('put_attributes', 'put_attributes',
+                              'delete_attributes'):
+                stub.add_response(operation, {})
+            with patch.object(Repodb, '_bump_generation'):
+                counts = self.migrator.run('repack-control-text')
+            stub.assert_no_pending_responses()
+        self.assertEqual(counts,
+                         {'scanned': 1, 'rewritten': 1, 'skipped': 0})
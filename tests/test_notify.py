@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import botocore.session
+
+from botocore.exceptions import BotoCoreError
+from botocore.stub import Stubber
+from mock import MagicMock
+
+from apt_repoman.notify import MAX_MESSAGE_BYTES
+from apt_repoman.notify import Dispatcher
+
+TOPIC = 'arn:aws:sns:us-east-1:123456789012:repoman'
+
+
+def _note(idx):
+    return {'action': 'add', 'type': 'package', 'name': 'foo%d' % idx,
+            'version': '1.0', 'distribution': 'xenial', 'component': 'main',
+            'caller': 'me'}
+
+
+def _entries(notifications):
+    return [{'Id': str(idx), 'Message': json.dumps(x),
+             'Subject': 'Repoman notification'}
+            for idx, x in enumerate(notifications)]
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.spool = os.path.join(self._dir, 'spool', 'test.jsonl')
+        self.sns = botocore.session.get_session().create_client(
+            'sns', region_name='us-east-1')
+        self.stubber = Stubber(self.sns)
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        shutil.rmtree(self._dir)
+
+    def _spooled(self):
+        with open(self.spool) as fp:
+            return [json.loads(x) for x in fp]
+
+    def testBatch(self):
+        notes = [_note(x) for x in range(13)]
+        self.stubber.add_response(
+            'publish_batch', {'Successful': [], 'Failed': []},
+            {'TopicArn': TOPIC,
+             'PublishBatchRequestEntries': _entries(notes[:10])})
+        self.stubber.add_response(
+            'publish_batch',
+            {'Successful': [],
+             'Failed': [{'Id': '1', 'Code': 'Throttled',
+                         'SenderFault': False}]},
+            {'TopicArn': TOPIC,
+             'PublishBatchRequestEntries': _entries(notes[10:])})
+        dispatcher = Dispatcher(self.sns, TOPIC, self.spool)
+        # queued before the thread starts, so they go out in full batches
+        for note in notes:
+            dispatcher._queue.put(note)
+        dispatcher._start()
+        self.assertEqual(dispatcher.close(5), 0)
+        self.stubber.assert_no_pending_responses()
+        # the rejected entry is spooled for the next run
+        self.assertEqual(self._spooled(), [notes[11]])
+        # as are notifications sent after close()
+        dispatcher.send([notes[0]])
+        self.assertEqual(self._spooled(), [notes[11], notes[0]])
+
+    def testSpoolAndReplay(self):
+        notes = [_note(x) for x in range(2)]
+        self.stubber.add_client_error('publish_batch', 'InternalError')
+        dispatcher = Dispatcher(self.sns, TOPIC, self.spool)
+        dispatcher.send(notes)
+        dispatcher.close(5)
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(self._spooled(), notes)
+        # the next dispatcher publishes the spooled notifications first
+        self.stubber.add_response(
+            'publish_batch', {'Successful': [], 'Failed': []},
+            {'TopicArn': TOPIC,
+             'PublishBatchRequestEntries': _entries(notes)})
+        dispatcher = Dispatcher(self.sns, TOPIC, self.spool)
+        dispatcher.send([])
+        self.assertEqual(dispatcher.close(5), 0)
+        self.stubber.assert_no_pending_responses()
+        self.assertFalse(os.path.exists(self.spool))
+
+    def testTopicNotFound(self):
+        notes = [_note(0)]
+        self.stubber.add_client_error('publish_batch', 'NotFound')
+        gone = MagicMock()
+        dispatcher = Dispatcher(self.sns, TOPIC, self.spool,
+                                on_not_found=gone)
+        dispatcher.send(notes)
+        dispatcher.close(5)
+        gone.assert_called_once_with()
+        self.assertEqual(self._spooled(), notes)
+
+    def testSummary(self):
+        notes = [_note(x) for x in range(25)]
+        self.stubber.add_response(
+            'publish_batch', {'Successful': [], 'Failed': []},
+            {'TopicArn': TOPIC, 'PublishBatchRequestEntries': _entries([
+                {'action': 'summary', 'count': 25, 'notifications': notes}])})
+        dispatcher = Dispatcher(self.sns, TOPIC, self.spool, mode='summary')
+        dispatcher.send(notes[:20])
+        dispatcher.send(notes[20:])
+        self.assertIsNone(dispatcher._thread)
+        self.assertEqual(dispatcher.close(5), 0)
+        self.stubber.assert_no_pending_responses()
+
+    def testSummarySplit(self):
+        dispatcher = Dispatcher(self.sns, TOPIC, self.spool, mode='summary')
+        notes = [dict(_note(x), blob='x' * 1024) for x in range(400)]
+        messages = dispatcher._summaries(notes)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(sum(x['count'] for x in messages), 400)
+        self.assertEqual(
+            [y for x in messages for y in x['notifications']], notes)
+        for message in messages:
+            self.assertLess(len(json.dumps(message)), 256 * 1024)
+            # too big to share a PublishBatch call
+            self.stubber.add_response(
+                'publish_batch', {'Successful': [], 'Failed': []},
+                {'TopicArn': TOPIC,
+                 'PublishBatchRequestEntries': _entries([message])})
+        dispatcher.send(notes)
+        self.assertEqual(dispatcher.close(5), 0)
+        self.stubber.assert_no_pending_responses()
+
+    def testSizeLimit(self):
+        # two notifications just too big to share a PublishBatch call
+        note = dict(_note(0), blob='')
+        room = MAX_MESSAGE_BYTES - 2 * len(json.dumps(note))
+        notes = [dict(note, blob=u'\u00e9' * (room // 12)),
+                 dict(note, blob='x' * (room - room // 12 * 6 + 1))]
+        self.assertEqual(
+            sum(len(json.dumps(x).encode('utf-8')) for x in notes),
+            MAX_MESSAGE_BYTES + 1)
+        for note in notes:
+            self.stubber.add_response(
+                'publish_batch', {'Successful': [], 'Failed': []},
+                {'TopicArn': TOPIC,
+                 'PublishBatchRequestEntries': _entries([note])})
+        dispatcher = Dispatcher(self.sns, TOPIC, self.spool)
+        for note in notes:
+            dispatcher._queue.put(note)
+        dispatcher._start()
+        self.assertEqual(dispatcher.close(5), 0)
+        self.stubber.assert_no_pending_responses()
+        # the same goes for summaries
+        summary = Dispatcher(self.sns, TOPIC, self.spool, mode='summary')
+        self.assertEqual(len(summary._summaries(notes)), 2)
+
+    def testTimeout(self):
+        notes = [_note(x) for x in range(3)]
+        sns = MagicMock()
+        hang = threading.Event()
+
+        def publish_batch(**kwargs):
+            hang.wait(10)
+            raise BotoCoreError()
+        sns.publish_batch.side_effect = publish_batch
+        dispatcher = Dispatcher(sns, TOPIC, self.spool, mode='summary')
+        dispatcher.send(notes)
+        # the summary in flight when SNS hangs is spooled, not lost
+        self.assertEqual(dispatcher.close(0.5), 1)
+        self.assertEqual(self._spooled(), [
+            {'action': 'summary', 'count': 3, 'notifications': notes}])
+        # and only once, even when the hanging call then fails
+        hang.set()
+        dispatcher._thread.join(5)
+        self.assertFalse(dispatcher._thread.is_alive())
+        self.assertEqual(len(self._spooled()), 1)
+
+    def testNothingSent(self):
+        dispatcher = Dispatcher(self.sns, TOPIC, self.spool)
+        self.assertEqual(dispatcher.close(), 0)
+        self.assertIsNone(dispatcher._thread)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(DispatcherTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
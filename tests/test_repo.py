@@ -1,8 +1,27 @@
 #!/usr/bin/env python
 
+import hashlib
+import os
+import tempfile
 import unittest
 
+from io import BytesIO
+
+import boto3
+
+from boto3.s3.transfer import TransferConfig
+from botocore.stub import ANY
+from botocore.stub import Stubber
+from mock import MagicMock
+from mock import call
+from mock import patch
+
+from apt_repoman.repo import ChecksumError
+from apt_repoman.repo import HashingReader
+from apt_repoman.repo import KeyExistsError
+from apt_repoman.repo import KeyNotFoundError
 from apt_repoman.repo import Repo
+from apt_repoman.repo import map_with_clones
 
 
 class RepoTest(unittest.TestCase):
@@ -14,6 +33,208 @@ class RepoTest(unittest.TestCase):
             self.repo._get_pkg_pathname('foo', 'bar', 'baz'),
             'pool/baz/f/foo/bar')
 
+    def testHashingReader(self):
+        data = b'x' * 1000
+        reader = HashingReader(BytesIO(data))
+        while reader.read(64):
+            pass
+        self.assertEqual(reader.digests, {
+            'md5': hashlib.md5(data).hexdigest(),
+            'sha1': hashlib.sha1(data).hexdigest(),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'size': '1000'})
+        # boto3 must not be able to seek around (and read twice)
+        self.assertFalse(hasattr(reader, 'seek'))
+        good = HashingReader(BytesIO(data), {
+            'sha512': hashlib.sha512(data).hexdigest()})
+        self.assertEqual(good.read(), data)
+        self.assertEqual(good.read(), b'')
+        bad = HashingReader(BytesIO(data), {'md5': 'nope'})
+        self.assertEqual(bad.read(1000), data)
+        self.assertRaises(ChecksumError, bad.read, 1000)
+
+    def testAddFiles(self):
+        with patch.object(self.repo, '_upload_files',
+                          return_value=[{'size': '3'}, {'size': '4'}]) \
+                as upload, patch.object(self.repo, 'copy_key') as copy:
+            self.assertEqual(self.repo.add_files(
+                'foo', ['/tmp/foo.dsc', '/tmp/foo.tar.gz'], ['d1', 'd2'],
+                checksums={'/tmp/foo.dsc': {'md5': 'abc'}}),
+                {'/tmp/foo.dsc': {'size': '3'},
+                 '/tmp/foo.tar.gz': {'size': '4'}})
+        # uploaded together, then copied on the S3 side
+        upload.assert_called_once_with(
+            [('pool/d1/f/foo/foo.dsc', '/tmp/foo.dsc', {'md5': 'abc'}),
+             ('pool/d1/f/foo/foo.tar.gz', '/tmp/foo.tar.gz', {})],
+            overwrite=False)
+        self.assertEqual(copy.call_args_list, [
+            call('pool/d1/f/foo/foo.dsc', 'pool/d2/f/foo/foo.dsc',
+                 overwrite=False),
+            call('pool/d1/f/foo/foo.tar.gz', 'pool/d2/f/foo/foo.tar.gz',
+                 overwrite=False)])
+
+    def testAddFilesToHashPool(self):
+        with patch.object(self.repo, '_upload_files',
+                          return_value=[{'size': '4'}]) as upload, \
+                patch.object(self.repo, '_key_exists',
+                             side_effect=[True, False]) as exists, \
+                patch.object(self.repo, '_get_key', side_effect=str), \
+                patch.object(self.repo, 'copy_key') as copy:
+            self.assertEqual(self.repo.add_files(
+                'foo', ['/tmp/foo.dsc', '/tmp/foo.tar.gz'], ['d1', 'd2'],
+                checksums={'/tmp/foo.dsc': {'md5': 'abc'}},
+                pooldir='pool/by-hash/f/foo/abc'),
+                {'/tmp/foo.dsc': {'md5': 'abc'},
+                 '/tmp/foo.tar.gz': {'size': '4'}})
+            # uploaded once for every dist, and only if not already there
+            self.assertEqual(exists.call_count, 2)
+            upload.assert_called_once_with(
+                [('pool/by-hash/f/foo/abc/foo.tar.gz', '/tmp/foo.tar.gz',
+                  {})], overwrite=False, skip_existing=True)
+            # nothing to upload at all
+            exists.side_effect = [True, True]
+            upload.reset_mock()
+            self.assertEqual(self.repo.add_files(
+                'foo', ['/tmp/foo.dsc', '/tmp/foo.tar.gz'], ['d1', 'd2'],
+                checksums={'/tmp/foo.dsc': {'md5': 'abc'}},
+                pooldir='pool/by-hash/f/foo/abc'),
+                {'/tmp/foo.dsc': {'md5': 'abc'}, '/tmp/foo.tar.gz': {}})
+            self.assertFalse(upload.called)
+            # overwriting uploads without looking
+            exists.reset_mock()
+            upload.return_value = [{'size': '1'}, {'size': '4'}]
+            self.repo.add_files(
+                'foo', ['/tmp/foo.dsc', '/tmp/foo.tar.gz'], ['d1'],
+                overwrite=True, pooldir='pool/by-hash/f/foo/abc')
+            self.assertFalse(exists.called)
+            self.assertEqual(len(upload.call_args[0][0]), 2)
+        self.assertFalse(copy.called)
+
+    def _stub(self):
+        session = boto3.Session(region_name='us-east-1',
+                                aws_access_key_id='x',
+                                aws_secret_access_key='y')
+        self.repo._connection = MagicMock()
+        self.repo._connection.get_resource.side_effect = session.resource
+        self.repo._use_resource(session.resource('s3'))
+        return Stubber(self.repo.s3.meta.client)
+
+    def testSetKeyFromString(self):
+        with self._stub() as stub:
+            # a single conditional PUT, without HEAD or reload
+            stub.add_response(
+                'put_object', {'ETag': '"abc"',
+                               'ResponseMetadata': {'HTTPStatusCode': 200}},
+                {'Bucket': 'testbucket', 'Key': 'test_key', 'Body': b'test',
+                 'ContentMD5': 'CY9rzUYh03PK3k6DJie09g==',
+                 'IfNoneMatch': '*'})
+            self.assertEqual(self.repo.set_key_from_string(
+                'test_key', u'test', overwrite=False)['ETag'], '"abc"')
+            stub.add_client_error('put_object', 'PreconditionFailed',
+                                  http_status_code=412)
+            self.assertRaises(KeyExistsError, self.repo.set_key_from_string,
+                              'test_key', 'test', overwrite=False)
+            stub.assert_no_pending_responses()
+
+    def testCopyKey(self):
+        with self._stub() as stub:
+            stub.add_response(
+                'copy_object', {},
+                {'Bucket': 'testbucket', 'Key': 'new',
+                 'CopySource': {'Bucket': 'testbucket', 'Key': 'old'},
+                 'IfNoneMatch': '*'})
+            self.repo.copy_key('old', 'new')
+            stub.add_response(
+                'copy_object', {},
+                {'Bucket': 'testbucket', 'Key': 'new',
+                 'CopySource': {'Bucket': 'testbucket', 'Key': 'old'}})
+            self.repo.copy_key('old', 'new', overwrite=True)
+            stub.add_client_error('copy_object', 'PreconditionFailed',
+                                  http_status_code=412)
+            self.assertRaises(KeyExistsError, self.repo.copy_key,
+                              'old', 'new')
+            stub.add_client_error('copy_object', 'NoSuchKey',
+                                  http_status_code=404)
+            self.assertRaises(KeyNotFoundError, self.repo.copy_key,
+                              'old', 'new')
+            stub.assert_no_pending_responses()
+
+    def testSetKeyFromFile(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'data')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        expected = {'Bucket': 'testbucket', 'Key': 'foo.deb', 'Body': ANY,
+                    'ACL': ANY, 'ChecksumAlgorithm': 'SHA256'}
+        with self._stub() as stub:
+            stub.add_response('put_object', {},
+                              dict(expected, IfNoneMatch='*'))
+            self.assertEqual(
+                self.repo._set_key_from_file('foo.deb', path)['sha256'],
+                hashlib.sha256(b'data').hexdigest())
+            stub.add_response('put_object', {}, expected)
+            self.repo._set_key_from_file('foo.deb', path, overwrite=True)
+            stub.add_client_error('put_object', 'PreconditionFailed',
+                                  http_status_code=412)
+            self.assertRaises(KeyExistsError, self.repo._set_key_from_file,
+                              'foo.deb', path)
+            stub.add_client_error('put_object', 'PreconditionFailed',
+                                  http_status_code=412)
+            self.assertEqual(self.repo._upload_files(
+                [('foo.deb', path, {})], skip_existing=True), [None])
+            stub.assert_no_pending_responses()
+        self.assertEqual(self.repo._exclusive, set())
+
+    def testMapWithClones(self):
+        repo = MagicMock()
+        repo.clone.side_effect = lambda: MagicMock()
+        used = set()
+
+        def func(worker, arg):
+            used.add(worker)
+            return arg * 2
+        self.assertEqual(list(map_with_clones(repo, func, range(5), 3)),
+                         [0, 2, 4, 6, 8])
+        # a clone per thread, never the original
+        self.assertEqual(repo.clone.call_count, 3)
+        self.assertNotIn(repo, used)
+        self.assertEqual(sorted(map_with_clones(
+            repo, func, range(5), 3, ordered=False)), [0, 2, 4, 6, 8])
+        # a single thread uses the repo itself
+        used.clear()
+        repo.clone.reset_mock()
+        self.assertEqual(list(map_with_clones(repo, func, [1], 3)), [2])
+        self.assertEqual(used, set([repo]))
+        self.assertFalse(repo.clone.called)
+        self.assertEqual(list(map_with_clones(repo, func, [], 3)), [])
+
+    def testTransferManager(self):
+        self.repo = Repo('testbucket', transfer_config=TransferConfig(
+            max_concurrency=4))
+        paths = []
+        for idx in range(3):
+            fd, path = tempfile.mkstemp()
+            os.write(fd, b'data%d' % idx)
+            os.close(fd)
+            self.addCleanup(os.remove, path)
+            paths.append(path)
+        with self._stub() as stub:
+            for idx in range(3):
+                stub.add_response('put_object', {})
+            with self.repo.transfer_manager() as manager:
+                self.assertEqual(manager._config.max_concurrency, 4)
+                clone = self.repo.clone()
+                self.assertIs(clone._transfers, manager)
+                with patch.object(manager, 'shutdown') as shutdown:
+                    digests = clone._upload_files(
+                        [('k%d' % x, paths[x], {}) for x in range(3)],
+                        overwrite=True)
+                # the clone does not shut down the manager it was lent
+                self.assertFalse(shutdown.called)
+            self.assertIsNone(self.repo._transfers)
+            stub.assert_no_pending_responses()
+        self.assertEqual([x['size'] for x in digests], ['5'] * 3)
+
 
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromTestCase(RepoTest)
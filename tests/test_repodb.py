@@ -1,6 +1,11 @@
 #!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
+import copy
+import hashlib
 import json
+import shutil
+import tempfile
 import time
 import unittest
 import os
@@ -8,14 +13,22 @@ import os
 from collections import OrderedDict
 from gzip import GzipFile
 from io import BytesIO
-from mock import patch, PropertyMock, MagicMock
+from mock import call, patch, PropertyMock, MagicMock
 
 import botocore.session
+from botocore.exceptions import ClientError
 from botocore.stub import Stubber, ANY
 
+from apt_repoman.cache import MetadataCache
 from apt_repoman.repodb import Repodb
 from apt_repoman.repodb import InvalidAttributesError
 from apt_repoman.repodb import InvalidCopyActionError
+from apt_repoman.repodb import ItemExistsError
+from apt_repoman.repodb import InvalidShardMapError
+from apt_repoman.repodb import encode_version
+from apt_repoman.repodb import pool_dir
+from apt_repoman.repo import KeyExistsError
+from apt_repoman.repo import KeyNotFoundError
 
 HASH = 'ad30985578dcf4e5fe0d8f40270fcff7b4e39720307f95b4511be0eda8ddc0b9'
 
@@ -32,10 +45,15 @@ ligula in venenatis blandit, leo neque hendrerit velit, ac porttitor urna metus
 a dolor."""
 
 
+def _raise(ex):
+    raise ex
+
+
 class RepodbTest(unittest.TestCase):
 
     def setUp(self):
         self.repodb = Repodb('testdomain')
+        self.repodb._meta = {'shard_map': ['none']}
         self._dir = os.path.dirname(__file__)
 
     def testMeta(self):
@@ -47,6 +65,87 @@ class RepodbTest(unittest.TestCase):
         # tricky...
         self.assertEqual(self.repodb.archs, ['a1', 'a2', 'all', 'source'])
 
+    def testPutMeta(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb._connection = MagicMock()
+        self.repodb._meta = {'dists': ['d1'], 'comps': ['c1'],
+                             'archs': ['a1'], 'shard_map': ['none'],
+                             'shard_map_from': ['hash:4'],
+                             'migrations': ['encode-versions'],
+                             'generation': ['%020d' % 3]}
+        with Stubber(self.repodb._sdb) as stub, \
+                patch.object(self.repodb, '_send_notifications'):
+            # only what was changed is written back, never the state that
+            # other commands maintain in the meta item
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': 'meta',
+                'Attributes': [
+                    {'Name': 'dists', 'Value': x, 'Replace': True}
+                    for x in ('d1', 'd2')]})
+            self.repodb.add_meta(dists=['d2'])
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': 'meta',
+                'Attributes': [
+                    {'Name': 'comps', 'Value': 'c1', 'Replace': True},
+                    {'Name': 'comps', 'Value': 'c2', 'Replace': True},
+                    {'Name': 'label', 'Value': 'lbl', 'Replace': True}]})
+            self.repodb.add_meta(comps=['c2'], label='lbl')
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': 'meta',
+                'Attributes': [
+                    {'Name': 'comps', 'Value': 'c2', 'Replace': True}]})
+            self.repodb.rm_meta(comps=['c1', 'c3'])
+            stub.assert_no_pending_responses()
+
+    def testMetadataCache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        topic = 'arn:aws:sns:us-east-1:123456789012:repoman'
+
+        def repodb():
+            db = Repodb('testdomain', metadata=MetadataCache(cache_dir))
+            db._connection = MagicMock(identity='default||us-east-1')
+            db._meta = {'topic_name': ['repoman']}
+            session = botocore.session.get_session()
+            db._sdb = session.create_client('sdb', region_name='us-east-1')
+            db._sns = session.create_client('sns', region_name='us-east-1')
+            return db
+        first = repodb()
+        with Stubber(first._sdb) as sdb, Stubber(first._sns) as sns:
+            sdb.add_response('list_domains', {'DomainNames': ['testdomain']})
+            sns.add_response('create_topic', {'TopicArn': topic},
+                             {'Name': 'repoman'})
+            self.assertTrue(first.domain_exists)
+            self.assertEqual(first.topic_arn, topic)
+        # the next invocation makes neither call
+        second = repodb()
+        with Stubber(second._sdb), Stubber(second._sns):
+            self.assertTrue(second.domain_exists)
+            self.assertEqual(second.topic_arn, topic)
+        # a missing domain is not remembered
+        other = repodb()
+        other.domain_name = 'otherdomain'
+        with Stubber(other._sdb) as sdb:
+            sdb.add_response('list_domains', {'DomainNames': ['testdomain']})
+            self.assertFalse(other.domain_exists)
+        self.assertNotIn('domain|default||us-east-1|otherdomain',
+                         MetadataCache(cache_dir).entries)
+        # a deleted topic is resolved again by the next invocation
+        second.notifier.on_not_found()
+        third = repodb()
+        with Stubber(third._sns) as sns:
+            sns.add_response('create_topic', {'TopicArn': topic + '2'},
+                             {'Name': 'repoman'})
+            self.assertEqual(third.topic_arn, topic + '2')
+        # and so is a deleted domain
+        third._meta = None
+        with Stubber(third._sdb) as sdb:
+            sdb.add_client_error('get_attributes', 'NoSuchDomain')
+            self.assertRaises(ClientError, lambda: third.meta)
+        self.assertNotIn('domain|default||us-east-1|testdomain',
+                         MetadataCache(cache_dir).entries)
+
     def testRespoolAttributes(self):
         _in_good = {'foo': 'bar', 'xyzzy': ['bada', 'bing']}
         _in_bad_key = {1: 'bar'}
@@ -134,6 +233,790 @@ class RepodbTest(unittest.TestCase):
                                                versions=['bar', 'baz']),
             "select * from `testdomain` where `name` is not null and "
             "every(name) in ('foo') and every(version) in ('bar','baz')")
+        self.assertEqual(
+            self.repodb._assemble_select_query(names=['foo'],
+                                               since_generation=41),
+            "select * from `testdomain` where `name` is not null and "
+            "every(name) in ('foo') and "
+            "`generation` > '00000000000000000041'")
+
+    def testAssembleLatestQuery(self):
+        self.assertEqual(
+            self.repodb._assemble_select_query(names=['foo'],
+                                               latest_versions=3),
+            "select * from `testdomain` where `name` is not null and "
+            "every(name) in ('foo') and `versionkey` is not null "
+            "order by `versionkey` desc limit 3")
+        self.assertEqual(
+            self.repodb._assemble_select_query(
+                names=['foo'], latest_versions=3, attributes=['versionkey']),
+            "select `versionkey` from `testdomain` where `name` is not null "
+            "and every(name) in ('foo') and `versionkey` is not null "
+            "order by `versionkey` desc limit 3")
+        self.assertEqual(
+            self.repodb._assemble_select_query(names=['foo'],
+                                               older_than='0011'),
+            "select * from `testdomain` where `name` is not null and "
+            "every(name) in ('foo') and `versionkey` < '0011'")
+
+    def testAssembleFieldQuery(self):
+        self.assertEqual(
+            self.repodb._assemble_select_query(
+                names=['foo'], fields={'Section': ['utils', "o'brien"],
+                                       'Build-Depends': ['bar']}),
+            "select * from `testdomain` where `name` is not null and "
+            "every(name) in ('foo') and `field_build_depends` in ('bar') "
+            "and `field_section` in ('utils','o''brien')")
+
+    def testExtractFields(self):
+        self.repodb._meta = {'fields': ['Source', 'section', 'Depends',
+                                        'Priority']}
+        control = ('Package: foo\n'
+                   'Source: foo-src (1.0-1)\n'
+                   'Section: utils\n'
+                   'Depends: libc6 (>= 2.14), bar:any | baz [amd64],\n'
+                   ' libc6 (<< 3)\n')
+        self.assertEqual(
+            self.repodb._extract_fields(control),
+            {'field_source': 'foo-src',
+             'field_section': 'utils',
+             'field_depends': ['bar', 'baz', 'libc6']})
+        item = {'name': 'foo', 'controltxt00': control,
+                'field_source': 'foo-src',
+                'field_section': 'utils',
+                'field_depends': ['libc6', 'baz', 'bar']}
+        self.assertIsNone(self.repodb._extract_item_fields(item))
+        self.repodb._meta['fields'] = ['Section', 'Priority']
+        item['field_section'] = 'admin'
+        self.assertEqual(
+            self.repodb._extract_item_fields(item),
+            ({'field_section': 'utils'}, ['field_depends', 'field_source']))
+
+    def testEncodeVersion(self):
+        # oldest to newest by dpkg rules
+        versions = ['0.9', '1.0~~', '1.0~~a', '1.0~', '1.0', '1.0-0.1',
+                    '1.0-1~bpo', '1.0-1', '1.0-1a', '1.0-1+b1', '1.0a',
+                    '1.0+', '1.00.1', '1.2', '1.10', '1:0.1']
+        self.assertEqual(sorted(versions, key=encode_version), versions)
+        self.assertEqual(encode_version('1.0'), encode_version('0:1.0-0'))
+
+    def testFindLatestInLeaf(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        leaf = ('foo', 'baz', 'qux', 'xyzzy')
+        item = {'name': 'foo', 'version': 'bar',
+                'distribution': 'baz', 'component': 'qux',
+                'architecture': 'xyzzy'}
+        filters = ("every(name) in ('foo') and every(distribution) in "
+                   "('baz') and every(component) in ('qux') and "
+                   "every(architecture) in ('xyzzy')")
+        newest = {
+            'SelectExpression':
+                "select `name`, `version`, `distribution`, `component`, "
+                "`architecture`, `versionkey` from `testdomain` where "
+                "`name` is not null and " + filters + " and `versionkey` is not null "
+                "order by `versionkey` desc limit 2",
+            'ConsistentRead': True}
+        older = {
+            'SelectExpression':
+                "select * from `testdomain` where `name` is not null and " +
+                filters + " and `versionkey` < 'k2'",
+            'ConsistentRead': True}
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_response('select', {'Items': [
+                {'Name': 'a', 'Attributes': [
+                    {'Name': 'versionkey', 'Value': 'k3'}]},
+                {'Name': 'b', 'Attributes': [
+                    {'Name': 'versionkey', 'Value': 'k2'}]}]}, newest)
+            stub.add_response('select', {'Items': [
+                {'Name': HASH, 'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in item.items()]}]},
+                older)
+            stub.add_response('select', {'Items': [
+                {'Name': 'a', 'Attributes': [
+                    {'Name': 'versionkey', 'Value': 'k3'}]}]}, newest)
+            # all but the two newest
+            self.assertEqual(
+                self.repodb._find_latest_in_leaf(leaf, latest_versions=-2),
+                [item])
+            # there are fewer than two to begin with
+            self.assertEqual(
+                self.repodb._find_latest_in_leaf(leaf, latest_versions=-2),
+                [])
+
+    def testLatestQuerySelects(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb._meta = {'dists': ['d1', 'd2'], 'comps': ['c1'],
+                             'archs': ['a1'], 'shard_map': ['none'],
+                             'migrations': ['encode-versions']}
+        items = [
+            {'name': 'foo', 'version': v, 'distribution': d,
+             'component': 'c1', 'architecture': 'a1',
+             'versionkey': encode_version(v)}
+            for v in ('1.0', '2.0') for d in ('d1', 'd2')]
+        page = {'Items': [
+            {'Name': 'k%d' % idx, 'Attributes': [
+                {'Name': k, 'Value': v} for k, v in item.items()]}
+            for idx, item in enumerate(items)]}
+        with Stubber(self.repodb._sdb) as stub:
+            # a broad query is a single scan, pruned locally
+            stub.add_response('select', page)
+            result = self.repodb.query(names=['foo'], latest_versions=1)
+            stub.assert_no_pending_responses()
+            self.assertEqual(
+                [x['version'] for x in result['foo']['d1']['c1']['a1']],
+                ['2.0'])
+            self.assertEqual(
+                [x['version'] for x in result['foo']['d2']['c1']['a1']],
+                ['2.0'])
+            # a query over a few named leaves is one select per leaf
+            for dist in ('d1', 'd2'):
+                stub.add_response('select', {'Items': [
+                    {'Name': 'k%s' % dist, 'Attributes': [
+                        {'Name': k, 'Value': v}
+                        for k, v in items[2 if dist == 'd1' else 3].items()]}
+                ]})
+            result = self.repodb.query(
+                names=['foo'], dists=['d1', 'd2'], comps=['c1'],
+                archs=['a1'], latest_versions=1)
+            stub.assert_no_pending_responses()
+            self.assertEqual(
+                [x['version'] for x in result['foo']['d2']['c1']['a1']],
+                ['2.0'])
+
+    def testBumpGeneration(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb._meta = {'generation': ['00000000000000000041']}
+        self.assertEqual(self.repodb._next_generation(),
+                         '00000000000000000042')
+        conflict = {'DomainName': 'testdomain',
+                    'ItemName': 'meta',
+                    'Attributes': [{'Name': 'generation',
+                                    'Value': '00000000000000000042',
+                                    'Replace': True},
+                                   {'Name': 'purged_generation',
+                                    'Value': '00000000000000000042',
+                                    'Replace': True}],
+                    'Expected': {'Name': 'generation',
+                                 'Value': '00000000000000000041'}}
+        reread = {'DomainName': 'testdomain',
+                  'ItemName': 'meta',
+                  'AttributeNames': [],
+                  'ConsistentRead': True}
+        restamp = {'DomainName': 'testdomain',
+                   'ItemName': HASH,
+                   'Attributes': [{'Name': 'generation',
+                                   'Value': '00000000000000000043',
+                                   'Replace': True}]}
+        bump = {'DomainName': 'testdomain',
+                'ItemName': 'meta',
+                'Attributes': [{'Name': 'generation',
+                                'Value': '00000000000000000043',
+                                'Replace': True},
+                               {'Name': 'purged_generation',
+                                'Value': '00000000000000000043',
+                                'Replace': True}],
+                'Expected': {'Name': 'generation',
+                             'Value': '00000000000000000042'}}
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_client_error(
+                'put_attributes', 'ConditionalCheckFailed',
+                expected_params=conflict)
+            stub.add_response(
+                'get_attributes',
+                {'Attributes': [{'Name': 'generation',
+                                 'Value': '00000000000000000042'}]},
+                reread)
+            stub.add_response('put_attributes', {}, restamp)
+            stub.add_response('put_attributes', {}, bump)
+            self.assertEqual(
+                self.repodb._bump_generation([('testdomain', HASH)],
+                                             purged=True), 43)
+        self.assertEqual(self.repodb.generation, 43)
+        self.assertEqual(self.repodb.purged_generation, 43)
+
+    def testPutNewItem(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        _in = {'name': 'foo', 'version': 'bar',
+               'distribution': 'baz', 'component': 'qux',
+               'architecture': 'xyzzy'}
+        params = {'DomainName': 'testdomain',
+                  'ItemName': HASH,
+                  'Attributes': ANY,
+                  'Expected': {'Name': 'name', 'Exists': False}}
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_response('put_attributes', {}, params)
+            stub.add_client_error(
+                'put_attributes', 'ConditionalCheckFailed',
+                expected_params=params)
+            overwrite_params = dict(params)
+            del overwrite_params['Expected']
+            stub.add_response('put_attributes', {}, overwrite_params)
+            self.repodb._put_new_item(HASH, _in)
+            self.assertRaises(ItemExistsError,
+                              self.repodb._put_new_item, HASH, _in)
+            self.repodb._put_new_item(HASH, _in, overwrite=True)
+
+    def testChangeFeed(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb._connection = MagicMock()
+        self.repodb._connection.caller_id = 'arn:aws:iam::123:user/foo'
+        self.repodb._meta = {'generation': ['00000000000000000041']}
+        item = {'name': 'foo', 'version': 'bar',
+                'distribution': 'baz', 'component': 'qux',
+                'architecture': 'xyzzy'}
+        record = self.repodb._change_record('delete', item)
+        self.assertEqual(record['key'], HASH)
+        seq = '%029d' % (42 * 10 ** 9)
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_response('batch_put_attributes', {}, {
+                'DomainName': 'testdomain-changes',
+                'Items': [{'Name': ANY, 'Attributes': ANY}]})
+            stub.add_response('put_attributes', {})
+            self.repodb._bump_generation(purged=True, changes=[record])
+            stub.add_response('get_attributes', {'Attributes': [
+                {'Name': 'generation', 'Value': '00000000000000000042'}]})
+            stub.add_response('select', {'Items': [
+                {'Name': 'abc', 'Attributes': [
+                    {'Name': k, 'Value': v}
+                    for k, v in dict(record, seq=seq).items()]}]}, {
+                'SelectExpression':
+                    "select * from `testdomain-changes` where `seq` > "
+                    "'%029d' and `seq` < '%029d' order by `seq` asc" % (
+                        41 * 10 ** 9, 43 * 10 ** 9),
+                'ConsistentRead': True})
+            self.assertEqual(
+                list(self.repodb.changes_since(41 * 10 ** 9)),
+                [dict(record, seq=42 * 10 ** 9)])
+
+    def testReadConsistency(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb.consistent_read = False
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_response('select', {'Items': []}, {
+                'SelectExpression': 'foo', 'ConsistentRead': False})
+            stub.add_response('get_attributes', {'Attributes': []}, {
+                'DomainName': 'testdomain', 'ItemName': 'meta',
+                'AttributeNames': [], 'ConsistentRead': False})
+            stub.add_response('select', {'Items': []}, {
+                'SelectExpression': 'foo', 'ConsistentRead': True})
+            self.assertEqual(list(self.repodb._select('foo')), [])
+            self.assertEqual(self.repodb._get_attributes('meta'), {})
+            self.assertEqual(list(self.repodb._select('foo', True)), [])
+
+    def testRefreshCache(self):
+        self.repodb.cache = MagicMock()
+        # the cache must never be filled from stale reads
+        self.repodb.consistent_read = False
+        item = {'name': 'foo', 'version': 'bar',
+                'distribution': 'baz', 'component': 'qux',
+                'architecture': 'xyzzy'}
+        meta = {'generation': ['00000000000000000007'],
+                'purged_generation': ['00000000000000000005']}
+        with patch.object(Repodb, '_get_attributes', return_value=meta), \
+                patch.object(Repodb, '_select', return_value=[item]) as sel:
+            # nothing deleted since the last refresh: incremental
+            self.repodb.cache.generation = 6
+            self.repodb._refresh_cache()
+            self.assertTrue(sel.call_args[0][0].endswith(
+                "`generation` > '00000000000000000006'"))
+            self.assertTrue(sel.call_args[0][1])
+            items, generation = self.repodb.cache.update.call_args[0]
+            self.assertEqual(list(items), [(HASH, item)])
+            self.assertEqual(generation, 7)
+            self.assertEqual(
+                self.repodb.cache.update.call_args[1], {'replace': False})
+            # the cache predates a deletion: full reload
+            self.repodb._cache_fresh = False
+            self.repodb.cache.generation = 4
+            self.repodb._refresh_cache()
+            self.assertEqual(
+                self.repodb.cache.update.call_args[1], {'replace': True})
+
+    def testShardFor(self):
+        self.repodb._meta = {'dists': ['d1', 'd2'], 'shard_map': ['none']}
+        self.assertEqual(self.repodb._shard_for(HASH, 'd1'), 'testdomain')
+        self.assertEqual(self.repodb.shard_domains, ['testdomain'])
+        self.repodb._meta['shard_map'] = ['dist']
+        self.assertEqual(self.repodb._shard_for(HASH, 'd1'),
+                         'testdomain-d1')
+        self.assertEqual(self.repodb._domains_for(['d2']),
+                         ['testdomain-d2'])
+        self.repodb._meta['shard_map'] = ['hash:4']
+        # int(HASH[:8], 16) % 4 == 1
+        self.assertEqual(self.repodb._shard_for(HASH, 'd1'),
+                         'testdomain-001')
+        self.assertEqual(len(self.repodb.shard_domains), 4)
+        # mid-rebalance, reads look in both places
+        self.repodb._meta['shard_map_from'] = ['dist']
+        self.assertEqual(self.repodb._domains_for(['d2']),
+                         ['testdomain-000', 'testdomain-001',
+                          'testdomain-002', 'testdomain-003',
+                          'testdomain-d2'])
+        # archived items are only looked for once there is an archive
+        self.assertEqual(self.repodb._domains_for(['d2'], tiers=('archive',)),
+                         [])
+        self.repodb._meta['archive_keep'] = ['2']
+        self.assertEqual(self.repodb._domains_for(['d2'], tiers=('archive',)),
+                         ['testdomain-archive'])
+        self.assertRaises(InvalidShardMapError,
+                          self.repodb.rebalance, 'hash:0')
+        self.assertRaises(InvalidShardMapError,
+                          self.repodb.rebalance, 'none')
+
+    def testRebalance(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb._meta = {'dists': ['baz'], 'shard_map': ['none']}
+        item = {'name': 'foo', 'version': 'bar',
+                'distribution': 'baz', 'component': 'qux',
+                'architecture': 'xyzzy'}
+        # in a distribution since removed from the repo config
+        hidden = dict(item, distribution='gone')
+        hidden_key = self.repodb._compute_keyname_from_item(hidden)
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_response('list_domains', {'DomainNames': ['testdomain']})
+            stub.add_response('create_domain', {},
+                              {'DomainName': 'testdomain-baz'})
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': 'meta',
+                'Attributes': [{'Name': 'dist_shards', 'Value': 'baz',
+                                'Replace': False}]})
+            stub.add_response('put_attributes', {})
+            stub.add_response('select', {'Items': [
+                {'Name': HASH, 'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in item.items()]},
+                {'Name': hidden_key, 'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in hidden.items()]}]})
+            # its domain is created when its first item is moved
+            stub.add_response('list_domains', {
+                'DomainNames': ['testdomain', 'testdomain-baz']})
+            stub.add_response('create_domain', {},
+                              {'DomainName': 'testdomain-gone'})
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': 'meta',
+                'Attributes': [{'Name': 'dist_shards', 'Value': 'gone',
+                                'Replace': False}]})
+            for domain, key in (('testdomain-baz', HASH),
+                                ('testdomain-gone', hidden_key)):
+                stub.add_response('put_attributes', {}, {
+                    'DomainName': domain, 'ItemName': key,
+                    'Attributes': ANY,
+                    'Expected': {'Name': 'name', 'Exists': False}})
+                stub.add_response('delete_attributes', {}, {
+                    'DomainName': 'testdomain', 'ItemName': key,
+                    'Expected': {'Name': 'name', 'Value': 'foo'}})
+            stub.add_response('delete_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': 'meta',
+                'Attributes': [{'Name': 'shard_map_from', 'Value': 'none'}]})
+            with patch('apt_repoman.repodb.SELECT_THREADS', 1):
+                self.assertEqual(self.repodb.rebalance('dist'), 2)
+            stub.assert_no_pending_responses()
+        self.assertEqual(self.repodb.shard_map, 'dist')
+        self.assertIsNone(self.repodb.rebalancing_from)
+        self.assertEqual(self.repodb.dist_shards, ['baz', 'gone'])
+        # the removed distribution is still read from, and moved back
+        self.assertEqual(self.repodb.shard_domains,
+                         ['testdomain-baz', 'testdomain-gone'])
+        self.assertEqual(self.repodb._domains_for(['gone', 'nope']),
+                         ['testdomain-gone'])
+        with patch.object(self.repodb, '_move_items',
+                          return_value=1) as move, \
+                patch.object(self.repodb, '_create_domains'), \
+                patch.object(self.repodb, '_put_attributes'), \
+                patch.object(self.repodb, '_delete_attributes'):
+            self.assertEqual(self.repodb.rebalance('none'), 2)
+        self.assertEqual(sorted(x[0][0] for x in move.call_args_list),
+                         ['testdomain-baz', 'testdomain-gone'])
+
+    def testMoveRace(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        item = {'name': 'foo', 'version': 'bar',
+                'distribution': 'baz', 'component': 'qux',
+                'architecture': 'xyzzy', 'generation': '%020d' % 3}
+        unchanged = {'Name': 'generation', 'Value': '%020d' % 3}
+        with Stubber(self.repodb._sdb) as stub:
+            # already in place: the copy there wins, ours is dropped
+            stub.add_client_error('put_attributes', 'ConditionalCheckFailed',
+                                  expected_params={
+                                      'DomainName': 'testdomain-baz',
+                                      'ItemName': HASH, 'Attributes': ANY,
+                                      'Expected': {'Name': 'name',
+                                                   'Exists': False}})
+            stub.add_response('delete_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': HASH,
+                'Expected': unchanged})
+            self.assertEqual(self.repodb._move_item(
+                'testdomain', 'testdomain-baz', item), 1)
+            # rewritten or deleted at the source in the meantime: the
+            # stale copy is taken back and the source left alone
+            stub.add_response('put_attributes', {})
+            stub.add_client_error('delete_attributes',
+                                  'AttributeDoesNotExist')
+            stub.add_response('delete_attributes', {}, {
+                'DomainName': 'testdomain-baz', 'ItemName': HASH,
+                'Expected': unchanged})
+            self.assertEqual(self.repodb._move_item(
+                'testdomain', 'testdomain-baz', item), 0)
+            # and when neither copy is ours, nothing is touched
+            stub.add_client_error('put_attributes', 'ConditionalCheckFailed')
+            stub.add_client_error('delete_attributes',
+                                  'ConditionalCheckFailed')
+            self.assertEqual(self.repodb._move_item(
+                'testdomain', 'testdomain-baz', item), 0)
+            stub.assert_no_pending_responses()
+
+    def testRelayout(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        repo = MagicMock()
+        repo.clone.return_value = repo
+        repo.copy_key.side_effect = [None, KeyExistsError()]
+        deb = {'name': 'foo', 'version': '1.0', 'distribution': 'baz',
+               'component': 'qux', 'architecture': 'amd64',
+               'filename': 'foo_1.0_amd64.deb', 'sha256': 'abc',
+               'generation': '%020d' % 2}
+        dsc = {'name': 'bar', 'version': '1.0', 'distribution': 'baz',
+               'component': 'qux', 'architecture': 'source',
+               'files': ['bar_1.0.dsc', 'bar_1.0.tar.gz'],
+               'controltxt00': 'Source: bar'}
+        done = dict(deb, name='moved', pooldir='pool/by-hash/m/moved/abc')
+        src_dir = 'pool/by-hash/b/bar/' + hashlib.sha256(
+            b'Source: bar').hexdigest()
+        with Stubber(self.repodb._sdb) as stub, \
+                patch.object(self.repodb, '_bump_generation') as bump:
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': 'meta',
+                'Attributes': [{'Name': 'pool_layout', 'Value': 'hash',
+                                'Replace': True}]})
+            stub.add_response('select', {'Items': [
+                {'Name': HASH, 'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in x.items()]}
+                for x in (deb, done)]})
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': ANY,
+                'Attributes': [{'Name': 'pooldir', 'Replace': True,
+                                'Value': 'pool/by-hash/f/foo/abc'}],
+                'Expected': {'Name': 'generation', 'Value': '%020d' % 2}})
+            self.assertEqual(self.repodb.relayout('hash', repo), 1)
+            stub.add_response('select', {'Items': [
+                {'Name': HASH, 'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in dsc.items()
+                    if k != 'files'] + [
+                    {'Name': 'files', 'Value': x} for x in dsc['files']]}]})
+            # the tarball is shared with another version: still moved
+            repo.copy_key.side_effect = [None, KeyExistsError()]
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': ANY,
+                'Attributes': [{'Name': 'pooldir', 'Replace': True,
+                                'Value': src_dir}],
+                'Expected': {'Name': 'name', 'Value': 'bar'}})
+            self.assertEqual(self.repodb.relayout('hash', repo), 1)
+            stub.assert_no_pending_responses()
+        self.assertEqual(self.repodb.pool_layout, 'hash')
+        self.assertEqual(repo.copy_key.call_args_list[-2:], [
+            call('pool/baz/b/bar/bar_1.0.dsc', src_dir + '/bar_1.0.dsc'),
+            call('pool/baz/b/bar/bar_1.0.tar.gz',
+                 src_dir + '/bar_1.0.tar.gz')])
+        self.assertEqual(bump.call_count, 2)
+        self.assertEqual(pool_dir({'name': 'bar', 'control': 'Source: bar'}),
+                         src_dir)
+
+    def testArchive(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb._meta = {'dists': ['baz'], 'comps': ['qux'],
+                             'archs': ['xyzzy'], 'shard_map': ['none'],
+                             'generation': ['%020d' % 7]}
+        self.repodb._connection = MagicMock()
+        self.repodb._connection.caller_id = 'arn:aws:iam::123:user/foo'
+
+        def item(version):
+            return {'Name': HASH + version, 'Attributes': [
+                {'Name': k, 'Value': v} for k, v in (
+                    ('name', 'foo'), ('version', version),
+                    ('distribution', 'baz'), ('component', 'qux'),
+                    ('architecture', 'xyzzy'))]}
+        oldest = self.repodb._compute_keyname('foo', '1.0', 'baz', 'qux',
+                                              'xyzzy')
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_response('select', {'Items': [
+                item('2.0'), item('1.0'), item('3.0')]})
+            stub.add_response('list_domains', {'DomainNames': ['testdomain']})
+            stub.add_response('create_domain', {},
+                              {'DomainName': 'testdomain-archive'})
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': 'meta',
+                'Attributes': [{'Name': 'archive_keep', 'Value': '2',
+                                'Replace': True}]})
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain-archive', 'ItemName': oldest,
+                'Attributes': ANY,
+                'Expected': {'Name': 'name', 'Exists': False}})
+            stub.add_response('delete_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': oldest,
+                'Expected': {'Name': 'name', 'Value': 'foo'}})
+            stub.add_response('batch_put_attributes', {}, {
+                'DomainName': 'testdomain-changes',
+                'Items': [{'Name': ANY, 'Attributes': ANY}]})
+            stub.add_response('put_attributes', {})
+            self.assertEqual(self.repodb.archive(2, names=['foo']), 1)
+        self.assertEqual(self.repodb.archive_keep, 2)
+        self.assertEqual(self.repodb.purged_generation, 8)
+
+    def testStats(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        filters = ("`name` is not null and every(distribution) in ('baz') "
+                   "and every(component) in ('qux') and "
+                   "every(architecture) in ('xyzzy')")
+        item = {'name': 'foo', 'version': 'bar'}
+        with Stubber(self.repodb._sdb) as stub:
+            # a count that times out comes back in two installments
+            stub.add_response('select', {
+                'Items': [{'Name': 'Domain', 'Attributes': [
+                    {'Name': 'Count', 'Value': '3'}]}],
+                'NextToken': 'next'}, {
+                'SelectExpression':
+                    'select count(*) from `testdomain` where ' + filters,
+                'ConsistentRead': True})
+            stub.add_response('select', {
+                'Items': [{'Name': 'Domain', 'Attributes': [
+                    {'Name': 'Count', 'Value': '1'}]}]})
+            stub.add_response('select', {'Items': [
+                {'Name': 'a', 'Attributes': [
+                    {'Name': 'name', 'Value': x}]}
+                for x in ('foo', 'foo', 'bar', 'foo')]}, {
+                'SelectExpression':
+                    'select `name` from `testdomain` where ' + filters,
+                'ConsistentRead': True})
+            stub.add_response('select', {'Items': [
+                {'Name': 'a', 'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in item.items()]}]}, {
+                'SelectExpression':
+                    'select * from `testdomain` where ' + filters +
+                    ' limit 1',
+                'ConsistentRead': True})
+            self.assertEqual(
+                self.repodb.stats(dists=['baz'], comps=['qux'],
+                                  archs=['xyzzy'], names=True, sample=1),
+                [{'distribution': 'baz', 'component': 'qux',
+                  'architecture': 'xyzzy', 'items': 4, 'names': 2,
+                  'bytes': 4 * (64 + 17)}])
+            # simpledb returns no more than 2500 items from a select
+            stub.add_response('select', {
+                'Items': [{'Name': 'Domain', 'Attributes': [
+                    {'Name': 'Count', 'Value': '4'}]}]})
+            stub.add_response('select', {'Items': [
+                {'Name': 'a', 'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in item.items()]}]}, {
+                'SelectExpression':
+                    'select * from `testdomain` where ' + filters +
+                    ' limit 2500',
+                'ConsistentRead': True})
+            self.assertEqual(
+                self.repodb.stats(dists=['baz'], comps=['qux'],
+                                  archs=['xyzzy'], sample=5000),
+                [{'distribution': 'baz', 'component': 'qux',
+                  'architecture': 'xyzzy', 'items': 4,
+                  'bytes': 4 * (64 + 17)}])
+            stub.assert_no_pending_responses()
+
+    def testWildcardNameIndex(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        filters = " and every(distribution) in ('baz')"
+        # without the index, wildcards are left to simpledb
+        with patch.object(Repodb, '_select', return_value=[]) as sel:
+            list(self.repodb._select_shards(names=['fo'], name_wildcard=True,
+                                            dists=['baz']))
+            self.assertIn("`name` LIKE 'fo%'", sel.call_args[0][0])
+        self.repodb._meta['migrations'] = ['index-names']
+        names = ['foo%02d' % x for x in range(25)]
+        # one thread, so that the batches are queried in order
+        with Stubber(self.repodb._sdb) as stub, \
+                patch('apt_repoman.repodb.SELECT_THREADS', 1):
+            stub.add_response('select', {'Items': [
+                {'Name': 'nameindex-' + x, 'Attributes': [
+                    {'Name': 'indexed_name', 'Value': x}]}
+                for x in names]}, {
+                'SelectExpression':
+                    "select `indexed_name` from `testdomain` where "
+                    "`indexed_name` like 'fo%' or `indexed_name` like 'ba%'",
+                'ConsistentRead': True})
+            for batch in (names[:20], names[20:]):
+                stub.add_response('select', {'Items': []}, {
+                    'SelectExpression':
+                        "select * from `testdomain` where `name` is not "
+                        "null and every(name) in (%s)%s" % (
+                            ','.join("'%s'" % x for x in batch), filters),
+                    'ConsistentRead': True})
+            self.assertEqual(list(self.repodb._select_shards(
+                names=['fo', 'ba'], name_wildcard=True, dists=['baz'])), [])
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_response('select', {'Items': []})
+            self.assertEqual(list(self.repodb._select_shards(
+                names=['qu'], name_wildcard=True)), [])
+
+    def testUnindexNames(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        token = {'Attributes': [{'Name': 'index_token', 'Value': 'abc'}]}
+        count = {'Items': [{'Name': 'Domain', 'Attributes': [
+            {'Name': 'Count', 'Value': '0'}]}]}
+        with Stubber(self.repodb._sdb) as stub:
+            # bar still has items somewhere
+            stub.add_response('get_attributes', token)
+            stub.add_response('select', {'Items': [
+                {'Name': 'Domain', 'Attributes': [
+                    {'Name': 'Count', 'Value': '2'}]}]})
+            self.repodb._unindex_names(['bar', 'bar'])
+            # foo does not
+            stub.add_response('get_attributes', token)
+            stub.add_response('select', count)
+            stub.add_response('delete_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': 'nameindex-foo',
+                'Expected': {'Name': 'index_token', 'Value': 'abc'}})
+            self.repodb._unindex_names(['foo'])
+            stub.assert_no_pending_responses()
+
+    def testFindFiles(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        item = {'name': 'foo', 'version': 'bar',
+                'distribution': 'baz', 'component': 'qux',
+                'architecture': 'xyzzy', 'sha256': 'abc'}
+        self.assertEqual(self.repodb.find_files(), [])
+        with Stubber(self.repodb._sdb) as stub:
+            stub.add_response('select', {'Items': [
+                {'Name': HASH, 'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in item.items()]}]}, {
+                'SelectExpression':
+                    "select * from `testdomain` where `name` is not null "
+                    "and (`sha256` in ('abc') or `filename` in "
+                    "('foo.dsc') or `files` in ('foo.dsc'))",
+                'ConsistentRead': True})
+            self.assertEqual(self.repodb.find_files(
+                sha256s=['abc'], filenames=['foo.dsc']), [item])
+
+    def testAddItems(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb._meta = {'dists': ['baz'], 'comps': ['qux'],
+                             'shard_map': ['none']}
+        self.repodb._connection = MagicMock()
+        self.repodb._connection.caller_id = 'arn:aws:iam::123:user/foo'
+        specs = [{'name': 'foo', 'version': v, 'architecture': 'xyzzy',
+                  'control': 'Package: foo\n'} for v in ('bar', '1.0')]
+        with Stubber(self.repodb._sdb) as stub, \
+                patch('apt_repoman.repodb.SELECT_THREADS', 1), \
+                patch.object(self.repodb, '_next_generation',
+                             return_value='%020d' % 3), \
+                patch.object(self.repodb, '_bump_generation') as bump, \
+                patch.object(self.repodb, '_index_names') as index:
+            stub.add_response('put_attributes', {}, {
+                'DomainName': 'testdomain', 'ItemName': HASH,
+                'Attributes': ANY,
+                'Expected': {'Name': 'name', 'Exists': False}})
+            stub.add_client_error('put_attributes', 'ConditionalCheckFailed')
+            errors = self.repodb.add_items(specs, ['baz'], ['qux'])
+            self.assertIsNone(errors[0])
+            self.assertIsInstance(errors[1], ItemExistsError)
+            index.assert_called_once_with(set(['foo']))
+            self.assertEqual(bump.call_args[0][0], [('testdomain', HASH)])
+            # overwrites are written in batches
+            stub.add_response('batch_put_attributes', {}, {
+                'DomainName': 'testdomain',
+                'Items': [{'Name': HASH, 'Attributes': ANY},
+                          {'Name': ANY, 'Attributes': ANY}]})
+            self.assertEqual(self.repodb.add_items(
+                specs, ['baz'], ['qux'], overwrite=True), [None, None])
+
+    def testDoCopy(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb._connection = MagicMock()
+        self.repodb._connection.caller_id = 'arn:aws:iam::123:user/foo'
+        repo = MagicMock()
+        repo.clone.return_value = repo
+        repo.copy_key.side_effect = lambda old, new, overwrite: (
+            _raise(KeyNotFoundError(old)) if 'bar' in old else None)
+
+        def item(name, dist):
+            return {'name': name, 'version': '1.0', 'distribution': dist,
+                    'component': 'qux', 'architecture': 'amd64',
+                    'filename': '%s_1.0_amd64.deb' % name}
+        candidates = {'foo': {'baz': {'qux': {'amd64': [item('foo', 'baz')]}}},
+                      'bar': {'baz': {'qux': {'amd64': [item('bar', 'baz')]}}}}
+        targets = {'foo': {'baz': {'qux': {'amd64': [item('foo', 'new')]}}},
+                   'bar': {'baz': {'qux': {'amd64': [item('bar', 'new')]}}}}
+        progress = MagicMock()
+        with Stubber(self.repodb._sdb) as stub, \
+                patch('apt_repoman.repodb.SELECT_THREADS', 1), \
+                patch.object(self.repodb, '_next_generation',
+                             return_value='%020d' % 3), \
+                patch.object(self.repodb, '_bump_generation') as bump:
+            # only the package whose files all landed is written
+            stub.add_response('batch_put_attributes', {}, {
+                'DomainName': 'testdomain',
+                'Items': [{'Name': ANY, 'Attributes': ANY}]})
+            failures = self.repodb.do_copy(candidates, targets, repo,
+                                           threads=2, progress=progress)
+            stub.assert_no_pending_responses()
+        self.assertEqual([(x['name'], type(y)) for x, y in failures],
+                         [('bar', KeyNotFoundError)])
+        self.assertEqual(sorted(x[0][0] for x in repo.copy_key.call_args_list),
+                         ['pool/baz/b/bar/bar_1.0_amd64.deb',
+                          'pool/baz/f/foo/foo_1.0_amd64.deb'])
+        self.assertEqual(len(bump.call_args[0][0]), 1)
+        self.assertEqual(bump.call_args[1]['changes'][0]['name'], 'foo')
+        progress.assert_any_call('copy', 2, 2)
+        progress.assert_any_call('write', 1, 1)
+
+    def testPurge(self):
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        self.repodb._connection = MagicMock()
+        self.repodb._connection.caller_id = 'arn:aws:iam::123:user/foo'
+
+        def item(name, version, arch):
+            return {'Name': self.repodb._compute_keyname(
+                name, version, 'baz', 'qux', arch), 'Attributes': [
+                {'Name': 'name', 'Value': name},
+                {'Name': 'version', 'Value': version},
+                {'Name': 'distribution', 'Value': 'baz'},
+                {'Name': 'component', 'Value': 'qux'},
+                {'Name': 'architecture', 'Value': arch}]}
+        with Stubber(self.repodb._sdb) as stub, \
+                patch('apt_repoman.repodb.SELECT_THREADS', 1), \
+                patch.object(self.repodb, '_bump_generation') as bump, \
+                patch.object(self.repodb, '_unindex_names') as unindex:
+            # one query for every leaf
+            stub.add_response('select', {'Items': [
+                item('foo', '10.0', 'amd64'), item('foo', '2.0', 'amd64'),
+                item('foo', '3.0', 'amd64'), item('foo', '1.0', 'i386'),
+                item('foo', '2.0', 'i386'), item('bar', '1.0', 'i386')]}, {
+                'SelectExpression': ANY, 'ConsistentRead': True})
+            # and one batch of deletes
+            stub.add_response('batch_delete_attributes', {}, {
+                'DomainName': 'testdomain', 'Items': [
+                    {'Name': self.repodb._compute_keyname(
+                        'foo', x, 'baz', 'qux', 'amd64')}
+                    for x in ('2.0', '3.0')]})
+            self.assertEqual(self.repodb.purge(
+                [('foo', 'baz', 'qux', 'amd64'),
+                 ('bar', 'baz', 'qux', 'i386')], 1), 2)
+            stub.assert_no_pending_responses()
+        self.assertEqual([x['version'] for x in bump.call_args[1]['changes']],
+                         ['2.0', '3.0'])
+        unindex.assert_called_once_with(['foo'])
+        self.assertEqual(self.repodb.purge([], 1), 0)
 
     def testComputeKeyname(self):
         self.assertEqual(
@@ -178,6 +1061,99 @@ class RepodbTest(unittest.TestCase):
                                  'a metus\na dolor.')])
         )
 
+    def testSplitControlTextMultibyte(self):
+        # each snowman is three bytes long once encoded
+        _in = u'☃' * 5
+        self.assertEqual(
+            self.repodb._split_control_text(_in, 7),
+            OrderedDict([
+                ('controltxt0', u'☃☃'),
+                ('controltxt1', u'☃☃'),
+                ('controltxt2', u'☃')]))
+        self.assertEqual(
+            list(self.repodb._split_control_text(IPSUM).values()),
+            [IPSUM])
+
+    def testPackControlText(self):
+        packed = self.repodb._pack_control_text(IPSUM)
+        self.assertEqual(
+            packed,
+            OrderedDict([
+                ('controltxt0', IPSUM),
+                ('controlfrags', '1'),
+                ('controlfmt', 'packed')]))
+        self.assertEqual(self.repodb._unpack_control_text(packed), IPSUM)
+        self.repodb.control_format = 'zlib'
+        packed = self.repodb._pack_control_text(IPSUM * 10)
+        self.assertEqual(packed['controlfmt'], 'zlib')
+        self.assertEqual(packed['controlfrags'], '1')
+        self.assertEqual(
+            self.repodb._unpack_control_text(packed), IPSUM * 10)
+
+    def testUnpackControlTextIgnoresStaleFragments(self):
+        _in = {'controltxt0': 'foo',
+               'controltxt1': 'bar',
+               'controltxt00': 'stale',
+               'controlfrags': '2',
+               'controlfmt': 'packed'}
+        self.assertEqual(self.repodb._unpack_control_text(_in), 'foobar')
+
+    def testUnpackControlTextRewrittenByOldClient(self):
+        self.repodb.control_format = 'zlib'
+        packed = self.repodb._pack_control_text('Package: stale')
+        # rewritten in twelve fragments, without touching controlfrags
+        # or controlfmt
+        _in = dict(packed, **self.repodb._split_control_text(IPSUM, 64))
+        self.assertEqual(self.repodb._unpack_control_text(_in), IPSUM)
+        # or in fragments of the same width as the ones named
+        _in = dict(packed, **self.repodb._split_control_text(IPSUM, 400))
+        self.assertEqual(sorted(x for x in _in if x.startswith('controltxt')),
+                         ['controltxt0', 'controltxt1'])
+        self.assertEqual(self.repodb._unpack_control_text(_in), IPSUM)
+        # and the migration puts things straight
+        self.repodb.control_format = 'packed'
+        attrs, stale = self.repodb._repack_control_text(_in)
+        self.assertEqual(attrs['controltxt0'], IPSUM)
+        self.assertEqual(stale, ['controltxt1'])
+
+    def testRepackControlText(self):
+        _in = self.repodb._split_control_text(IPSUM, 64)
+        attrs, stale = self.repodb._repack_control_text(_in)
+        self.assertEqual(
+            attrs,
+            OrderedDict([
+                ('controltxt0', IPSUM),
+                ('controlfrags', '1'),
+                ('controlfmt', 'packed')]))
+        self.assertEqual(
+            sorted(stale),
+            ['controltxt%02d' % x for x in range(12)])
+        self.assertEqual(self.repodb._repack_control_text(attrs), None)
+
+    def testDeleteAttributes(self):
+        _in = self.repodb._split_control_text(IPSUM, 64)
+        attrs, stale = self.repodb._repack_control_text(_in)
+        self.repodb._sdb = botocore.session.get_session().create_client(
+            'sdb', region_name='us-east-1')
+        with Stubber(self.repodb._sdb) as stub:
+            # simpledb takes a value with every attribute name
+            stub.add_response('delete_attributes', {}, {
+                'DomainName': 'testdomain',
+                'ItemName': 'foo',
+                'Attributes': [{'Name': 'controltxt%02d' % x,
+                                'Value': _in['controltxt%02d' % x]}
+                               for x in range(12)]})
+            stub.add_response('delete_attributes', {}, {
+                'DomainName': 'testdomain',
+                'ItemName': 'meta',
+                'Attributes': [{'Name': 'dists', 'Value': 'jessie'},
+                               {'Name': 'dists', 'Value': 'xenial'}]})
+            self.repodb._delete_attributes(
+                'foo', dict((x, _in[x]) for x in stale))
+            self.repodb._delete_attributes(
+                'meta', {'dists': ['xenial', 'jessie']})
+            stub.assert_no_pending_responses()
+
     def testBuildDistRelease(self):
         date = time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime())
         self.assertEqual(
@@ -216,6 +1192,10 @@ class RepodbTest(unittest.TestCase):
                 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. Phasellus',
                 'mollis hendrerit quam, non consectetur elit vestibulum sed. Donec pharetra',
                 'egestas purus eu venenatis. Etiam dignissim pretiu\n']))
+        _in['pooldir'] = 'pool/by-hash/f/foo/CAFEFACE'
+        self.assertTrue(
+            self.repodb._create_pkg_msg_from_item(_in, 'xyzzy').startswith(
+                'Filename: pool/by-hash/f/foo/CAFEFACE/bar\n'))
 
     def testCreateSourceMessageFromItem(self):
         _in = {
@@ -232,6 +1212,10 @@ class RepodbTest(unittest.TestCase):
         self.assertEqual(
             expected,
             self.repodb._create_src_msg_from_item(_in, 'xyzzy'))
+        _in['pooldir'] = 'pool/by-hash/f/foo/abc'
+        self.assertEqual(
+            expected.replace('pool/xyzzy/f/foo', 'pool/by-hash/f/foo/abc'),
+            self.repodb._create_src_msg_from_item(_in, 'xyzzy'))
 
     def testGzipPackageFiles(self):
         # fun!
@@ -471,14 +1455,26 @@ SHA256:
              'architecture': 'a1',
              'version': '1:0.0.0-test1'}]}}}}
         self.assertEqual(
-            json.dumps(self.repodb._create_sorted_package_dict(_in)),
+            json.dumps(self.repodb._create_sorted_package_dict(_in),
+                       default=dict),
             json.dumps(_out))
         self.assertEqual(
-            json.dumps(self.repodb._create_sorted_package_dict(_in, 1)),
+            json.dumps(self.repodb._create_sorted_package_dict(_in, 1),
+                       default=dict),
             json.dumps(_onelatest))
         self.assertEqual(
-            json.dumps(self.repodb._create_sorted_package_dict(_in, 2)),
+            json.dumps(self.repodb._create_sorted_package_dict(_in, 2),
+                       default=dict),
             json.dumps(_twolatest))
+        self.assertEqual(
+            json.dumps(self.repodb._create_sorted_package_dict(_in, -1),
+                       default=dict),
+            json.dumps({'foo': {'d1': {'c1': {'a1': _out['foo']['d1'][
+                'c1']['a1'][:2]}}}}))
+        self.assertEqual(
+            json.dumps(self.repodb._create_sorted_package_dict(_in, -4),
+                       default=dict),
+            json.dumps({'foo': {'d1': {'c1': {'a1': []}}}}))
 
     def testCheckSpec(self):
         _left = {'foo': {'d1': {'c1': {'a1': [
@@ -527,6 +1523,44 @@ SHA256:
         self.assertRaises(InvalidCopyActionError,
                           self.repodb._check_spec, _left, _badlist)
 
+    @patch('apt_repoman.repodb.Repodb.check_valid_dists')
+    @patch('apt_repoman.repodb.Repodb.check_valid_comps')
+    def testGetCopySpec(self, comps, dists):
+        def item(version, comp, sha256=None):
+            return {'name': 'foo', 'version': version, 'distribution': 'd1',
+                    'component': comp, 'architecture': 'a1',
+                    'sha256': sha256 or version}
+        candidates = {'foo': {'d1': {'c1': {'a1': [
+            item('1.0', 'c1'), item('2.0', 'c1'), item('3.0', 'c1'),
+            item('4.0', 'c1')]}}}}
+        # 2.0 is already there, 3.0 is there but a different build
+        existing = {'foo': {'d1': {'c2': {'a1': [
+            item('2.0', 'c2'), item('3.0', 'c2', sha256='other')]}}}}
+        with patch.object(self.repodb, 'get_candidates',
+                          return_value=existing):
+            sources, targets = self.repodb.get_copy_spec(
+                copy.deepcopy(candidates), 'd1', 'c1', dst_comp='c2')
+            self.assertEqual(
+                [x['version'] for x in sources['foo']['d1']['c1']['a1']],
+                ['1.0', '3.0', '4.0'])
+            self.assertEqual(
+                [(x['version'], x['component'])
+                 for x in targets['foo']['d1']['c1']['a1']],
+                [('1.0', 'c2'), ('3.0', 'c2'), ('4.0', 'c2')])
+            # promotions skip what is older than the newest at target
+            sources, targets = self.repodb.get_copy_spec(
+                copy.deepcopy(candidates), 'd1', 'c1', dst_comp='c2',
+                prune_for_promote=True)
+            self.assertEqual(
+                [x['version'] for x in targets['foo']['d1']['c1']['a1']],
+                ['4.0'])
+            # nothing left to copy is not an error
+            sources, targets = self.repodb.get_copy_spec(
+                {'foo': {'d1': {'c1': {'a1': [item('2.0', 'c1')]}}}},
+                'd1', 'c1', dst_comp='c2')
+            self.assertEqual(sources['foo']['d1']['c1']['a1'], [])
+            self.assertEqual(targets['foo']['d1']['c1']['a1'], [])
+
     def testWalkNdcai(self):
         _in = {'foo': {'d1': {'c1': {'a1': ['foo-1', 'foo-2']}}}}
         _out = [('foo', 'd1', 'c1', 'a1', 'foo-1'),
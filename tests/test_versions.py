@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import unittest
+
+from pydpkg import Dpkg
+
+from apt_repoman import versions
+from apt_repoman.versions import SortedItems
+from apt_repoman.versions import compare_versions
+from apt_repoman.versions import latest_items
+from apt_repoman.versions import sort_items
+from apt_repoman.versions import version_key
+
+# oldest to newest by dpkg rules
+VERSIONS = ['0.9', '1.0~~', '1.0~~a', '1.0~', '1.0', '1.0-0.1',
+            '1.0-1~bpo', '1.0-1', '1.0-1a', '1.0-1+b1', '1.0a',
+            '1.0+', '1.00.1', '1.2', '1.10', '1:0.1']
+
+
+def _items(versions):
+    return [{'name': 'foo', 'version': x} for x in versions]
+
+
+class VersionsTest(unittest.TestCase):
+
+    def testCompareVersions(self):
+        for x in VERSIONS:
+            for y in VERSIONS:
+                self.assertEqual(compare_versions(x, y),
+                                 Dpkg.compare_versions(x, y))
+        self.assertEqual(compare_versions('1.0', '0:1.0-0'), 0)
+
+    def testVersionKey(self):
+        version_key.cache_clear()
+        self.assertEqual(sorted(reversed(VERSIONS), key=version_key),
+                         VERSIONS)
+        self.assertEqual(version_key.cache_info().currsize, len(VERSIONS))
+        self.assertEqual(version_key.cache_info().maxsize,
+                         versions.KEY_CACHE_SIZE)
+        version_key(VERSIONS[0])
+        self.assertEqual(version_key.cache_info().hits, 1)
+
+    def testSortItems(self):
+        items = _items(reversed(VERSIONS))
+        ordered = sort_items(items)
+        self.assertIsInstance(ordered, SortedItems)
+        self.assertEqual(ordered, _items(VERSIONS))
+        # sorted lists are left alone
+        self.assertIs(sort_items(ordered), ordered)
+
+    def testLatestItems(self):
+        items = _items(reversed(VERSIONS))
+        self.assertEqual(latest_items(items), _items(VERSIONS))
+        self.assertEqual(latest_items(items, 3), _items(VERSIONS[-3:]))
+        self.assertEqual(latest_items(items, 30), _items(VERSIONS))
+        self.assertEqual(latest_items(items, -3), _items(VERSIONS[:-3]))
+        self.assertEqual(latest_items(items, -30), [])
+        self.assertEqual(latest_items(sort_items(items), 2),
+                         _items(VERSIONS[-2:]))
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(VersionsTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)